@@ -0,0 +1,222 @@
+# -*- coding:utf-8 -*-
+"""Split bills of many AT&T accounts at once.
+
+Accounts are read from a manifest with one section per account:
+
+    [home]
+    username = my_att_username
+    password = my_att_password
+    holder = 415-555-0001
+    ; optional, default to ~/.attbillsplitter.home.db
+    database = ~/bills/home.db
+
+Each account is split in its own worker process with its own session and
+is saved to its own database, so accounts never wait on each other.
+"""
+
+from __future__ import print_function, unicode_literals
+try:
+    import configparser
+except:
+    import ConfigParser as configparser
+import json
+import os
+import re
+import timeit
+from multiprocessing import Pool, cpu_count
+import click
+import attbillsplitter.utils as utils
+from attbillsplitter import cookies
+from attbillsplitter.cache import PageCache
+from attbillsplitter.errors import ConfigError, LoginError
+from attbillsplitter.instrumentation import profiler
+from attbillsplitter.main import AttBillSplitter
+from attbillsplitter.transport import RetryingAdapter
+from attbillsplitter.models import (
+    DATABASE_CONFIG, db, use_database
+)
+
+
+def account_database_path(name):
+    """Get default database path of an account, next to the main database.
+
+    :param name: account name
+    :type name: str
+    :returns: database path, e.g. ~/.attbillsplitter.home.db
+    :rtype: str
+    """
+    root, ext = os.path.splitext(DATABASE_CONFIG['path'])
+    return '{}.{}{}'.format(root, re.sub(r'[^\w.-]', '_', name), ext)
+
+
+def load_manifest(path):
+    """Load accounts from a manifest.
+
+    :param path: path of the manifest
+    :type path: str
+    :returns: list of account dicts with name, username, password, holder
+        and database
+    :rtype: list
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise ConfigError('Can not read manifest {}'.format(path))
+    accounts = []
+    for name in config.sections():
+        items = dict(config.items(name))
+        missing = [key for key in ('username', 'password', 'holder')
+                   if not items.get(key)]
+        if missing:
+            raise ConfigError('Account {} is missing {}'.format(
+                name, ', '.join(missing)))
+        database = items.get('database') or account_database_path(name)
+        accounts.append({
+            'name': name,
+            'username': items['username'],
+            'password': items['password'],
+            'holder': items['holder'],
+            'database': os.path.expanduser(database),
+        })
+    return accounts
+
+
+def split_account(args):
+    """Split new bills of one account. Runs in worker processes.
+
+    :param args: tuple of account dict and options dict (lag, force, full,
+        workers, stream, no_cache, no_session and archive)
+    :type args: tuple
+    :returns: result dict with account, database, status ('ok', 'partial'
+        if some bills failed, or 'failed'), cycles, failed (bills), error,
+        elapsed_s, phases (totals per phase) and hosts (latency stats)
+    :rtype: dict
+    """
+    account, options = args
+    start = timeit.default_timer()
+    result = {'account': account['name'], 'database': account['database'],
+              'status': 'failed', 'cycles': [], 'failed': [], 'error': None,
+              'hosts': {}}
+    profiler.enable()
+    try:
+        use_database(account['database'])
+        cache = None
+        if not options['no_cache']:
+            cache = PageCache(utils.CACHE_DIR, utils.CACHE_MAX_BYTES)
+        session_path = None
+        if not options['no_session']:
+            session_path = cookies.cookie_path(utils.SESSION_DIR,
+                                               account['username'])
+        archive_dir = None
+        if options['archive']:
+            archive_dir = os.path.join(options['archive'], account['name'])
+        transport = RetryingAdapter(
+            pool_size=2 * max(1, options['workers'])
+        )
+        splitter = AttBillSplitter(
+            account['username'], account['password'],
+            workers=options['workers'], cache=cache, archive_dir=archive_dir,
+            holder_number=account['holder'], session_path=session_path,
+            transport=transport, stream=options['stream'],
+            parsed_dir=os.path.join(utils.PARSED_DIR, account['name'])
+        )
+        cycles = splitter.run(options['lag'], options['force'],
+                              options['full'])
+        result['hosts'] = transport.stats()
+        if cycles is None:
+            raise LoginError('Login failed')
+        result['cycles'] = cycles
+        result['failed'] = splitter.failed_cycles
+        result['status'] = 'partial' if splitter.failed_cycles else 'ok'
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if not db.is_closed():
+            db.close()
+    result['elapsed_s'] = timeit.default_timer() - start
+    result['phases'] = profiler.report()['totals']
+    return result
+
+
+def split_accounts(accounts, options, processes=None):
+    """Split bills of accounts in a process pool.
+
+    :param accounts: account dicts, see load_manifest
+    :type accounts: list
+    :param options: options passed to split_account
+    :type options: dict
+    :param processes: number of worker processes, default to cpu count
+    :type processes: int
+    :returns: list of result dicts (see split_account) in order of accounts
+    :rtype: list
+    """
+    if not accounts:
+        return []
+    processes = min(processes or cpu_count(), len(accounts))
+    # a fresh process for each account, so no session, database or
+    # profiler state leaks between accounts
+    pool = Pool(processes, maxtasksperchild=1)
+    try:
+        return pool.map(split_account,
+                        [(account, options) for account in accounts],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_status(results, elapsed):
+    """Print status and timing of each account.
+
+    :returns: None
+    """
+    print('{:<16} {:<7} {:>6} {:>9}  {}'.format(
+        'account', 'status', 'bills', 'seconds', 'error'))
+    for r in results:
+        print('{:<16} {:<7} {:>6} {:>9.1f}  {}'.format(
+            r['account'], r['status'], len(r['cycles']), r['elapsed_s'],
+            r['error'] or '; '.join(r['failed'])))
+    ok = sum(1 for r in results if r['status'] == 'ok')
+    print('{}/{} accounts succeeded in {:.1f}s'.format(ok, len(results),
+                                                      elapsed))
+
+
+@click.command()
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--processes', '-p', type=int,
+              help='Number of accounts to split at the same time. Default '
+                   'to number of CPUs.')
+@click.option('--workers', '-w', default=1, type=int,
+              help='Number of bills to download concurrently per account.')
+@click.option('--lag', '-l', multiple=True, type=int,
+              help='Lag of the bills to split, see att-split-bill.')
+@click.option('--force', '-f', is_flag=True, default=False,
+              help='Force to split bills that have been split before.')
+@click.option('--full', is_flag=True, default=False,
+              help='Check the whole bill history, see att-split-bill.')
+@click.option('--stream', is_flag=True, default=False,
+              help='Parse bills while they download, see att-split-bill.')
+@click.option('--no-cache', is_flag=True, default=False,
+              help='Always download bills instead of using local cache.')
+@click.option('--no-session', is_flag=True, default=False,
+              help='Always login instead of reusing saved sessions.')
+@click.option('--archive', type=click.Path(file_okay=False),
+              help=('Directory to save bill pages in, one subdirectory per '
+                    'account.'))
+@click.option('--report', type=click.Path(dir_okay=False),
+              help='Write status and timings of each account to this json '
+                   'file.')
+def run_split_accounts(manifest, processes, workers, lag, force, full,
+                       stream, no_cache, no_session, archive, report):
+    """Split AT&T wireless bills of all accounts in MANIFEST."""
+    accounts = load_manifest(manifest)
+    options = {'lag': list(lag), 'force': force, 'full': full,
+               'workers': workers, 'stream': stream, 'no_cache': no_cache,
+               'no_session': no_session, 'archive': archive}
+    start = timeit.default_timer()
+    results = split_accounts(accounts, options, processes)
+    elapsed = timeit.default_timer() - start
+    print_status(results, elapsed)
+    if report:
+        with open(report, 'w') as f:
+            json.dump({'accounts': results, 'elapsed_s': elapsed}, f,
+                      indent=2, sort_keys=True)
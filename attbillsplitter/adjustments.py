@@ -0,0 +1,188 @@
+# -*- coding:utf-8 -*-
+"""Fees, credits and percentage adjustments of wireless charges.
+
+An adjustment adds one charge to each selected user in each selected
+billing cycle, with a single INSERT ... SELECT over monthly bills, so a
+correction over every line of a whole year is one statement. Users are
+those with a monthly bill in the billing cycle. Monthly bills are then
+updated by the database triggers on charges.
+
+An adjustment is applied at most once to a user in a billing cycle:
+adding a charge name that selected users already have in selected billing
+cycles raises ValueError, so running a command twice is not silently
+ignored.
+"""
+
+from __future__ import print_function, unicode_literals
+import click
+from slugify import slugify
+import attbillsplitter.utils as utils
+from attbillsplitter.models import (
+    User, atomic, db, charge_category_cache, charge_type_cache,
+    initialize_database
+)
+
+# amount is cents added to each user
+EACH = 'each'
+# amount is cents split equally among users of each billing cycle
+SPLIT = 'split'
+# amount is percent of each user's wireless total
+PERCENT = 'percent'
+MODES = (EACH, SPLIT, PERCENT)
+
+# users of the same billing cycle selected by the adjustment
+_CYCLE_USERS = ('SELECT COUNT(*) FROM monthlybill m2 '
+                'WHERE m2.billing_cycle_id = mb.billing_cycle_id{users}')
+
+
+def _amount_sql(mode, amount, users):
+    """Get sql expression of the adjustment amount of a monthly bill mb and
+    its parameters. users is the filter of selected users on a monthly bill
+    table {table}."""
+    if mode == EACH:
+        return ('?', [int(amount)])
+    if mode == PERCENT:
+        return ('CAST(ROUND(mb.total * ? / 100.0) AS INTEGER)',
+                [float(amount)])
+    # same as utils.split_cents with equal weights: users get the floor of
+    # the equal share and cents left over go to users with the lowest ids.
+    # sqlite's % takes the sign of the amount, left is made non-negative.
+    users = users.format(table='m2')
+    count = _CYCLE_USERS.format(users=users)
+    rank = _CYCLE_USERS.format(users=users + ' AND m2.user_id < mb.user_id')
+    left = '((? % ({count})) + ({count})) % ({count})'.format(count=count)
+    return ('(? - {left}) / ({count}) + (({rank}) < {left})'.format(
+        left=left, count=count, rank=rank), [int(amount)] * 3)
+
+
+def apply_adjustment(name, amount, mode=EACH, numbers=None, since=None,
+                     until=None):
+    """Add an adjustment charge to users in billing cycles.
+
+    :param name: name of the charge, e.g. 'Twilio Fee'
+    :type name: str
+    :param amount: cents (negative for credits) for EACH and SPLIT modes,
+        percent (negative for credits) for PERCENT mode
+    :type amount: int or float
+    :param mode: EACH, SPLIT or PERCENT
+    :type mode: str
+    :param numbers: numbers of users to adjust, default to all users
+    :type numbers: list
+    :param since: (year, month) of the end of the first billing cycle to
+        adjust
+    :type since: tuple
+    :param until: (year, month) of the end of the last billing cycle to
+        adjust
+    :type until: tuple
+    :returns: number of charges added
+    :rtype: int
+    :raises ValueError: if selected users already have the charge, or the
+        name is too close to the name of another charge
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown adjustment mode {}'.format(mode))
+    users = ''
+    if numbers:
+        user_ids = [u.id for u in User.select(User.id).where(
+            User.number << list(numbers))]
+        users = ' AND {{table}}.user_id IN ({})'.format(
+            ', '.join('{:d}'.format(i) for i in user_ids) or 'NULL')
+    if since is None and until is None:
+        # most recent billing cycle
+        cycles = ('mb.billing_cycle_id = (SELECT id FROM billingcycle '
+                  'ORDER BY end_date DESC LIMIT 1)')
+        cycle_params = []
+    else:
+        cycles = ('mb.billing_cycle_id IN (SELECT id FROM billingcycle '
+                  'WHERE end_year * 100 + end_month BETWEEN ? AND ?)')
+        cycle_params = [since[0] * 100 + since[1] if since else 0,
+                        until[0] * 100 + until[1] if until else 999999]
+    amount_sql, amount_params = _amount_sql(mode, amount, users)
+    selected = users.format(table='mb')
+    with atomic():
+        category, _ = charge_category_cache.get_or_create(
+            category='wireless',
+            text='Wireless'
+        )
+        charge_type, created = charge_type_cache.get_or_create(
+            type=slugify(name),
+            charge_category=category,
+            defaults={'text': name}
+        )
+        if not created:
+            if charge_type.text != name:
+                raise ValueError('{} is too close to the name of charge '
+                                 '{}'.format(name, charge_type.text))
+            existing = db.execute_sql(
+                'SELECT COUNT(*) FROM monthlybill mb WHERE {cycles}{users} '
+                'AND EXISTS (SELECT 1 FROM charge c '
+                'WHERE c.user_id = mb.user_id '
+                'AND c.billing_cycle_id = mb.billing_cycle_id '
+                'AND c.charge_type_id = ?)'.format(cycles=cycles,
+                                                   users=selected),
+                cycle_params + [charge_type.id]
+            ).fetchone()[0]
+            if existing:
+                raise ValueError('{} was already added to {} users of these '
+                                 'billing cycles'.format(name, existing))
+        cursor = db.execute_sql(
+            'INSERT INTO charge (user_id, charge_type_id, billing_cycle_id, '
+            'amount) '
+            'SELECT mb.user_id, ?, mb.billing_cycle_id, {amount} '
+            'FROM monthlybill mb WHERE {cycles}{users} '
+            'AND NOT EXISTS (SELECT 1 FROM charge c '
+            'WHERE c.user_id = mb.user_id '
+            'AND c.billing_cycle_id = mb.billing_cycle_id '
+            'AND c.charge_type_id = ?)'.format(amount=amount_sql,
+                                               cycles=cycles,
+                                               users=selected),
+            [charge_type.id] + amount_params + cycle_params +
+            [charge_type.id]
+        )
+    return cursor.rowcount
+
+
+@click.command()
+@click.argument('charge_name', type=str)
+@click.argument('amount', type=float)
+@click.option('--credit', is_flag=True, default=False,
+              help='Subtract AMOUNT instead of adding it.')
+@click.option('--each', 'mode', flag_value=EACH, default=True,
+              help='AMOUNT is added to each user (default).')
+@click.option('--split', 'mode', flag_value=SPLIT,
+              help=('AMOUNT is a total split equally among users of each '
+                    'billing cycle.'))
+@click.option('--percent', 'mode', flag_value=PERCENT,
+              help='AMOUNT is a percentage of each user\'s wireless total.')
+@click.option('--number', '-n', multiple=True,
+              help=('Number of a user to adjust, e.g. 415-555-0001. Can be '
+                    'used multiple times. Default to all users.'))
+@click.option('--since', help=('First month (end of billing cycle) to '
+                               'adjust, e.g. 2016-01.'))
+@click.option('--until', help=('Last month (end of billing cycle) to '
+                               'adjust, e.g. 2016-12.'))
+def run_adjust(charge_name, amount, credit, mode, number, since, until):
+    """Add a fee (or credit) named CHARGE_NAME to users.
+
+    By default AMOUNT dollars are added to every user in the most recent
+    billing cycle. Use --since and --until to adjust other billing cycles.
+    """
+    initialize_database()
+    since, until = utils.parse_month(since), utils.parse_month(until)
+    if number:
+        known = set(u.number for u in User.select(User.number).where(
+            User.number << list(number)))
+        unknown = [n for n in number if n not in known]
+        if unknown:
+            raise click.BadParameter('Unknown numbers: {}'.format(
+                ', '.join(unknown)))
+    if mode != PERCENT:
+        amount = utils.to_cents(amount)
+    if credit:
+        amount = -amount
+    try:
+        added = apply_adjustment(charge_name, amount, mode, number, since,
+                                 until)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print('{} charges of {} added.'.format(added, charge_name))
@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+"""Allocation of shared charges among lines.
+
+All rules work on many billing cycles at once: amounts are given as one
+total (in cents) per cycle and weights as one row of per-line values per
+cycle. Rows may have different lengths. Each cycle's parts add up exactly
+to its total (largest remainder method, ties go to the earlier line).
+
+NumPy is used when installed, otherwise the rows are allocated one by one
+with utils.split_cents.
+"""
+
+from __future__ import division, unicode_literals
+import attbillsplitter.utils as utils
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def allocate(totals, weights):
+    """Split each cycle's total proportionally to the weights of its lines.
+
+    :param totals: cents to split for each cycle
+    :type totals: list
+    :param weights: for each cycle, a list of non-negative line weights
+    :type weights: list
+    :returns: for each cycle, a list of cents for each line
+    :rtype: list
+    """
+    if len(totals) != len(weights):
+        raise ValueError('Need one row of weights per total')
+    if np is None or not totals:
+        return [utils.split_cents(total, row)
+                for total, row in zip(totals, weights)]
+
+    lengths = [len(row) for row in weights]
+    width = max(lengths) or 1
+    w = np.zeros((len(weights), width))
+    for i, row in enumerate(weights):
+        w[i, :len(row)] = row
+    t = np.asarray(totals, dtype=np.int64)
+    w_sum = w.sum(axis=1)
+    valid = w_sum > 0
+    shares = np.zeros_like(w)
+    shares[valid] = t[valid, None] * w[valid] / w_sum[valid, None]
+    parts = np.floor(shares).astype(np.int64)
+    left = np.where(valid, t - parts.sum(axis=1), 0)
+    # rank lines by remainder, largest first and earlier line on ties
+    order = np.argsort(-(shares - parts), axis=1, kind='mergesort')
+    ranks = np.empty_like(order)
+    rows = np.arange(len(weights))[:, None]
+    ranks[rows, order] = np.arange(width)
+    parts += ranks < left[:, None]
+    return [parts[i, :n].tolist() for i, n in enumerate(lengths)]
+
+
+def equal_share(totals, counts):
+    """Split each cycle's total equally among its lines.
+
+    :param totals: cents to split for each cycle
+    :type totals: list
+    :param counts: number of lines sharing the total in each cycle
+    :type counts: list
+    :returns: for each cycle, a list of cents for each line
+    :rtype: list
+    """
+    return allocate(totals, [[1] * n for n in counts])
+
+
+def weighted_by_line(totals, line_weights):
+    """Split each cycle's total by a fixed weight per line, e.g. to make a
+    line pay double share.
+
+    :param totals: cents to split for each cycle
+    :type totals: list
+    :param line_weights: for each cycle, a list of line weights
+    :type line_weights: list
+    :returns: for each cycle, a list of cents for each line
+    :rtype: list
+    """
+    return allocate(totals, line_weights)
+
+
+def proportional_by_usage(totals, usages, allowances):
+    """Split each cycle's total among lines that used more than their
+    allowance, proportionally to the amount over used.
+
+    :param totals: cents to split for each cycle, e.g. data overage charge
+    :type totals: list
+    :param usages: for each cycle, a list of usage of each line
+    :type usages: list
+    :param allowances: allowance of each line in each cycle
+    :type allowances: list
+    :returns: for each cycle, a list of cents for each line
+    :rtype: list
+    """
+    if len(usages) != len(allowances):
+        raise ValueError('Need one allowance per row of usages')
+    overages = [[max(usage - allowance, 0) for usage in row]
+                for row, allowance in zip(usages, allowances)]
+    return allocate(totals, overages)
@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+"""Benchmark parsing and saving synthetic bills of different sizes.
+
+Run with `python -m attbillsplitter.benchmark`. Nothing is downloaded and
+bills are saved to a temporary database.
+"""
+
+from __future__ import print_function, unicode_literals
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import click
+from attbillsplitter.main import save_parsed_bill
+from attbillsplitter.models import DATABASE_CONFIG, use_database
+from attbillsplitter.parsers import parse_bill, parse_bill_stream
+from attbillsplitter.synthetic import generate_bill
+
+try:
+    import tracemalloc
+except ImportError:
+    # python2
+    tracemalloc = None
+
+DEFAULT_LINE_COUNTS = (1, 10, 50, 100, 500)
+# size of chunks fed to the streaming parser, like a download
+STREAM_CHUNK_SIZE = 16384
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence prints (e.g. overage messages) while saving bills."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def measure_parse(bill_html, usage_html, repeat):
+    """Measure time and peak memory to parse a bill.
+
+    :returns: tuple of parsed bill, best time in seconds and peak memory in
+        bytes (None if tracemalloc is not available)
+    :rtype: tuple
+    """
+    timer = timeit.Timer(lambda: parse_bill(bill_html, usage_html))
+    best = min(timer.repeat(repeat=repeat, number=1))
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        bill = parse_bill(bill_html, usage_html)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        bill = parse_bill(bill_html, usage_html)
+    return (bill, best, peak)
+
+
+def measure_stream_parse(bill_html, usage_html, repeat):
+    """Measure time to parse a bill with the streaming parser.
+
+    :returns: best time in seconds
+    :rtype: float
+    """
+    chunks = [bill_html[i:i + STREAM_CHUNK_SIZE]
+              for i in range(0, len(bill_html), STREAM_CHUNK_SIZE)]
+    timer = timeit.Timer(lambda: parse_bill_stream(chunks, [usage_html]))
+    return min(timer.repeat(repeat=repeat, number=1))
+
+
+def measure_write(bill, db_dir, index):
+    """Measure time to split and save a parsed bill to a new database.
+
+    :returns: time in seconds
+    :rtype: float
+    """
+    use_database(os.path.join(db_dir, 'bench_{}.db'.format(index)))
+    # any billing cycle name will do
+    bc_name = 'Mar 15 - Apr 14, 2016'
+    start = timeit.default_timer()
+    with _quiet():
+        save_parsed_bill(bc_name, bill, holder=0)
+    return timeit.default_timer() - start
+
+
+def benchmark(line_counts=DEFAULT_LINE_COUNTS, repeat=3):
+    """Benchmark parse and write for bills with different number of lines.
+
+    :param line_counts: numbers of lines to generate bills with
+    :type line_counts: list
+    :param repeat: parse each bill this many times and keep the best time
+    :type repeat: int
+    :returns: list of dicts with lines, bytes, parse_s, stream_s, write_s
+        and peak_bytes for each line count
+    :rtype: list
+    """
+    results = []
+    db_dir = tempfile.mkdtemp()
+    try:
+        for i, n_lines in enumerate(line_counts):
+            bill_html, usage_html = generate_bill(n_lines)
+            bill, parse_s, peak = measure_parse(bill_html, usage_html,
+                                                repeat)
+            stream_s = measure_stream_parse(bill_html, usage_html, repeat)
+            write_s = measure_write(bill, db_dir, i)
+            results.append({
+                'lines': n_lines,
+                'bytes': len(bill_html) + len(usage_html),
+                'parse_s': parse_s,
+                'stream_s': stream_s,
+                'write_s': write_s,
+                'peak_bytes': peak,
+            })
+    finally:
+        use_database(DATABASE_CONFIG['path'], initialize=False)
+        shutil.rmtree(db_dir, ignore_errors=True)
+    return results
+
+
+@click.command()
+@click.option('--lines', '-n', multiple=True, type=int,
+              help='Number of lines in the bill. Can be used multiple times.')
+@click.option('--repeat', '-r', default=3, type=int,
+              help='Number of times to parse each bill.')
+def run_benchmark(lines, repeat):
+    """Benchmark parsing and saving synthetic bills."""
+    results = benchmark(lines or DEFAULT_LINE_COUNTS, repeat)
+    print('{:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'lines', 'KB', 'parse ms', 'stream ms', 'write ms', 'peak MB'))
+    for r in results:
+        peak = ('{:.1f}'.format(r['peak_bytes'] / 1048576.0)
+                if r['peak_bytes'] is not None else '-')
+        print('{:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10}'.format(
+            r['lines'], r['bytes'] / 1024.0, r['parse_s'] * 1000,
+            r['stream_s'] * 1000, r['write_s'] * 1000, peak))
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+"""Compact binary files of parsed bills, to split bills again without
+downloading or parsing them.
+
+A file holds one billing cycle: its name, dates, statement id, the index of
+the account holder and every line with its charge blocks, account monthly
+fee and discount and data usage. Integers and floats are packed with
+struct, strings are length prefixed utf-8.
+"""
+
+from __future__ import unicode_literals
+from collections import namedtuple
+import datetime as dt
+import io
+import math
+import os
+import struct
+import tempfile
+from attbillsplitter.errors import ParsingError
+from attbillsplitter.parsers import ParsedBill, ParsedCharge, ParsedLine
+from attbillsplitter.utils import PARSED_SUFFIX
+
+MAGIC = b'ATTB'
+FORMAT_VERSION = 1
+
+# name: billing cycle name, start_date and end_date: datetime.date,
+# statement_id: AT&T bill statement id or None, holder: index of account
+# holder in bill.lines, bill: ParsedBill
+SavedBill = namedtuple('SavedBill',
+                       'name start_date end_date statement_id holder bill')
+
+_HEADER = struct.Struct('<4sB')
+_CYCLE = struct.Struct('<IIHH')
+_LINE = struct.Struct('<qqddH')
+_AMOUNT = struct.Struct('<q')
+_LENGTH = struct.Struct('<H')
+
+
+def _pack_str(out, text):
+    data = (text or '').encode('utf-8')
+    out.append(_LENGTH.pack(len(data)))
+    out.append(data)
+
+
+def _unpack_str(data, offset):
+    length, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    return (data[offset:offset + length].decode('utf-8'), offset + length)
+
+
+def _nan_to_none(value):
+    return None if math.isnan(value) else value
+
+
+def dump_bill(saved):
+    """Serialize a saved bill.
+
+    :param saved: saved bill
+    :type saved: SavedBill
+    :returns: serialized bill
+    :rtype: bytes
+    """
+    nan = float('nan')
+    out = [_HEADER.pack(MAGIC, FORMAT_VERSION)]
+    out.append(_CYCLE.pack(saved.start_date.toordinal(),
+                           saved.end_date.toordinal(),
+                           saved.holder if saved.holder is not None
+                           else 0xFFFF,
+                           len(saved.bill.lines)))
+    _pack_str(out, saved.name)
+    _pack_str(out, saved.statement_id)
+    for line in saved.bill.lines:
+        out.append(_LINE.pack(
+            line.account_monthly, line.account_discount,
+            nan if line.usage is None else line.usage,
+            nan if line.allowance is None else line.allowance,
+            len(line.charges)
+        ))
+        _pack_str(out, line.number)
+        _pack_str(out, line.name)
+        for charge in line.charges:
+            out.append(_AMOUNT.pack(charge.amount))
+            _pack_str(out, charge.text)
+    return b''.join(out)
+
+
+def load_bill(data):
+    """Deserialize a saved bill.
+
+    :param data: serialized bill
+    :type data: bytes
+    :returns: saved bill
+    :rtype: SavedBill
+    """
+    magic, version = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ParsingError('Not a parsed bill file of version {}'.format(
+            FORMAT_VERSION))
+    offset = _HEADER.size
+    start, end, holder, n_lines = _CYCLE.unpack_from(data, offset)
+    offset += _CYCLE.size
+    name, offset = _unpack_str(data, offset)
+    statement_id, offset = _unpack_str(data, offset)
+    lines = []
+    for _ in range(n_lines):
+        monthly, discount, usage, allowance, n_charges = _LINE.unpack_from(
+            data, offset)
+        offset += _LINE.size
+        number, offset = _unpack_str(data, offset)
+        line_name, offset = _unpack_str(data, offset)
+        charges = []
+        for _ in range(n_charges):
+            amount, = _AMOUNT.unpack_from(data, offset)
+            offset += _AMOUNT.size
+            text, offset = _unpack_str(data, offset)
+            charges.append(ParsedCharge(text, amount))
+        lines.append(ParsedLine(number, line_name, charges, monthly,
+                                discount, _nan_to_none(usage),
+                                _nan_to_none(allowance)))
+    return SavedBill(name, dt.date.fromordinal(start),
+                     dt.date.fromordinal(end), statement_id or None,
+                     None if holder == 0xFFFF else holder, ParsedBill(lines))
+
+
+def bill_file_path(directory, bc_name):
+    """Get path of the parsed bill file of a billing cycle.
+
+    :rtype: str
+    """
+    return os.path.join(directory, bc_name + PARSED_SUFFIX)
+
+
+def write_bill_file(directory, saved):
+    """Write a saved bill to its file in directory.
+
+    :param directory: directory of parsed bill files
+    :type directory: str
+    :param saved: saved bill
+    :type saved: SavedBill
+    :returns: path of the file
+    :rtype: str
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = bill_file_path(directory, saved.name)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(dump_bill(saved))
+    os.rename(tmp_path, path)
+    return path
+
+
+def read_bill_files(directory):
+    """Read all parsed bill files in directory, oldest billing cycle first.
+
+    :param directory: directory of parsed bill files
+    :type directory: str
+    :returns: list of saved bills
+    :rtype: list
+    """
+    saved = []
+    for name in os.listdir(directory):
+        if not name.endswith(PARSED_SUFFIX):
+            continue
+        with io.open(os.path.join(directory, name), 'rb') as f:
+            saved.append(load_bill(f.read()))
+    return sorted(saved, key=lambda s: s.end_date)
@@ -0,0 +1,190 @@
+# -*- coding:utf-8 -*-
+"""On-disk cache of raw AT&T pages.
+
+Statements of closed billing cycles never change, so their pages only need
+to be downloaded once. Bodies are zlib compressed and stored under a file
+name derived from the endpoint and the key (e.g. bill statement id).
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import os
+import tempfile
+import zlib
+
+
+class PageWriter(object):
+    """Write a page chunk by chunk, e.g. as it is downloaded.
+
+    Chunks go to a temporary file next to `path`, which is renamed to
+    `path` on commit so that readers never see a partial page.
+    """
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # exists, or created by another thread
+            if not os.path.isdir(directory):
+                raise
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        self._compressor = zlib.compressobj() if compress else None
+
+    def write(self, chunk):
+        """Write a chunk of the page.
+
+        :param chunk: chunk of page body
+        :type chunk: str
+        :returns: None
+        """
+        data = chunk.encode('utf-8')
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+    def commit(self):
+        """Save the page written so far to `path`.
+
+        :returns: None
+        """
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+        os.rename(self._tmp_path, self.path)
+
+    def discard(self):
+        """Remove the page written so far, e.g. if it is an error page.
+
+        :returns: None
+        """
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class PageCache(object):
+    """Compressed page cache with size based eviction.
+
+    Least recently used entries are evicted once the total size of the
+    cache directory exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, endpoint, key):
+        digest = hashlib.sha1(
+            '{}\n{}'.format(endpoint, key).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.z')
+
+    def get(self, endpoint, key):
+        """Get cached page body.
+
+        :param endpoint: name of the page, e.g. 'bill' or 'usage'
+        :type endpoint: str
+        :param key: key of the page, e.g. bill statement id
+        :type key: str
+        :returns: page body or None if not cached
+        :rtype: str
+        """
+        path = self._path(endpoint, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # touch for LRU eviction
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        try:
+            return zlib.decompress(data).decode('utf-8')
+        except zlib.error:
+            self._remove(path)
+            return None
+
+    def set(self, endpoint, key, body):
+        """Save page body to cache.
+
+        :param endpoint: name of the page, e.g. 'bill' or 'usage'
+        :type endpoint: str
+        :param key: key of the page, e.g. bill statement id
+        :type key: str
+        :param body: page body
+        :type body: str
+        :returns: None
+        """
+        writer = self.writer(endpoint, key)
+        writer.write(body)
+        self.commit(writer)
+
+    def writer(self, endpoint, key):
+        """Get a writer to save a page body to cache chunk by chunk. The
+        page is cached once it is passed to commit.
+
+        :param endpoint: name of the page, e.g. 'bill' or 'usage'
+        :type endpoint: str
+        :param key: key of the page, e.g. bill statement id
+        :type key: str
+        :returns: writer of the page
+        :rtype: PageWriter
+        """
+        return PageWriter(self._path(endpoint, key), compress=True)
+
+    def commit(self, writer):
+        """Save a page written with a writer of this cache.
+
+        :param writer: result of writer
+        :type writer: PageWriter
+        :returns: None
+        """
+        writer.commit()
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until cache fits in
+        `max_bytes`.
+
+        :returns: None
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.z'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        """Remove all entries.
+
+        :returns: None
+        """
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.z'):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+"""Saved AT&T session cookies, so repeat runs can skip logging in.
+
+Cookies are stored as json in a file only readable by you (mode 0600), one
+file per username.
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import tempfile
+
+
+def cookie_path(session_dir, username):
+    """Get path of the cookie file of a username.
+
+    :param session_dir: directory of cookie files
+    :type session_dir: str
+    :param username: AT&T username
+    :type username: str
+    :returns: path of the cookie file
+    :rtype: str
+    """
+    digest = hashlib.sha1(username.encode('utf-8')).hexdigest()
+    return os.path.join(session_dir, digest + '.json')
+
+
+def save_cookies(jar, path):
+    """Save cookies to a file readable only by the owner.
+
+    :param jar: cookies to save
+    :type jar: requests.cookies.RequestsCookieJar
+    :param path: path of the cookie file
+    :type path: str
+    :returns: None
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    cookies = [{
+        'name': c.name,
+        'value': c.value,
+        'domain': c.domain,
+        'path': c.path,
+        'expires': c.expires,
+        'secure': c.secure,
+    } for c in jar]
+    # mkstemp creates the file with mode 0600
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cookies, f)
+    os.rename(tmp_path, path)
+
+
+def load_cookies(jar, path):
+    """Load saved cookies into a cookie jar.
+
+    :param jar: cookie jar to load cookies into
+    :type jar: requests.cookies.RequestsCookieJar
+    :param path: path of the cookie file
+    :type path: str
+    :returns: whether any cookie was loaded
+    :rtype: bool
+    """
+    try:
+        with open(path) as f:
+            cookies = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    for c in cookies:
+        jar.set(c['name'], c['value'], domain=c['domain'], path=c['path'],
+                expires=c['expires'], secure=c['secure'])
+    return bool(cookies)
+
+
+def delete_cookies(path):
+    """Delete a cookie file if it exists.
+
+    :param path: path of the cookie file
+    :type path: str
+    :returns: None
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
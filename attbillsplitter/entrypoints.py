@@ -10,6 +10,24 @@ def split_bill():
     run_split_bill()
 
 
+def replay_bills():
+    """Split saved AT&T bills without logging in."""
+    from attbillsplitter.replay import run_replay_bills
+    run_replay_bills()
+
+
+def resplit():
+    """Split AT&T bills again from parsed bill files."""
+    from attbillsplitter.resplit import run_resplit
+    run_resplit()
+
+
+def split_accounts():
+    """Split AT&T bills of all accounts in a manifest."""
+    from attbillsplitter.accounts import run_split_accounts
+    run_split_accounts()
+
+
 def print_summary():
     """Print wireless monthly summary among users."""
     from attbillsplitter.services import run_print_summary
@@ -34,6 +52,12 @@ def add_onetime_fee():
     add_onetime_fee()
 
 
+def adjust():
+    """Add fees, credits or percentage adjustments to users."""
+    from attbillsplitter.adjustments import run_adjust
+    run_adjust()
+
+
 def init_twilio():
     """Initialize twilio credentials."""
     from attbillsplitter.utils import initialize_twiolio
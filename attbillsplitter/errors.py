@@ -24,9 +24,13 @@ class ParsingError(BaseError):
     pass
 
 
+class HolderError(ParsingError):
+    pass
+
+
 class CalculationError(BaseError):
     pass
 
 
 __all__ = ['ConfigError', 'UrlError', 'LoginError', 'ParsingError',
-           'CalculationError', 'IntegrityError']
+           'HolderError', 'CalculationError', 'IntegrityError']
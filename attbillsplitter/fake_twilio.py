@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+"""Local fake of Twilio's message API to benchmark sending offline.
+
+Run with `python -m attbillsplitter.fake_twilio`. No message leaves your
+computer.
+"""
+
+from __future__ import print_function, unicode_literals
+import json
+import random
+import threading
+import time
+import timeit
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+import click
+from attbillsplitter import messaging
+from attbillsplitter.services import MessageClient
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    """Accept any POST as a queued message. Latency and failure rate are
+    read from the server."""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        server = self.server
+        time.sleep(server.latency_s)
+        with server.lock:
+            server.received += 1
+            sid = 'SM{:032d}'.format(server.received)
+        if random.random() < server.failure_rate:
+            status, body = 503, {'status': 503, 'message': 'Unavailable'}
+        else:
+            status, body = 201, {'sid': sid, 'status': 'queued'}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTwilioServer(ThreadingMixIn, HTTPServer):
+    """Threaded fake Twilio server listening on localhost."""
+
+    daemon_threads = True
+
+    def __init__(self, latency_s=0.05, failure_rate=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeTwilioHandler)
+        self.latency_s = latency_s
+        self.failure_rate = failure_rate
+        self.received = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base(self):
+        """Base url to pass to the Twilio client."""
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        """Serve in a background thread.
+
+        :returns: None
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def benchmark(n_messages, workers, rate, latency_s, failure_rate):
+    """Send messages to a fake Twilio server.
+
+    :returns: tuple of results of send_messages and elapsed seconds
+    :rtype: tuple
+    """
+    server = FakeTwilioServer(latency_s, failure_rate)
+    server.start()
+    try:
+        client = MessageClient(number='+10000000000', account_sid='AC0',
+                               auth_token='fake', base=server.base)
+        messages = [('+1415555{:04d}'.format(i), 'Hi USER_NAME_{}'.format(i))
+                    for i in range(n_messages)]
+        start = timeit.default_timer()
+        results = messaging.send_messages(client, messages, workers, rate)
+        return (results, timeit.default_timer() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@click.command()
+@click.option('--messages', '-n', default=50, type=int,
+              help='Number of messages to send.')
+@click.option('--workers', '-w', default=messaging.DEFAULT_WORKERS,
+              type=int, help='Number of messages sent at the same time.')
+@click.option('--rate', '-r', default=20.0, type=float,
+              help='Max messages per second.')
+@click.option('--latency', default=0.05, type=float,
+              help='Response time of the fake server in seconds.')
+@click.option('--failure-rate', default=0.0, type=float,
+              help='Fraction of requests the fake server fails with 503.')
+def run_benchmark(messages, workers, rate, latency, failure_rate):
+    """Benchmark batch sending against a local fake Twilio server."""
+    results, elapsed = benchmark(messages, workers, rate, latency,
+                                 failure_rate)
+    sent = sum(1 for r in results if r['status'] == 'sent')
+    attempts = sum(r['attempts'] for r in results)
+    print('Sent {}/{} messages with {} attempts in {:.2f}s '
+          '({:.1f} messages/s)'.format(sent, len(results), attempts, elapsed,
+                                       len(results) / elapsed))
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+"""Timing and counters for phases of a split run.
+
+Each phase (login, history, bill_download, usage_download, parse, db_write)
+records wall time, HTTP requests, bytes downloaded, parsed nodes and DB
+statements, optionally per billing cycle. Counters go to the innermost
+phase running in the current thread.
+
+Profiling is off until enabled, e.g. by `att-split-bill --profile-out`.
+Functions added with `profiler.add_hook` are called with each finished
+phase record (a dict), which can be used to ship timings elsewhere.
+"""
+
+from __future__ import unicode_literals
+import contextlib
+import json
+import threading
+import timeit
+
+COUNTERS = ('requests', 'bytes', 'nodes', 'statements')
+
+
+class Profiler(object):
+    """Collect phase records."""
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        """Start collecting phase records.
+
+        :returns: None
+        """
+        self.enabled = True
+
+    def add_hook(self, hook):
+        """Call hook with each finished phase record. Enables profiling.
+
+        :param hook: callable taking a record dict
+        :type hook: callable
+        :returns: None
+        """
+        self.hooks.append(hook)
+        self.enable()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def phase(self, name, cycle=None):
+        """Time a phase and collect its counters.
+
+        :param name: name of the phase
+        :type name: str
+        :param cycle: billing cycle name the phase belongs to, if any
+        :type cycle: str
+        """
+        if not self.enabled:
+            yield None
+            return
+        record = {'phase': name, 'cycle': cycle, 'wall_s': 0.0}
+        record.update((c, 0) for c in COUNTERS)
+        stack = self._stack()
+        stack.append(record)
+        start = timeit.default_timer()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = timeit.default_timer() - start
+            stack.pop()
+            with self._lock:
+                self.records.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def count(self, **counters):
+        """Add to counters of the current phase, e.g. count(requests=1).
+
+        :returns: None
+        """
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if not stack:
+            return
+        record = stack[-1]
+        for key, value in counters.items():
+            record[key] += value
+
+    def count_response(self, response, *args, **kwargs):
+        """Response hook for requests sessions.
+
+        :returns: None
+        """
+        if not self.enabled:
+            return
+        if kwargs.get('stream'):
+            # reading content here would defeat streaming
+            size = int(response.headers.get('Content-Length', 0))
+        else:
+            size = len(response.content)
+        self.count(requests=1, bytes=size)
+
+    def count_statement(self, sql, params):
+        """Statement callback for the database.
+
+        :returns: None
+        """
+        self.count(statements=1)
+
+    def report(self):
+        """Summarize records.
+
+        :returns: dict with all phase records, totals per phase and totals
+            per billing cycle and phase
+        :rtype: dict
+        """
+        totals = {}
+        cycles = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            targets = [totals]
+            if record['cycle'] is not None:
+                targets.append(cycles.setdefault(record['cycle'], {}))
+            for target in targets:
+                total = target.setdefault(record['phase'], dict(
+                    [('count', 0), ('wall_s', 0.0)] +
+                    [(c, 0) for c in COUNTERS]
+                ))
+                total['count'] += 1
+                total['wall_s'] += record['wall_s']
+                for c in COUNTERS:
+                    total[c] += record[c]
+        return {'phases': records, 'totals': totals, 'cycles': cycles}
+
+    def write_json(self, path, **extra):
+        """Write report to a json file.
+
+        :param path: path of the json file
+        :type path: str
+        :param extra: more entries to write, e.g. hosts=latency stats
+        :returns: None
+        """
+        report = self.report()
+        report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+profiler = Profiler()
@@ -3,42 +3,53 @@
 
 from __future__ import print_function, unicode_literals
 from builtins import input
+from collections import OrderedDict
 import datetime as dt
 import re
+from multiprocessing.pool import ThreadPool
 import click
-import peewee as pw
 import requests
-from bs4 import BeautifulSoup, Tag
 from slugify import slugify
 
 # import fake_useragent
-from attbillsplitter.errors import ParsingError
+import attbillsplitter.utils as utils
+from attbillsplitter import allocation, billfile, cookies
+from attbillsplitter.cache import PageCache, PageWriter
+from attbillsplitter.errors import HolderError, ParsingError
+from attbillsplitter.instrumentation import profiler
+from attbillsplitter.parsers import (
+    add_usage_stream, has_usage_tiles, make_soup, parse_bill,
+    stream_bill_lines
+)
+from attbillsplitter.transport import (
+    DEFAULT_CONNECT_TIMEOUT_S, DEFAULT_READ_TIMEOUT_S, DEFAULT_RETRIES,
+    RetryingAdapter, run_concurrently
+)
 from attbillsplitter.models import (
-    User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill, db
+    ChargeType, BillingCycle, Charge, db, charge_category_cache,
+    charge_type_cache, initialize_database, user_cache
 )
 
 
 CHROME_AGENT = ('Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 '
                 '(KHTML, like Gecko) Chrome/28.0.1468.0 Safari/537.36')
 # CHROME_AGENT = fake_useragent.UserAgent().chrome
-
-
-def create_tables_if_not_exist():
-    """Create tables in database if tables do not exist.
-
-    Tables will be created for following models:
-        - User
-        - ChargeCategory
-        - ChargeType
-        - BillingCycle
-        - Charge
-        - MonthlyBill
-    """
-    db.connect()
-    for model in (User, ChargeCategory, ChargeType, BillingCycle, Charge,
-                  MonthlyBill):
-        if not model.table_exists():
-            model.create_table()
+BILL_LINK_TEMPLATE = (
+    'https://www.att.com/olam/billPrintPreview.myworld?'
+    'fromPage=history&billStatementID={}'
+)
+USAGE_URL = 'https://www.att.com/olam/billUsageTiles.myworld'
+HISTORY_URL = 'https://www.att.com/olam/billingPaymentHistoryAction.myworld'
+# (type, text) of charge types created when splitting
+ACCOUNT_SHARE_CHARGE_TYPE = ('wireless-acount-monthly-charges-share',
+                             'Account Monthly Charges Share')
+OVERAGE_CHARGE_TYPE = ('data-text-usage-charges',
+                       'Data & Text Usage Charges')
+INSERT_BATCH_SIZE = 100
+# times a billing cycle is downloaded again if splitting it failed
+CYCLE_RETRIES = 2
+# bytes of a page read at a time when streaming
+STREAM_CHUNK_SIZE = 16384
 
 
 def get_start_end_date(bc_name):
@@ -58,35 +69,340 @@ def get_start_end_date(bc_name):
     return (start_date, end_date)
 
 
-def aggregate_wireless_monthly(bc):
-    """Aggregate wireless charges among all lines.
+def save_split_bill(bc_name, start_date, end_date, charges,
+                    statement_id=None):
+    """Save billing cycle, wireless charges and monthly totals of a split
+    bill in one transaction.
 
-    :param bc: billing_cycle object
-    :type bc: BillingCycle
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :param start_date: start date of billing cycle
+    :type start_date: datetime.date
+    :param end_date: end date of billing cycle
+    :type end_date: datetime.date
+    :param charges: list of tuples of user, wireless charge type and amount
+        in cents
+    :type charges: list
+    :param statement_id: AT&T bill statement id, if known
+    :type statement_id: str
+    :returns: billing cycle object
+    :rtype: BillingCycle
+    """
+    with profiler.phase('db_write', bc_name), db.atomic():
+        billing_cycle = BillingCycle.create(name=bc_name,
+                                            start_date=start_date,
+                                            end_date=end_date,
+                                            statement_id=statement_id)
+        insert_split_charges(billing_cycle, charges)
+    return billing_cycle
+
+
+def insert_split_charges(billing_cycle, charges):
+    """Insert wireless charges of a billing cycle in batches. Monthly totals
+    are updated by database triggers.
+
+    :param billing_cycle: billing cycle of the charges
+    :type billing_cycle: BillingCycle
+    :param charges: list of tuples of user, wireless charge type and amount
+        in cents
+    :type charges: list
     :returns: None
     """
-    if MonthlyBill.select().where(MonthlyBill.billing_cycle == bc).exists():
-        print('\U000026A0  Charges already aggregated for {}'.format(
-            bc.name).encode("utf-8"))
-        return
-
-    query = (
-        User
-        .select(User,
-                pw.fn.SUM(Charge.amount).alias('total'))
-        .join(Charge)
-        .join(BillingCycle)
-        .switch(Charge)
-        .join(ChargeType)
-        .join(ChargeCategory)
-        .where(BillingCycle.id == bc.id,
-               ChargeCategory.category == 'wireless')
-        .group_by(User, BillingCycle)
-        .naive()
+    rows = [
+        {'user': user, 'charge_type': charge_type,
+         'billing_cycle': billing_cycle, 'amount': amount}
+        for user, charge_type, amount in charges
+    ]
+    # stay below sqlite's limit of host parameters per statement
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        Charge.insert_many(rows[i:i + INSERT_BATCH_SIZE]).execute()
+
+
+def update_split_bill(billing_cycle, charges):
+    """Update wireless charges of a billing cycle that was split before to a
+    new split of its bill, in one transaction.
+
+    New charges are compared to stored ones and only inserts, updates and
+    deletes of charges that changed are applied. Database triggers update
+    monthly totals of users whose charges changed.
+
+    All stored charges of types that come from bills are compared, so
+    charges of a type dropped from a corrected bill are deleted, while
+    adjustments (e.g. one time fees) are kept.
+
+    :param billing_cycle: billing cycle split before
+    :type billing_cycle: BillingCycle
+    :param charges: list of tuples of user, wireless charge type and amount
+        in cents, see prepare_split_charges
+    :type charges: list
+    :returns: tuple of numbers of charges inserted, updated and deleted
+    :rtype: tuple
+    """
+    split_types = ChargeType.select(ChargeType.id).where(
+        ChargeType.from_bill == True
     )
-    results = query.execute()
-    for user in results:
-        MonthlyBill.create(user=user, billing_cycle=bc, total=user.total)
+    new = OrderedDict()
+    for user, charge_type, amount in charges:
+        key = (user.id, charge_type.id)
+        new[key] = new.get(key, 0) + amount
+    with profiler.phase('db_write', billing_cycle.name), db.atomic():
+        # (user id, charge type id) to (charge id, amount)
+        stored = dict(
+            ((user_id, charge_type_id), (charge_id, amount))
+            for charge_id, user_id, charge_type_id, amount in Charge.select(
+                Charge.id, Charge.user, Charge.charge_type, Charge.amount
+            ).where(
+                Charge.billing_cycle == billing_cycle,
+                Charge.charge_type << split_types
+            ).tuples()
+        )
+        inserts = [key for key in new if key not in stored]
+        updates = [key for key in new
+                   if key in stored and stored[key][1] != new[key]]
+        deletes = [key for key in stored if key not in new]
+        delete_ids = [stored[key][0] for key in deletes]
+        for i in range(0, len(delete_ids), INSERT_BATCH_SIZE):
+            Charge.delete().where(
+                Charge.id << delete_ids[i:i + INSERT_BATCH_SIZE]
+            ).execute()
+        for key in updates:
+            Charge.update(amount=new[key]).where(
+                Charge.id == stored[key][0]
+            ).execute()
+        rows = [
+            {'user': key[0], 'charge_type': key[1],
+             'billing_cycle': billing_cycle, 'amount': new[key]}
+            for key in inserts
+        ]
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            Charge.insert_many(rows[i:i + INSERT_BATCH_SIZE]).execute()
+    return (len(inserts), len(updates), len(deletes))
+
+
+def choose_account_holder(users):
+    """Ask which user is the account holder.
+
+    :param users: list of user objects or parsed lines
+    :type users: list
+    :returns: index of account holder in users
+    :rtype: int
+    """
+    message = 'Choose account holder\'s number\n'
+    for i, user in enumerate(users):
+        message += '{}: {}\n'.format(i, user.number)
+    while True:
+        ind = input(message + '> ')
+        try:
+            if 0 <= int(ind) < len(users):
+                return int(ind)
+        except ValueError:
+            pass
+        print('You have to input a number from 0 to {}'.format(len(users) - 1))
+
+
+def find_holder(bill, holder_number):
+    """Find account holder in a parsed bill by number.
+
+    :param bill: parsed bill
+    :type bill: ParsedBill
+    :param holder_number: number of account holder, e.g. '415-555-0001'
+    :type holder_number: str
+    :returns: index of account holder in bill.lines, None if not found
+    :rtype: int
+    """
+    for i, line in enumerate(bill.lines):
+        if line.number == holder_number:
+            return i
+    return None
+
+
+def split_parsed_bills(bills):
+    """Split wireless charges of parsed bills among lines.
+
+    Account monthly charges (less national account discount) are shared
+    equally by all charged lines. Data overage is shared by lines that used
+    more than their share of data allowance, proportionally to the amount
+    over used, or by the account holder if no line did. Everything else is
+    charged to the line it belongs to.
+
+    Shared charges of all bills are allocated at once, so splitting many
+    bills again (see resplit module) is one pass of the allocation module.
+
+    :param bills: list of tuples of parsed bill and index of account holder
+        in its lines
+    :type bills: list
+    :returns: for each bill, a list of tuples of line index, charge type,
+        charge type text and amount in cents
+    :rtype: list
+    """
+    all_splits = []
+    # for each bill with lines: splits, lines sharing the account monthly
+    # charges and its total
+    shared = []
+    # for each bill with data overage: splits, lines, indexes of lines with
+    # data usage, share of data allowance and overage total
+    overages = []
+    for bill, holder in bills:
+        splits = []
+        all_splits.append(splits)
+        lines = bill.lines
+        if not lines:
+            continue
+        holder_line = lines[holder]
+        account_total = (holder_line.account_monthly -
+                         holder_line.account_discount)
+        charged = [holder]
+        overage_total = None
+        for charge in holder_line.charges:
+            charge_type = slugify(charge.text)
+            # data overage needs to be shared proportionally
+            if charge_type == OVERAGE_CHARGE_TYPE[0]:
+                overage_total = charge.amount
+                continue
+            amount = charge.amount
+            if charge.text == 'Monthly Charges':
+                # account monthly fee is shared, only keep holder's line fee
+                amount -= account_total
+            splits.append((holder, charge_type, charge.text, amount))
+
+        # iterate regular users
+        for i, line in enumerate(lines):
+            if i == holder:
+                continue
+            for charge in line.charges:
+                splits.append((i, slugify(charge.text), charge.text,
+                               charge.amount))
+            if any(charge.amount > 0 for charge in line.charges):
+                charged.append(i)
+        shared.append((splits, charged, account_total))
+
+        if overage_total is not None:
+            if holder_line.allowance is None:
+                raise ParsingError('Data usage not found for account holder')
+            # account holder first, then other lines with data usage
+            used = [holder] + [i for i, line in enumerate(lines)
+                               if i != holder and line.usage is not None]
+            overages.append((splits, lines, used,
+                             holder_line.allowance / len(charged),
+                             overage_total))
+
+    # leftover cents go to the first users so that shares add up exactly
+    shares = allocation.equal_share([total for _, _, total in shared],
+                                    [len(charged) for _, charged, _ in shared])
+    for (splits, charged, _), cycle_shares in zip(shared, shares):
+        for i, share in zip(charged, cycle_shares):
+            splits.append((i,) + ACCOUNT_SHARE_CHARGE_TYPE + (share,))
+
+    amounts = allocation.proportional_by_usage(
+        [total for _, _, _, _, total in overages],
+        [[lines[i].usage for i in used] for _, lines, used, _, _ in overages],
+        [user_share for _, _, _, user_share, _ in overages]
+    )
+    for (splits, lines, used, user_share, total), cycle_amounts in zip(
+            overages, amounts):
+        if not any(lines[i].usage > user_share for i in used):
+            # nobody used more than their share, the account holder (first
+            # in used) pays the overage
+            splits.append((used[0],) + OVERAGE_CHARGE_TYPE + (total,))
+            continue
+        for i, amount in zip(used, cycle_amounts):
+            over = lines[i].usage - user_share
+            if over <= 0:
+                continue
+            print('User {} over used {} GB data, will be charged extra '
+                  '${}'.format(lines[i].name, over,
+                               utils.format_cents(amount)))
+            splits.append((i,) + OVERAGE_CHARGE_TYPE + (amount,))
+    return all_splits
+
+
+def split_parsed_bill(bill, holder):
+    """Split wireless charges of a parsed bill among lines, see
+    split_parsed_bills.
+
+    :param bill: parsed bill
+    :type bill: ParsedBill
+    :param holder: index of account holder in bill.lines
+    :type holder: int
+    :returns: list of tuples of line index, charge type, charge type text
+        and amount in cents
+    :rtype: list
+    """
+    return split_parsed_bills([(bill, holder)])[0]
+
+
+def prepare_split_charges(bill, holder, splits=None):
+    """Split a parsed bill into charges of users, creating users and charge
+    types that do not exist yet.
+
+    :param bill: parsed bill
+    :type bill: ParsedBill
+    :param holder: index of account holder in bill.lines
+    :type holder: int
+    :param splits: splits of the bill from split_parsed_bills, computed if
+        not given
+    :type splits: list
+    :returns: list of tuples of user, wireless charge type and amount in
+        cents
+    :rtype: list
+    """
+    if not bill.lines:
+        return []
+    users = [
+        user_cache.get_or_create(name=line.name, number=line.number)[0]
+        for line in bill.lines
+    ]
+    # --------------------------------------------------------------------
+    # Wireless
+    # --------------------------------------------------------------------
+    wireless_charge_category, _ = charge_category_cache.get_or_create(
+        category='wireless',
+        text='Wireless'
+    )
+    if splits is None:
+        splits = split_parsed_bill(bill, holder)
+    charges = []
+    for i, type_, text, amount in splits:
+        charge_type, _ = charge_type_cache.get_or_create(
+            type=type_,
+            text=text,
+            charge_category=wireless_charge_category,
+            defaults={'from_bill': True}
+        )
+        if not charge_type.from_bill:
+            # e.g. created before charge types were marked
+            ChargeType.update(from_bill=True).where(
+                ChargeType.id == charge_type.id
+            ).execute()
+            charge_type.from_bill = True
+        charges.append((users[i], charge_type, amount))
+    return charges
+
+
+def save_parsed_bill(bc_name, bill, holder=None, statement_id=None,
+                     splits=None):
+    """Split a parsed bill and save users, charges and monthly totals.
+
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :param bill: parsed bill
+    :type bill: ParsedBill
+    :param holder: index of account holder in bill.lines, asked if None
+    :type holder: int
+    :param statement_id: AT&T bill statement id, if known
+    :type statement_id: str
+    :param splits: splits of the bill from split_parsed_bills, computed if
+        not given
+    :type splits: list
+    :returns: billing cycle object
+    :rtype: BillingCycle
+    """
+    start_date, end_date = get_start_end_date(bc_name)
+    if holder is None and bill.lines:
+        holder = choose_account_holder(bill.lines)
+    charges = prepare_split_charges(bill, holder, splits)
+    return save_split_bill(bc_name, start_date, end_date, charges,
+                           statement_id)
 
 
 class AttBillSplitter(object):
@@ -96,12 +412,42 @@ class AttBillSplitter(object):
     Share Value Plan (for wireless).
     """
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, workers=1, cache=None,
+                 archive_dir=None, holder_number=None, session_path=None,
+                 transport=None, stream=False, parsed_dir=None):
         self.username = username
         self.password = password
+        # account holder's number, asked for each bill if not given
+        self.holder_number = holder_number
+        # optional file to save session cookies in to skip login next time
+        self.session_path = session_path
+        # history page fetched when validating a saved session
+        self._history_html = None
+        self.workers = max(1, workers)
+        # optional PageCache for pages that never change
+        self.cache = cache
+        # statement ids of bills split again with force, whose cached pages
+        # may be outdated, e.g. if AT&T corrected the bill
+        self.refresh_statements = set()
+        # optional directory to save pages in for att-replay-bills
+        self.archive_dir = archive_dir
+        # parse bill pages while they are downloaded
+        self.stream = stream
+        # optional directory to save parsed bills in for att-resplit
+        self.parsed_dir = parsed_dir
+        # billing cycles that still failed after CYCLE_RETRIES retries
+        self.failed_cycles = []
         self.session = requests.session()
+        # share one connection pool among all fetch workers, each fetching
+        # a bill and its usage at the same time
+        self.transport = transport or RetryingAdapter(
+            pool_size=2 * self.workers
+        )
+        self.session.mount('https://', self.transport)
+        self.session.mount('http://', self.transport)
         headers = {'User-Agent': CHROME_AGENT}
         self.session.headers.update(headers)
+        self.session.hooks['response'].append(profiler.count_response)
 
     def login(self):
         """Login to your AT&T online account.
@@ -155,6 +501,39 @@ class AttBillSplitter(object):
                   'password and retry. Or something unexpected happened.'.encode("utf-8"))
             return False
 
+    def resume_session(self):
+        """Reuse saved session cookies if AT&T still accepts them.
+
+        The session is validated with a single request to the bill history
+        page, which is kept for get_history_bills. Expired sessions are
+        redirected to login and their cookies are discarded.
+
+        :returns: whether the saved session is valid
+        :rtype: bool
+        """
+        if not self.session_path or not cookies.load_cookies(
+                self.session.cookies, self.session_path):
+            return False
+        bh_req = self.session.get(HISTORY_URL,
+                                  params={'action': 'ViewBillHistory'},
+                                  allow_redirects=False)
+        if (bh_req.status_code == requests.codes.ok and
+                'bill_period' in bh_req.text):
+            self._history_html = bh_req.text
+            print('\U00002705  Resumed saved session.'.encode("utf-8"))
+            return True
+        self.session.cookies.clear()
+        cookies.delete_cookies(self.session_path)
+        return False
+
+    def save_session(self):
+        """Save session cookies if a session file is set.
+
+        :returns: None
+        """
+        if self.session_path:
+            cookies.save_cookies(self.session.cookies, self.session_path)
+
     def click_skip_promo(self):
         """Request to skip the promo popup
 
@@ -175,11 +554,14 @@ class AttBillSplitter(object):
 
         :yields: tuple of billing_cycle name and link to the bill
         """
-        # this request will add some cookie
-        self.session.get(
-            'https://www.att.com/olam/passthroughAction.myworld',
-            params={'actionType': 'ViewBillHistory'}
-        )
+        bh_text = self._history_html
+        self._history_html = None
+        if bh_text is None:
+            # this request will add some cookie, resumed sessions have it
+            self.session.get(
+                'https://www.att.com/olam/passthroughAction.myworld',
+                params={'actionType': 'ViewBillHistory'}
+            )
 
         # obtain account number from bill detail page
         # seems like for accounts with uverse services, the link to get the account
@@ -189,10 +571,26 @@ class AttBillSplitter(object):
         uverse_url = ('https://www.att.com/olam/acctInfoView.myworld?'
                       'actionEvent=displayProfileInformation')
         wireless_url = 'https://www.att.com/olam/ViewBillDetailsAction.myworld'
-        an_req = self.session.get(wireless_url)
+        # pages that are not cached are downloaded at the same time. The
+        # uverse page is requested speculatively with the wireless one.
+        calls = {}
+        an_text = self._cache_get('wireless-account', self.username)
+        uverse_text = None
+        if an_text is None:
+            calls['wireless'] = lambda: self.session.get(wireless_url).text
+            uverse_text = self._cache_get('uverse-account', self.username)
+            if uverse_text is None:
+                calls['uverse'] = lambda: self.session.get(uverse_url).text
+        if bh_text is None:
+            calls['history'] = self.fetch_history
+        fetched = run_concurrently(calls)
+        an_text = fetched.get('wireless', an_text)
+        bh_text = fetched.get('history', bh_text)
+
         act_num_full = re.search(
-            'wirelessAccountNumber":"[0-9]+"', an_req.text)
+            'wirelessAccountNumber":"[0-9]+"', an_text)
         if act_num_full:
+            self._cache_set('wireless-account', self.username, an_text)
             bill_statement_id_template = '{}|{}|T01|W'
             try:
                 act_num_str = act_num_full.group(0)
@@ -202,24 +600,23 @@ class AttBillSplitter(object):
                 raise ParsingError('Account number not found!')
             act_num = re.search('[0-9]+', act_num_str).group(0)
         else:
-            an_req = self.session.get(uverse_url)
+            an_text = fetched.get('uverse', uverse_text)
+            if an_text is None:
+                an_text = self.session.get(uverse_url).text
             bill_statement_id_template = '{}|{}|T06|V'
-            an_soup = BeautifulSoup(an_req.text, 'html.parser')
+            an_soup = make_soup(an_text, 'account')
             act_num_tag = an_soup.find('span', class_='account-number')
-            m = re.search(r'.?(\d+).?', act_num_tag.text, re.DOTALL)
+            m = act_num_tag and re.search(r'.?(\d+).?', act_num_tag.text,
+                                          re.DOTALL)
             if not m:
                 print(
                     'Something went wrong. Could not find account number from bill detail page.')
                 raise ParsingError('Account number not found!')
+            self._cache_set('uverse-account', self.username, an_text)
             act_num = m.group(1)
 
         # now we can get billing history
-        bh_req = self.session.get(
-            'https://www.att.com/olam/billingPaymentHistoryAction.myworld',
-            params={'action': 'ViewBillHistory'}
-        )
-        bh_req.raise_for_status()
-        bh_soup = BeautifulSoup(bh_req.text, 'html.parser')
+        bh_soup = make_soup(bh_text, 'history')
         bc_tags = bh_soup.find_all('td', headers=['bill_period'])
         for tag in bc_tags:
             bc_name = tag.contents[0]
@@ -230,304 +627,360 @@ class AttBillSplitter(object):
                 end_date_str, act_num)
             yield (bc_name, bill_statement_id)
 
-    def parse_user_info(self, bill_html):
-        """Parse the bill to find name and number for each line and create
-        users. Account holder should be the first entry.
+    def fetch_history(self):
+        """Download bill history page.
 
-        :returns: list of user objects
-        :rtype: list
-        :returns: None
+        :returns: bill history page html
+        :rtype: str
         """
-        users = []
-        soup = BeautifulSoup(bill_html, 'html.parser')
-        number_tags = soup.find_all('div', string=re.compile('Total for'))
-        for num_tag in number_tags:
-            number = num_tag.text.lstrip('Total for')
-            # get name for number
-            name_tag = soup.find('div', class_='accRow bold MarTop10',
-                                 string=re.compile('{}'.format(number)))
-            name = name_tag.text.rstrip(' {}'.format(number))
-            user, _ = User.get_or_create(name=name, number=number)
-            users.append(user)
-        return users
-
-    def split_bill(self, bc_name, bill_statement_id):
-        """Parse bill and split wireless charges among users.
+        bh_req = self.session.get(HISTORY_URL,
+                                  params={'action': 'ViewBillHistory'})
+        bh_req.raise_for_status()
+        return bh_req.text
+
+    def fetch_bill(self, bill_statement_id):
+        """Download bill page for a billing cycle.
 
-        Currently not parsing U-Verse charges.
-        :param bc_name: billing cycle name
-        :type bc_name: str
         :param bill_statement_id: bill statement id, used in link
         :type bill_statement_id: str
-        :returns: None
+        :returns: bill page html
+        :rtype: str
         """
-        bill_link_template = (
-            'https://www.att.com/olam/billPrintPreview.myworld?'
-            'fromPage=history&billStatementID={}'
-        )
+        bill_html = self._cache_get('bill', bill_statement_id)
+        if bill_html is not None:
+            return bill_html
         bill_req = self.session.get(
-            bill_link_template.format(bill_statement_id))
+            BILL_LINK_TEMPLATE.format(bill_statement_id))
         bill_html = bill_req.text
-        if 'Account Details' not in bill_html:
-            raise ParsingError('Failed to retrieve billing page')
+        # never cache error pages
+        if 'Account Details' in bill_html:
+            self._cache_set('bill', bill_statement_id, bill_html)
+        return bill_html
 
-        soup = BeautifulSoup(bill_html, 'html.parser')
-        start_date, end_date = get_start_end_date(bc_name)
-        billing_cycle = BillingCycle.create(name=bc_name,
-                                            start_date=start_date,
-                                            end_date=end_date)
+    def stream_bill(self, bill_statement_id, bc_name=None):
+        """Download bill page and extract its lines as it arrives.
 
-        # parse user name and number
-        users = self.parse_user_info(bill_html)
-        if not users:
-            return
+        Downloaded chunks are written straight to the cache and archive, so
+        the whole page is never kept in memory.
+
+        :param bill_statement_id: bill statement id, used in link
+        :type bill_statement_id: str
+        :param bc_name: billing cycle name, to archive the page under
+        :type bc_name: str
+        :returns: tuple of parser with lines of the bill (see
+            parsers.stream_bill_lines) and bill page html (None if it was
+            downloaded)
+        :rtype: tuple
+        """
+        bill_html = self._cache_get('bill', bill_statement_id)
+        if bill_html is not None:
+            return (stream_bill_lines([bill_html]), bill_html)
+        cache_writer = archive_writer = None
+        if self.cache is not None:
+            cache_writer = self.cache.writer('bill', bill_statement_id)
+        if self.archive_dir and bc_name:
+            bill_path, _ = utils.bill_page_paths(self.archive_dir, bc_name)
+            archive_writer = PageWriter(bill_path)
+        writers = [w for w in (cache_writer, archive_writer) if w is not None]
+
+        def chunks():
+            bill_req = self.session.get(
+                BILL_LINK_TEMPLATE.format(bill_statement_id), stream=True)
+            try:
+                if bill_req.encoding is None:
+                    bill_req.encoding = 'utf-8'
+                for chunk in bill_req.iter_content(STREAM_CHUNK_SIZE,
+                                                   decode_unicode=True):
+                    for writer in writers:
+                        writer.write(chunk)
+                    yield chunk
+            finally:
+                bill_req.close()
 
-        message = 'Choose account holder\'s number\n'
-        for i, user in enumerate(users):
-            message += '{}: {}\n'.format(i, user.number)
-    
-        ind = input(message + '> ')
         try:
-            account_holder = users[int(ind)]
-        except:
-            print('You have to input a number from 0 to {}'.format(len(users) - 1))
-        # --------------------------------------------------------------------
-        # Wireless
-        # --------------------------------------------------------------------
-        wireless_charge_category, _ = ChargeCategory.get_or_create(
-            category='wireless',
-            text='Wireless'
-        )
-        charged_users = [account_holder]
-        name, number = account_holder.name, account_holder.number
-        offset = 0.0
-        # charge section starts with user name followed by his/her number
-        target = soup.find('div',
-                           string=re.compile('{} {}'.format(name, number)))
-        # fetch data usage in case there is an overage
+            # raises ParsingError for error pages, so they are never saved
+            bill_parser = stream_bill_lines(chunks())
+        except BaseException:
+            for writer in writers:
+                writer.discard()
+            raise
+        if cache_writer is not None:
+            self.cache.commit(cache_writer)
+        if archive_writer is not None:
+            archive_writer.commit()
+        return (bill_parser, None)
+
+    def fetch_usage(self, bill_statement_id):
+        """Download data usage tiles for a billing cycle.
+
+        :param bill_statement_id: bill statement id
+        :type bill_statement_id: str
+        :returns: usage tiles html
+        :rtype: str
+        """
+        usage_html = self._cache_get('usage', bill_statement_id)
+        if usage_html is not None:
+            return usage_html
         usage_req = self.session.post(
-            'https://www.att.com/olam/billUsageTiles.myworld',
-            data={'billStatementID': bill_statement_id}
+            USAGE_URL, data={'billStatementID': bill_statement_id}
         )
-        usage_soup = BeautifulSoup(usage_req.text, 'html.parser')
-        usages = {}
-        overage_charge_type_name = 'data-text-usage-charges'
-        overage_charge_type_text = 'Data & Text Usage Charges'
-        data_overused = False
-        for tag in target.parent.next_siblings:
-            # all charge data are in divs
-            if not isinstance(tag, Tag) or tag.name != 'div':
-                continue
+        # never cache error pages, which may be sent with status 200 too
+        if (usage_req.status_code == requests.codes.ok and
+                has_usage_tiles(usage_req.text)):
+            self._cache_set('usage', bill_statement_id, usage_req.text)
+        return usage_req.text
 
-            # charge section ends with Total for number
-            if 'Total for {}'.format(number) in tag.text:
-                break
+    def _cache_get(self, endpoint, key):
+        # downloaded pages of bills split again replace the cached ones
+        if self.cache is None or key in self.refresh_statements:
+            return None
+        return self.cache.get(endpoint, key)
 
-            # each charge type has 'accSummary' as one of its css classes
-            if 'accSummary' in tag.get('class', []):
-                charge_type_text = tag.find('div').text.strip('\n\t')
-                if charge_type_text.startswith('Monthly Charges'):
-                    charge_type_text = 'Monthly Charges'
-                    # account monthly fee will be shared by all users
-                    w_act_m = float(
-                        re.search(r'\$([0-9.]+)', tag.text).group(1)
-                    )
-                    # national discount is applied to account monthly fee
-                    m = re.search(
-                        r'National Account Discount.*?\$([0-9.]+)',
-                        tag.text, re.DOTALL
-                    )
-                    w_act_m_disc = float(m.group(1)) if m else 0.0
-                    # this non-zero offset will be used to adjust account
-                    # holder's total monthly charge
-                    offset = w_act_m - w_act_m_disc
-
-                m = re.search(
-                    r'Total {}.*?\$([0-9.]+)'.format(charge_type_text),
-                    tag.text,
-                    flags=re.DOTALL
-                )
-                charge_type_name = slugify(charge_type_text)
-
-                # check if it's a data overage which needs to be shared proportionaly
-                if charge_type_name == overage_charge_type_name:
-                    data_overused = True
-                    total_overage_charge = float(m.group(1))
-                    user_tag = usage_soup.find(
-                        'p', string=re.compile(account_holder.name))
-                    usage_tag = list(
-                        user_tag.parent.parent.parent.next_siblings)[1]
-                    usage = float(usage_tag.findChild('strong').text)
-                    usages[account_holder] = usage
-                    total_data_allowance = float(
-                        list(usage_tag.findChild(
-                            'strong').next_siblings)[-1].split()[0]
-                    )
-                else:
-                    charge_total = float(m.group(1)) - offset
-                    # save data to db
-                    # ChargeType
-                    charge_type, _ = ChargeType.get_or_create(
-                        type=charge_type_name,
-                        text=charge_type_text,
-                        charge_category=wireless_charge_category
-                    )
-                    # Charge
-                    new_charge = Charge(
-                        user=account_holder,
-                        charge_type=charge_type,
-                        billing_cycle=billing_cycle,
-                        amount=charge_total
-                    )
-                    new_charge.save()
-                offset = 0.0
+    def _cache_set(self, endpoint, key, body):
+        if self.cache is not None:
+            self.cache.set(endpoint, key, body)
 
-        # iterate regular users
-        remaining_users = [u for u in users if u.number != number]
-        for user in remaining_users:
-            charge_total = 0.0
-            name, number = user.name, user.number
-            # charge section starts with user name followed by his/her number
-            target = soup.find('div',
-                               string=re.compile('{} {}'.format(name, number)))
-            for tag in target.parent.next_siblings:
-                # all charge data are in divs
-                if not isinstance(tag, Tag) or tag.name != 'div':
-                    continue
-
-                # charge section ends with Total for number
-                if 'Total for {}'.format(number) in tag.text:
-                    break
+    def fetch_cycle(self, cycle):
+        """Download bill and usage pages for a billing cycle. Safe to call
+        from worker threads since it does not touch the database.
 
-                # each charge type has 'accSummary' as one of its css classes
-                if 'accSummary' in tag.get('class', []):
-                    charge_type_text = tag.find('div').text.strip('\n\t')
-                    if charge_type_text.startswith('Monthly Charges'):
-                        charge_type_text = 'Monthly Charges'
-
-                    m = re.search(
-                        r'Total {}.*?\$([0-9.]+)'.format(charge_type_text),
-                        tag.text,
-                        flags=re.DOTALL
-                    )
-                    charge_total = float(m.group(1))
-                    # save data to db
-                    charge_type_name = slugify(charge_type_text)
-                    # ChargeType
-                    charge_type, _ = ChargeType.get_or_create(
-                        type=charge_type_name,
-                        text=charge_type_text,
-                        charge_category=wireless_charge_category
-                    )
-                    # Charge
-                    new_charge = Charge(
-                        user=user,
-                        charge_type=charge_type,
-                        billing_cycle=billing_cycle,
-                        amount=charge_total
-                    )
-                    new_charge.save()
-            if charge_total > 0:
-                charged_users.append(user)
-            charge_type, _ = ChargeType.get_or_create(
-                type='data-text-usage-charges',
-                text='Data & Text Usage Charges',
-                charge_category=wireless_charge_category
-            )
-            # data usages
-            user_tag = usage_soup.find('p', string=re.compile(user.name))
-            if user_tag:
-                usage_tag = list(
-                    user_tag.parent.parent.parent.next_siblings)[1]
-                usage = float(usage_tag.findChild('strong').text)
-                usages[user] = usage
-
-        # update share of account monthly charges for each user
-        # also calculate total wireless charges (for verification later)
-        act_m_share = (w_act_m - w_act_m_disc) / len(charged_users)
-        wireless_total = 0
-        for user in charged_users:
-            # ChargeType
-            charge_type, _ = ChargeType.get_or_create(
-                type='wireless-acount-monthly-charges-share',
-                text='Account Monthly Charges Share',
-                charge_category=wireless_charge_category
-            )
-            # Charge
-            new_charge = Charge(
-                user=user,
-                charge_type=charge_type,
-                billing_cycle=billing_cycle,
-                amount=act_m_share
-            )
-            new_charge.save()
-            user_total = Charge.select(
-                pw.fn.Sum(Charge.amount).alias('total')
-            ).join(
-                ChargeType,
-                on=Charge.charge_type_id == ChargeType.id
-            ).where(
-                (Charge.user == user),
-                Charge.billing_cycle == billing_cycle,
-                ChargeType.charge_category == wireless_charge_category
-            )
-            wireless_total += user_total[0].total
-
-        if data_overused:
-            user_share = total_data_allowance / len(charged_users)
-            overages = {k: v - user_share for k,
-                        v in usages.iteritems() if v > user_share}
-            total_overage = sum(overages.values())
-            for user, overage in overages.iteritems():
-                overage_charge = overage / total_overage * total_overage_charge
-                print('User {} over used {} GB data, will be charged extra ${:.2f}'.format(
-                    user.name, overage, overage_charge)
-                )
-                charge_type, _ = ChargeType.get_or_create(
-                    type=overage_charge_type_name,
-                    text=overage_charge_type_text,
-                    charge_category=wireless_charge_category
-                )
-                # Charge
-                new_charge = Charge(
-                    user=user,
-                    charge_type=charge_type,
-                    billing_cycle=billing_cycle,
-                    amount=overage_charge
-                )
-                new_charge.save()
-        # aggregate
-        aggregate_wireless_monthly(billing_cycle)
-
-    def run(self, lag, force):
+        When streaming, the bill is parsed while it downloads (timed as
+        part of bill_download) and bill html is None unless it is kept for
+        cache or archive.
+
+        :param cycle: tuple of billing cycle name and bill statement id
+        :type cycle: tuple
+        :returns: tuple of billing cycle name, bill statement id, bill html,
+            usage html and parsed bill (None if not streaming)
+        :rtype: tuple
+        """
+        bc_name, bill_statement_id = cycle
+
+        def fetch_bill():
+            with profiler.phase('bill_download', bc_name):
+                if self.stream:
+                    return self.stream_bill(bill_statement_id, bc_name)
+                return (None, self.fetch_bill(bill_statement_id))
+
+        def fetch_usage():
+            with profiler.phase('usage_download', bc_name):
+                return self.fetch_usage(bill_statement_id)
+
+        # the two pages do not depend on each other
+        fetched = run_concurrently({'bill': fetch_bill, 'usage': fetch_usage})
+        bill_parser, bill_html = fetched['bill']
+        bill = None
+        if bill_parser is not None:
+            with profiler.phase('parse', bc_name):
+                bill = add_usage_stream(bill_parser, [fetched['usage']])
+        return (bc_name, bill_statement_id, bill_html, fetched['usage'], bill)
+
+    def split_bill(self, bc_name, bill_statement_id, bill_html=None,
+                   usage_html=None, bill=None):
+        """Parse bill and split wireless charges among users.
+
+        Currently not parsing U-Verse charges.
+        :param bc_name: billing cycle name
+        :type bc_name: str
+        :param bill_statement_id: bill statement id, used in link
+        :type bill_statement_id: str
+        :param bill_html: prefetched bill page, downloaded if not given
+        :type bill_html: str
+        :param usage_html: prefetched usage tiles, downloaded if not given
+        :type usage_html: str
+        :param bill: bill parsed while streaming, bill_html is then only
+            used for archive (streamed bill pages are archived while they
+            download)
+        :type bill: ParsedBill
+        :returns: None
+        """
+        if bill is None:
+            if bill_html is None:
+                bill_html = self.fetch_bill(bill_statement_id)
+            if 'Account Details' not in bill_html:
+                raise ParsingError('Failed to retrieve billing page')
+        # fetch data usage in case there is an overage
+        if usage_html is None:
+            usage_html = self.fetch_usage(bill_statement_id)
+        if self.archive_dir:
+            utils.save_bill_pages(self.archive_dir, bc_name, bill_html,
+                                  usage_html)
+        if bill is None:
+            with profiler.phase('parse', bc_name):
+                bill = parse_bill(bill_html, usage_html)
+        holder = None
+        if self.holder_number is not None and bill.lines:
+            holder = find_holder(bill, self.holder_number)
+            if holder is None:
+                raise HolderError('Account holder {} not found in bill {}'
+                                   .format(self.holder_number, bc_name))
+        elif bill.lines:
+            holder = choose_account_holder(bill.lines)
+        try:
+            billing_cycle = BillingCycle.get(BillingCycle.name == bc_name)
+        except BillingCycle.DoesNotExist:
+            billing_cycle = save_parsed_bill(bc_name, bill, holder,
+                                             bill_statement_id)
+        else:
+            # split before, only apply what changed
+            charges = prepare_split_charges(bill, holder)
+            added, changed, removed = update_split_bill(billing_cycle,
+                                                        charges)
+            print('\U0001F504  Bill {} split again: {} charges added, {} '
+                  'changed, {} removed.'.format(bc_name, added, changed,
+                                                removed).encode("utf-8"))
+        if self.parsed_dir:
+            billfile.write_bill_file(self.parsed_dir, billfile.SavedBill(
+                bc_name, billing_cycle.start_date, billing_cycle.end_date,
+                bill_statement_id, holder, bill
+            ))
+
+    def run(self, lag, force, full=False):
         """
         :param lag: a list of lags indicating which bills to split
         :type lag: list
         :param force: a flag to force splitting the bill
         :type force: bool
+        :param full: scan the whole bill history, see pending_cycles
+        :type full: bool
+        :returns: names of billing cycles split, None if login failed
+        :rtype: list
+        """
+        with profiler.phase('login'):
+            logged_in = self.resume_session() or self.login()
+        if not logged_in:
+            return None
+
+        with profiler.phase('history'):
+            cycles = self.pending_cycles(lag, force, full)
+        # save after history pages, which add cookies too
+        self.save_session()
+        self.failed_cycles = []
+        if self.workers > 1:
+            # download concurrently, but parse and save in cycle order
+            pool = ThreadPool(self.workers)
+            try:
+                fetched = pool.imap(self.try_fetch_cycle, cycles)
+                for cycle in cycles:
+                    self.split_with_retry(cycle, next(fetched))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for cycle in cycles:
+                self.split_with_retry(cycle, self.try_fetch_cycle(cycle))
+        if self.failed_cycles:
+            print('\U0001F534  Failed to split bills: {}. Run again with '
+                  '--full to retry.'.format('; '.join(self.failed_cycles))
+                  .encode("utf-8"))
+        return [bc_name for bc_name, _ in cycles
+                if bc_name not in self.failed_cycles]
+
+    def try_fetch_cycle(self, cycle):
+        """Like fetch_cycle, but return the error instead of raising it so
+        that one failed download does not stop other cycles.
+
+        :returns: result of fetch_cycle or the raised error
+        :rtype: tuple or Exception
+        """
+        try:
+            return self.fetch_cycle(cycle)
+        except (requests.RequestException, ParsingError) as e:
+            return e
+
+    def split_with_retry(self, cycle, fetched):
+        """Split a fetched billing cycle. If downloading or parsing it
+        failed, download it again up to CYCLE_RETRIES times. A bill without
+        the account holder is not downloaded again.
+
+        :param cycle: tuple of billing cycle name and bill statement id
+        :type cycle: tuple
+        :param fetched: result of try_fetch_cycle
+        :type fetched: tuple or Exception
+        :returns: whether the billing cycle was split
+        :rtype: bool
+        """
+        for attempt in range(CYCLE_RETRIES + 1):
+            if attempt:
+                fetched = self.try_fetch_cycle(cycle)
+            try:
+                if isinstance(fetched, Exception):
+                    raise fetched
+                self.split_fetched(*fetched)
+                return True
+            except HolderError as e:
+                # the same bill would be downloaded again
+                print('\U000026A0  Failed to split bill {}: {}'.format(
+                    cycle[0], e).encode("utf-8"))
+                break
+            except (requests.RequestException, ParsingError) as e:
+                print('\U000026A0  Failed to split bill {}: {}'.format(
+                    cycle[0], e).encode("utf-8"))
+        self.failed_cycles.append(cycle[0])
+        return False
+
+    def split_fetched(self, bc_name, bill_statement_id, bill_html=None,
+                      usage_html=None, bill=None):
+        """Split one billing cycle with progress messages.
+
         :returns: None
         """
-        if not self.login():
-            return
+        print('\U0001F3C3  Start splitting bill {}...'.format(
+            bc_name).encode("utf-8"))
+        self.split_bill(bc_name, bill_statement_id, bill_html, usage_html,
+                        bill)
+        print('\U0001F3C1  Finished splitting bill {}.'.format(
+            bc_name).encode("utf-8"))
+
+    def pending_cycles(self, lag, force, full=False):
+        """Select billing cycles from history that need to be split.
 
+        Bill history is newest first. Unless bills are selected with lag or
+        a full scan is asked for, scanning stops at the first bill that was
+        already split, since older bills were split before it. Bills split
+        again with force are downloaded again instead of read from cache.
+
+        :param lag: a list of lags indicating which bills to split
+        :type lag: list
+        :param force: split bills again even if they were split before
+        :type force: bool
+        :param full: scan the whole history, e.g. to retry failed bills
+        :type full: bool
+        :returns: list of tuples of billing cycle name and bill statement id
+        :rtype: list
+        """
+        # one query instead of one per history row
+        known = dict(BillingCycle.select(BillingCycle.name,
+                                         BillingCycle.statement_id)
+                     .tuples())
+        known_statements = set(known.values())
+        incremental = not (lag or force or full)
+        cycles = []
         for i, (bc_name, bill_statement_id) in enumerate(self.get_history_bills()):
             # if lag is not empty, only split bills specified
-            if lag and (i not in lag) and not force:
+            if lag and (i not in lag):
                 continue
 
-            # check if billing cycle already exist
-            if BillingCycle.select().where(
-                    BillingCycle.name == bc_name
-            ):
+            # check if billing cycle already exist, unless splitting again
+            split_before = (bc_name in known or
+                            bill_statement_id in known_statements)
+            if split_before and not force:
+                if bc_name in known and known[bc_name] is None:
+                    # remember statement ids of bills split before they
+                    # were stored
+                    BillingCycle.update(statement_id=bill_statement_id).where(
+                        BillingCycle.name == bc_name
+                    ).execute()
                 print('\U000026A0  Billing Cycle {} already '
                       'processed.'.format(bc_name).encode("utf-8"))
+                if incremental:
+                    break
                 continue
 
-            print('\U0001F3C3  Start splitting bill {}...'.format(
-                bc_name).encode("utf-8"))
-            self.split_bill(bc_name, bill_statement_id)
-            print('\U0001F3C1  Finished splitting bill {}.'.format(
-                bc_name).encode("utf-8"))
+            if split_before:
+                self.refresh_statements.add(bill_statement_id)
+            cycles.append((bc_name, bill_statement_id))
+        return cycles
 
 
 @click.command()
@@ -536,19 +989,74 @@ class AttBillSplitter(object):
                     'current bill. 0 refers to the most recent bill, 1 '
                     'refers to the bill from previous month. Can be used '
                     'multiple times.'))
-@click.option('--force', '-f', default=False,
-              help=('Force to split the bill (and save) even if the bill has '
-                    'already been split before.'))
+@click.option('--force', '-f', is_flag=True, default=False,
+              help=('Split bills again even if they have been split before. '
+                    'Only charges that changed are saved.'))
+@click.option('--full', is_flag=True, default=False,
+              help=('Check the whole bill history for new bills, not only '
+                    'bills newer than the last split bill.'))
+@click.option('--workers', '-w', default=1, type=int,
+              help=('Number of bills to download concurrently. Bills are '
+                    'still split and saved one at a time in order.'))
+@click.option('--pool-size', type=int,
+              help=('Max number of connections to AT&T. Default to twice '
+                    'the number of workers.'))
+@click.option('--connect-timeout', default=DEFAULT_CONNECT_TIMEOUT_S,
+              type=float, help='Seconds to wait for a connection to AT&T.')
+@click.option('--read-timeout', default=DEFAULT_READ_TIMEOUT_S, type=float,
+              help='Seconds to wait for a response from AT&T.')
+@click.option('--retries', default=DEFAULT_RETRIES, type=int,
+              help=('Number of times a failed download is retried before '
+                    'the bill is retried.'))
+@click.option('--stream', is_flag=True, default=False,
+              help=('Parse bills while they download. Uses less memory: '
+                    'pages are written to cache and archive as they '
+                    'arrive.'))
+@click.option('--no-cache', is_flag=True, default=False,
+              help='Always download bills instead of using local cache.')
+@click.option('--no-session', is_flag=True, default=False,
+              help='Always login instead of reusing the saved session.')
+@click.option('--archive', type=click.Path(file_okay=False),
+              help=('Directory to save bill pages in, so that they can be '
+                    'split again later with att-replay-bills.'))
+@click.option('--parsed-dir', default=utils.PARSED_DIR,
+              type=click.Path(file_okay=False),
+              help=('Directory to save parsed bills in, so that they can be '
+                    'split again quickly with att-resplit.'))
+@click.option('--profile-out', type=click.Path(dir_okay=False),
+              help=('Write timings and counters of each phase of the run '
+                    'to this json file.'))
 @click.option('--username', prompt='\U0001F464  AT&T Username',
               help='Username')
 @click.option('--password', prompt='\U0001F5DD  AT&T Password',
               hide_input=True, help='Password')
-def run_split_bill(username, password, lag, force):
+def run_split_bill(username, password, lag, force, full, workers, pool_size,
+                   connect_timeout, read_timeout, retries, stream, no_cache,
+                   no_session, archive, parsed_dir, profile_out):
     """Split AT&T wireless bills among lines.
 
     By default all new (unsplit) bills will be split. If you want to select
     bills to split, use the --lag (-l) option.
     """
-    create_tables_if_not_exist()
-    splitter = AttBillSplitter(username, password)
-    splitter.run(lag, force)
+    initialize_database()
+    cache = None
+    if not no_cache:
+        cache = PageCache(utils.CACHE_DIR, utils.CACHE_MAX_BYTES)
+    session_path = None
+    if not no_session:
+        session_path = cookies.cookie_path(utils.SESSION_DIR, username)
+    transport = RetryingAdapter(pool_size=pool_size or 2 * max(1, workers),
+                                connect_timeout=connect_timeout,
+                                read_timeout=read_timeout, retries=retries)
+    if profile_out:
+        profiler.enable()
+    splitter = AttBillSplitter(username, password, workers=workers,
+                               cache=cache, archive_dir=archive,
+                               session_path=session_path,
+                               transport=transport, stream=stream,
+                               parsed_dir=parsed_dir)
+    try:
+        splitter.run(lag, force, full)
+    finally:
+        if profile_out:
+            profiler.write_json(profile_out, hosts=transport.stats())
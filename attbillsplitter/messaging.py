@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+"""Send many text messages concurrently without exceeding a rate limit."""
+
+from __future__ import division, unicode_literals
+import random
+import threading
+import time
+import timeit
+from multiprocessing.pool import ThreadPool
+from twilio.rest.exceptions import TwilioRestException
+
+# twilio allows about one message per second from a long code number
+DEFAULT_RATE = 1.0
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3
+BACKOFF_BASE_S = 0.5
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second up to `capacity`. Each acquire
+    takes one token, waiting until one is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = timeit.default_timer()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available.
+
+        :returns: None
+        """
+        while True:
+            with self._lock:
+                now = timeit.default_timer()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error):
+    """Whether sending a message may succeed if retried.
+
+    :param error: exception raised when sending
+    :type error: Exception
+    :rtype: bool
+    """
+    if isinstance(error, TwilioRestException):
+        return error.status == 429 or error.status >= 500
+    # connection errors
+    return isinstance(error, (IOError, OSError))
+
+
+def send_with_retry(message_client, body, to, bucket, retries):
+    """Send one message, retrying with jittered exponential backoff.
+
+    :returns: result dict with to, status ('sent' or 'failed'), attempts,
+        error and elapsed_s
+    :rtype: dict
+    """
+    start = timeit.default_timer()
+    result = {'to': to, 'status': 'failed', 'attempts': 0, 'error': None}
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        result['attempts'] += 1
+        try:
+            message_client.send_message(body=body, to=to)
+        except Exception as e:
+            result['error'] = '{}'.format(e)
+            if attempt == retries or not is_retryable(e):
+                break
+            delay = BACKOFF_BASE_S * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay))
+        else:
+            result['status'] = 'sent'
+            result['error'] = None
+            break
+    result['elapsed_s'] = timeit.default_timer() - start
+    return result
+
+
+def send_messages(message_client, messages, workers=DEFAULT_WORKERS,
+                  rate=DEFAULT_RATE, retries=DEFAULT_RETRIES):
+    """Send messages through a bounded pool of workers sharing one rate
+    limit.
+
+    :param message_client: client with send_message(body, to)
+    :type message_client: MessageClient
+    :param messages: list of tuples of number and message body
+    :type messages: list
+    :param workers: number of messages sent at the same time
+    :type workers: int
+    :param rate: max number of messages (attempts) per second
+    :type rate: float
+    :param retries: max number of retries for each message
+    :type retries: int
+    :returns: list of result dicts (see send_with_retry) in order of
+        messages
+    :rtype: list
+    """
+    if not messages:
+        return []
+    bucket = TokenBucket(rate)
+    pool = ThreadPool(max(1, min(workers, len(messages))))
+    try:
+        return pool.map(
+            lambda m: send_with_retry(message_client, m[1], m[0], bucket,
+                                      retries),
+            messages
+        )
+    finally:
+        pool.close()
+        pool.join()
@@ -1,10 +1,44 @@
 # -*- coding:utf-8 -*-
 """Database and Data models for att-bill-splitter."""
 
+from contextlib import contextmanager
+import os
 from peewee import *
-from attbillsplitter.utils import DATABASE_PATH
+from attbillsplitter.instrumentation import profiler
+from attbillsplitter.utils import load_database_config
 
-db = SqliteDatabase(DATABASE_PATH)
+
+class SplitterDatabase(SqliteDatabase):
+    """Sqlite database that calls back on every executed statement."""
+
+    def __init__(self, *args, **kwargs):
+        super(SplitterDatabase, self).__init__(*args, **kwargs)
+        # callables taking sql and params, e.g. to count statements
+        self.statement_callbacks = []
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        for callback in self.statement_callbacks:
+            callback(sql, params)
+        return super(SplitterDatabase, self).execute_sql(sql, params, *args,
+                                                         **kwargs)
+
+
+def database_pragmas(settings):
+    """Get pragmas set on each new connection.
+
+    :param settings: sqlite settings, see utils.load_database_config
+    :type settings: dict
+    :returns: list of tuples of pragma name and value
+    :rtype: list
+    """
+    return [(name, settings[name])
+            for name in ('journal_mode', 'synchronous', 'cache_size',
+                         'mmap_size')]
+
+
+DATABASE_CONFIG = load_database_config()
+db = SplitterDatabase(DATABASE_CONFIG['path'],
+                      pragmas=database_pragmas(DATABASE_CONFIG))
 
 
 class BaseModel(Model):
@@ -33,6 +67,8 @@ class ChargeType(BaseModel):
     type = CharField()
     text = CharField()
     charge_category = ForeignKeyField(ChargeCategory)
+    # charges of this type come from splitting bills, not from adjustments
+    from_bill = BooleanField(default=False, constraints=[SQL('DEFAULT 0')])
     created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
 
     class Meta:
@@ -45,14 +81,30 @@ class BillingCycle(BaseModel):
     name = CharField(unique=True)
     start_date = DateField(unique=True)
     end_date = DateField(unique=True)
+    # stored so billing cycles can be found by month with an index
+    end_year = IntegerField()
+    end_month = IntegerField()
+    # AT&T bill statement id, None for bills split from saved pages
+    statement_id = CharField(null=True, unique=True)
     created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
 
+    class Meta:
+        indexes = (
+            (('end_year', 'end_month'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        self.end_year = self.end_date.year
+        self.end_month = self.end_date.month
+        return super(BillingCycle, self).save(*args, **kwargs)
+
 
 class Charge(BaseModel):
     user = ForeignKeyField(User)
-    charge_type = ForeignKeyField(ChargeType)
-    billing_cycle = ForeignKeyField(BillingCycle)
-    amount = FloatField()
+    charge_type = ForeignKeyField(ChargeType, index=True)
+    billing_cycle = ForeignKeyField(BillingCycle, index=True)
+    # in cents
+    amount = IntegerField()
     created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
 
     class Meta:
@@ -62,9 +114,376 @@ class Charge(BaseModel):
         )
 
 
+# wireless total of a user in a billing cycle, kept up to date by
+# MONTHLY_BILL_TRIGGERS
 class MonthlyBill(BaseModel):
     user = ForeignKeyField(User, related_name='mb_user')
     billing_cycle = ForeignKeyField(BillingCycle,
                                     related_name='mb_billing_cycle')
-    total = FloatField()
+    # in cents
+    total = IntegerField()
     created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+
+    class Meta:
+        indexes = (
+            (('user', 'billing_cycle'), True),
+        )
+
+
+MODELS = (User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill)
+
+# bump when adding a migration to MIGRATIONS
+SCHEMA_VERSION = 5
+
+# condition on a charge row (NEW or OLD) being a wireless charge
+_WIRELESS_CHARGE = (
+    "(SELECT cc.category FROM chargetype ct "
+    "JOIN chargecategory cc ON cc.id = ct.charge_category_id "
+    "WHERE ct.id = {row}.charge_type_id) = 'wireless'"
+)
+_ADD_TO_MONTHLY_BILL = (
+    'INSERT OR IGNORE INTO monthlybill (user_id, billing_cycle_id, total) '
+    'VALUES (NEW.user_id, NEW.billing_cycle_id, 0); '
+    'UPDATE monthlybill SET total = total + NEW.amount '
+    'WHERE user_id = NEW.user_id AND billing_cycle_id = NEW.billing_cycle_id;'
+)
+_SUBTRACT_FROM_MONTHLY_BILL = (
+    'UPDATE monthlybill SET total = total - OLD.amount '
+    'WHERE user_id = OLD.user_id AND billing_cycle_id = OLD.billing_cycle_id; '
+    # users without wireless charges left have no monthly bill
+    'DELETE FROM monthlybill '
+    'WHERE user_id = OLD.user_id AND billing_cycle_id = OLD.billing_cycle_id '
+    'AND NOT EXISTS (SELECT 1 FROM charge c '
+    'JOIN chargetype ct ON ct.id = c.charge_type_id '
+    'JOIN chargecategory cc ON cc.id = ct.charge_category_id '
+    'WHERE c.user_id = OLD.user_id '
+    'AND c.billing_cycle_id = OLD.billing_cycle_id '
+    "AND cc.category = 'wireless');"
+)
+# keep monthly bills equal to the sum of wireless charges of each user in
+# each billing cycle, whoever writes the charges
+MONTHLY_BILL_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS {} AFTER {} ON charge WHEN {} '
+    'BEGIN {} END'.format(name, event, _WIRELESS_CHARGE.format(row=row), body)
+    for name, event, row, body in (
+        ('charge_monthlybill_insert', 'INSERT', 'NEW', _ADD_TO_MONTHLY_BILL),
+        ('charge_monthlybill_delete', 'DELETE', 'OLD',
+         _SUBTRACT_FROM_MONTHLY_BILL),
+        ('charge_monthlybill_update_old',
+         'UPDATE OF user_id, charge_type_id, billing_cycle_id, amount',
+         'OLD', _SUBTRACT_FROM_MONTHLY_BILL),
+        ('charge_monthlybill_update_new',
+         'UPDATE OF user_id, charge_type_id, billing_cycle_id, amount',
+         'NEW', _ADD_TO_MONTHLY_BILL),
+    )
+]
+
+
+def get_schema_version():
+    """Get schema version stored in sqlite user_version.
+
+    :returns: schema version
+    :rtype: int
+    """
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_schema_version(version):
+    """Store schema version in sqlite user_version.
+
+    :param version: schema version
+    :type version: int
+    :returns: None
+    """
+    db.execute_sql('PRAGMA user_version = {:d}'.format(version))
+
+
+def rebuild_table(table, create_sql, columns, values):
+    """Rebuild a table with a new definition, for changes ALTER TABLE can
+    not make (e.g. column types): create the new table, copy rows, drop the
+    old table and rename the new one. Indexes of the table are recreated.
+
+    :param table: table name
+    :type table: str
+    :param create_sql: CREATE TABLE statement of the new table, named
+        <table>_new
+    :type create_sql: str
+    :param columns: columns of the new table to fill
+    :type columns: list
+    :param values: sql expressions of the old table giving column values
+    :type values: list
+    :returns: None
+    """
+    indexes = [row[0] for row in db.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' "
+        'AND tbl_name = ? AND sql IS NOT NULL', (table,)
+    )]
+    db.execute_sql(create_sql)
+    db.execute_sql('INSERT INTO {table}_new ({columns}) SELECT {values} '
+                   'FROM {table}'.format(table=table,
+                                         columns=', '.join(columns),
+                                         values=', '.join(values)))
+    db.execute_sql('DROP TABLE {}'.format(table))
+    db.execute_sql('ALTER TABLE {0}_new RENAME TO {0}'.format(table))
+    for sql in indexes:
+        db.execute_sql(sql)
+
+
+def migrate_amounts_to_cents():
+    """Convert dollar amounts stored as floats to integer cents. Columns
+    are rebuilt as INTEGER, since sqlite stores values of REAL columns as
+    floats."""
+    rebuild_table(
+        'charge',
+        'CREATE TABLE "charge_new" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" INTEGER NOT NULL, "charge_type_id" INTEGER NOT NULL, '
+        '"billing_cycle_id" INTEGER NOT NULL, "amount" INTEGER NOT NULL, '
+        '"created_at" DATETIME NOT NULL DEFAULT (datetime(\'now\')), '
+        'FOREIGN KEY ("user_id") REFERENCES "user" ("id"), '
+        'FOREIGN KEY ("charge_type_id") REFERENCES "chargetype" ("id"), '
+        'FOREIGN KEY ("billing_cycle_id") REFERENCES "billingcycle" ("id"))',
+        ['id', 'user_id', 'charge_type_id', 'billing_cycle_id', 'amount',
+         'created_at'],
+        ['id', 'user_id', 'charge_type_id', 'billing_cycle_id',
+         'CAST(ROUND(amount * 100) AS INTEGER)', 'created_at']
+    )
+    rebuild_table(
+        'monthlybill',
+        'CREATE TABLE "monthlybill_new" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" INTEGER NOT NULL, "billing_cycle_id" INTEGER NOT NULL, '
+        '"total" INTEGER NOT NULL, '
+        '"created_at" DATETIME NOT NULL DEFAULT (datetime(\'now\')), '
+        'FOREIGN KEY ("user_id") REFERENCES "user" ("id"), '
+        'FOREIGN KEY ("billing_cycle_id") REFERENCES "billingcycle" ("id"))',
+        ['id', 'user_id', 'billing_cycle_id', 'total', 'created_at'],
+        ['id', 'user_id', 'billing_cycle_id',
+         'CAST(ROUND(total * 100) AS INTEGER)', 'created_at']
+    )
+
+
+def migrate_indexes():
+    """Add end_year and end_month to billing cycles and index foreign keys
+    used to filter charges and monthly bills."""
+    for column, fmt in (('end_year', '%Y'), ('end_month', '%m')):
+        db.execute_sql(
+            'ALTER TABLE billingcycle ADD COLUMN {} INTEGER'.format(column)
+        )
+        db.execute_sql(
+            "UPDATE billingcycle SET {} = CAST(strftime('{}', end_date) "
+            "AS INTEGER)".format(column, fmt)
+        )
+    # keep the latest monthly bill of a user in a billing cycle
+    db.execute_sql(
+        'DELETE FROM monthlybill WHERE id NOT IN '
+        '(SELECT MAX(id) FROM monthlybill GROUP BY user_id, billing_cycle_id)'
+    )
+    # same index names peewee uses for new databases
+    for sql in (
+        'CREATE INDEX IF NOT EXISTS billingcycle_end_year_end_month '
+        'ON billingcycle (end_year, end_month)',
+        'CREATE INDEX IF NOT EXISTS charge_charge_type_id '
+        'ON charge (charge_type_id)',
+        'CREATE INDEX IF NOT EXISTS charge_billing_cycle_id '
+        'ON charge (billing_cycle_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS '
+        'monthlybill_user_id_billing_cycle_id '
+        'ON monthlybill (user_id, billing_cycle_id)',
+    ):
+        db.execute_sql(sql)
+
+
+def migrate_statement_ids():
+    """Add statement_id to billing cycles. Known billing cycles get theirs
+    the next time they are seen in bill history."""
+    db.execute_sql('ALTER TABLE billingcycle ADD COLUMN statement_id '
+                   'VARCHAR(255)')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS '
+                   'billingcycle_statement_id ON billingcycle (statement_id)')
+
+
+def create_monthly_bill_triggers():
+    """Create triggers that keep monthly bills up to date on every insert,
+    update and delete of charges.
+
+    :returns: None
+    """
+    for sql in MONTHLY_BILL_TRIGGERS:
+        db.execute_sql(sql)
+
+
+def migrate_monthly_bill_triggers():
+    """Rebuild monthly bills from wireless charges, including charges
+    added after the bill was split, and keep them up to date with
+    triggers."""
+    db.execute_sql('DELETE FROM monthlybill')
+    db.execute_sql(
+        'INSERT INTO monthlybill (user_id, billing_cycle_id, total) '
+        'SELECT c.user_id, c.billing_cycle_id, SUM(c.amount) FROM charge c '
+        'JOIN chargetype ct ON ct.id = c.charge_type_id '
+        'JOIN chargecategory cc ON cc.id = ct.charge_category_id '
+        "WHERE cc.category = 'wireless' "
+        'GROUP BY c.user_id, c.billing_cycle_id'
+    )
+    create_monthly_bill_triggers()
+
+
+def migrate_charge_type_sources():
+    """Add from_bill to charge types. Types charged in more than one
+    billing cycle are taken as coming from bills; a type charged in a single
+    billing cycle may be a one time fee added by hand, so it is only marked
+    once a bill has it."""
+    db.execute_sql('ALTER TABLE chargetype ADD COLUMN from_bill INTEGER '
+                   'NOT NULL DEFAULT 0')
+    db.execute_sql(
+        'UPDATE chargetype SET from_bill = 1 WHERE id IN '
+        '(SELECT charge_type_id FROM charge GROUP BY charge_type_id '
+        'HAVING COUNT(DISTINCT billing_cycle_id) > 1)'
+    )
+
+
+# list of (version, migration) to bring an old database up to date
+MIGRATIONS = [
+    (1, migrate_amounts_to_cents),
+    (2, migrate_indexes),
+    (3, migrate_statement_ids),
+    (4, migrate_monthly_bill_triggers),
+    (5, migrate_charge_type_sources),
+]
+
+
+def migrate_schema():
+    """Apply migrations newer than the stored schema version, each in its
+    own transaction.
+
+    :returns: None
+    """
+    current = get_schema_version()
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.atomic():
+            migration()
+            set_schema_version(version)
+
+
+def initialize_database():
+    """Create tables of a new database, or bring an existing database up
+    to the latest schema.
+
+    :returns: None
+    """
+    directory = os.path.dirname(db.database)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # count statements of profiled phases, see instrumentation
+    if profiler.count_statement not in db.statement_callbacks:
+        db.statement_callbacks.append(profiler.count_statement)
+    db.connect()
+    if not Charge.table_exists():
+        # new databases are created with the latest schema
+        with db.atomic():
+            db.create_tables(MODELS, safe=True)
+            create_monthly_bill_triggers()
+            set_schema_version(SCHEMA_VERSION)
+    else:
+        migrate_schema()
+
+
+class IdentityCache(object):
+    """Write-through cache of a small dimension table.
+
+    All rows are loaded with one query on first use. Lookups by the unique
+    key are then served from memory and only misses hit the database.
+    """
+
+    def __init__(self, model, key_fields):
+        self.model = model
+        self.key_fields = key_fields
+        self._rows = None
+
+    def _key(self, values):
+        # foreign keys may be given as model instances or ids
+        return tuple(getattr(values[f], 'id', values[f])
+                     for f in self.key_fields)
+
+    def load(self):
+        """Load all rows of the table into the cache.
+
+        :returns: None
+        """
+        self._rows = {}
+        for row in self.model.select():
+            # _data holds raw column values, ids for foreign keys
+            self._rows[self._key(row._data)] = row
+
+    def clear(self):
+        """Drop cached rows, e.g. after a rolled back transaction.
+
+        :returns: None
+        """
+        self._rows = None
+
+    def get_or_create(self, **kwargs):
+        """Same as Model.get_or_create but looks up the unique key in the
+        cache first.
+
+        :returns: tuple of row object and whether it was created
+        :rtype: tuple
+        """
+        if self._rows is None:
+            self.load()
+        key = self._key(kwargs)
+        row = self._rows.get(key)
+        if row is not None:
+            return row, False
+        row, created = self.model.get_or_create(**kwargs)
+        self._rows[key] = row
+        return row, created
+
+
+user_cache = IdentityCache(User, ('name', 'number'))
+charge_category_cache = IdentityCache(ChargeCategory, ('category',))
+charge_type_cache = IdentityCache(ChargeType, ('type', 'charge_category'))
+
+
+def clear_caches():
+    """Clear all identity caches.
+
+    :returns: None
+    """
+    for cache in (user_cache, charge_category_cache, charge_type_cache):
+        cache.clear()
+
+
+@contextmanager
+def atomic():
+    """Like db.atomic, but clear identity caches if the transaction is
+    rolled back, since they may hold rows created in it.
+
+    :returns: None
+    """
+    try:
+        with db.atomic():
+            yield
+    except BaseException:
+        clear_caches()
+        raise
+
+
+def use_database(path, initialize=True):
+    """Point the models at another database, e.g. the database of an
+    account. The connection to the current database is closed, if any, and
+    identity caches, which hold its rows, are cleared.
+
+    :param path: path of the database
+    :type path: str
+    :param initialize: create or migrate the database, see
+        initialize_database
+    :type initialize: bool
+    :returns: None
+    """
+    # init closes the connection to the current database
+    db.init(path)
+    clear_caches()
+    if initialize:
+        initialize_database()
@@ -0,0 +1,605 @@
+# -*- coding:utf-8 -*-
+"""Helpers to parse AT&T pages and locate the pieces of a bill.
+
+parse_bill builds a tree of each page with BeautifulSoup. parse_bill_stream
+gives the same records from an event-driven parser fed with chunks of the
+page as they are downloaded, keeping only the current line's section in
+memory.
+"""
+
+from __future__ import unicode_literals
+from collections import namedtuple, OrderedDict
+import functools
+import re
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+try:
+    from html import unescape
+    from html.parser import HTMLParser
+except ImportError:
+    # python2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+import attbillsplitter.utils as utils
+from attbillsplitter.errors import ParsingError
+from attbillsplitter.instrumentation import profiler
+
+try:
+    import lxml  # noqa: F401
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
+
+# number: line number, name: user name of the line, start: div with user
+# name and number where the section starts, charge_blocks: 'accSummary'
+# divs with charges of the line
+BillSection = namedtuple('BillSection', 'number name start charge_blocks')
+
+# Parsed bill, free of database objects so it can be passed between
+# processes. Amounts are in cents.
+# text: charge type text, amount: total of the charge block
+ParsedCharge = namedtuple('ParsedCharge', 'text amount')
+# charges: list of ParsedCharge, account_monthly and account_discount: only
+# meaningful for account holder, whose monthly charges include the account
+# monthly fee and national account discount. usage and allowance: data
+# usage and total data allowance (GB) from usage tiles, None if not found.
+ParsedLine = namedtuple(
+    'ParsedLine',
+    'number name charges account_monthly account_discount usage allowance'
+)
+# lines: list of ParsedLine, account holder should be the first entry
+ParsedBill = namedtuple('ParsedBill', 'lines')
+
+TOTAL_MARKER = 'Total for'
+NAME_ROW_CLASSES = ['accRow', 'bold', 'MarTop10']
+
+# only build the parts of each page we extract data from. Usage tiles are
+# looked up through their ancestors and siblings, so the whole page is kept.
+STRAINERS = {
+    'history': SoupStrainer('td', headers='bill_period'),
+    'account': SoupStrainer('span', class_='account-number'),
+    'bill': SoupStrainer('div'),
+    'usage': None,
+}
+
+# errors of pieces missing from a malformed page, e.g. a tag that is not
+# found (AttributeError) or a total that is not a number (ValueError)
+MALFORMED_PAGE_ERRORS = (AttributeError, IndexError, KeyError, TypeError,
+                         ValueError)
+
+
+def raises_parsing_error(parser):
+    """Decorate a parser to raise ParsingError for malformed pages, so
+    callers only have to handle ParsingError."""
+    @functools.wraps(parser)
+    def wrapper(*args, **kwargs):
+        try:
+            return parser(*args, **kwargs)
+        except MALFORMED_PAGE_ERRORS as e:
+            raise ParsingError('Malformed page ({}: {})'.format(
+                type(e).__name__, e))
+    return wrapper
+
+
+def make_soup(html, page=None):
+    """Parse a page with the configured parser backend.
+
+    lxml is used when installed, otherwise html.parser. Set
+    utils.HTML_PARSER (or ATT_HTML_PARSER env var) to force a backend.
+
+    :param html: page html
+    :type html: str
+    :param page: name of the page (a key of STRAINERS) to restrict parsing
+        to the elements needed from that page. Parse the whole page if None.
+    :type page: str
+    :returns: parsed page
+    :rtype: BeautifulSoup
+    """
+    parser = utils.HTML_PARSER or DEFAULT_PARSER
+    soup = BeautifulSoup(html, parser, parse_only=STRAINERS.get(page))
+    if profiler.enabled:
+        profiler.count(nodes=len(soup.find_all(True)))
+    return soup
+
+
+def index_bill_sections(soup):
+    """Index charge sections of all lines in a bill with one traversal.
+
+    Each line's section starts with a div of user name followed by number
+    and ends with a div of 'Total for number'. Charge blocks in between
+    have 'accSummary' as one of their css classes.
+
+    :param soup: parsed bill page
+    :type soup: BeautifulSoup
+    :returns: ordered dict of number to BillSection, in order of the bill.
+        Account holder should be the first entry.
+    :rtype: OrderedDict
+    """
+    total_tags = OrderedDict()
+    name_rows = []
+    for div in soup.find_all('div'):
+        text = div.string
+        if text is None:
+            continue
+        if TOTAL_MARKER in text:
+            number = text.split(TOTAL_MARKER, 1)[1].strip()
+            total_tags.setdefault(number, div)
+        elif div.get('class') == NAME_ROW_CLASSES:
+            name_rows.append(div)
+
+    sections = OrderedDict()
+    for number, total_tag in total_tags.items():
+        start = next(
+            (t for t in name_rows if t.string.strip().endswith(number)),
+            None
+        )
+        if start is None:
+            continue
+        name = start.string.strip()[:-len(number)].strip()
+        # the section ends at the div containing the total marker
+        ends = set(id(t) for t in total_tag.parents)
+        ends.add(id(total_tag))
+        charge_blocks = []
+        for tag in start.parent.next_siblings:
+            # all charge data are in divs
+            if not isinstance(tag, Tag) or tag.name != 'div':
+                continue
+            if id(tag) in ends:
+                break
+            if 'accSummary' in tag.get('class', []):
+                charge_blocks.append(tag)
+        sections[number] = BillSection(number, name, start, charge_blocks)
+    return sections
+
+
+def parse_charge_text(title, block_text):
+    """Parse text of an 'accSummary' charge block.
+
+    :param title: text of the first div in the block, e.g. 'Monthly Charges'
+    :type title: str
+    :param block_text: all text in the block
+    :type block_text: str
+    :returns: tuple of ParsedCharge, account monthly fee and national account
+        discount (both 0 if not a monthly charges block)
+    :rtype: tuple
+    """
+    account_monthly = account_discount = 0
+    text = title.strip('\n\t')
+    if text.startswith('Monthly Charges'):
+        text = 'Monthly Charges'
+        account_monthly = utils.to_cents(
+            re.search(r'\$([0-9.]+)', block_text).group(1)
+        )
+        # national discount is applied to account monthly fee
+        m = re.search(r'National Account Discount.*?\$([0-9.]+)',
+                      block_text, re.DOTALL)
+        account_discount = utils.to_cents(m.group(1)) if m else 0
+    m = re.search(r'Total {}.*?\$([0-9.]+)'.format(re.escape(text)),
+                  block_text, flags=re.DOTALL)
+    if not m:
+        raise ParsingError('Total not found for {}'.format(text))
+    charge = ParsedCharge(text, utils.to_cents(m.group(1)))
+    return (charge, account_monthly, account_discount)
+
+
+def parse_charge_block(tag):
+    """Parse an 'accSummary' charge block.
+
+    :param tag: charge block
+    :type tag: Tag
+    :returns: see parse_charge_text
+    :rtype: tuple
+    """
+    return parse_charge_text(tag.find('div').text, tag.text)
+
+
+def make_line(number, name, blocks, usage, allowance):
+    """Build a parsed line from its parsed charge blocks.
+
+    :param blocks: list of results of parse_charge_text
+    :type blocks: list
+    :rtype: ParsedLine
+    """
+    charges = []
+    account_monthly = account_discount = 0
+    for charge, monthly, discount in blocks:
+        charges.append(charge)
+        if monthly:
+            account_monthly, account_discount = monthly, discount
+    return ParsedLine(number, name, charges, account_monthly,
+                      account_discount, usage, allowance)
+
+
+def parse_usage(usage_soup, name):
+    """Find data usage and total data allowance of a line in usage tiles.
+
+    :param usage_soup: parsed usage tiles
+    :type usage_soup: BeautifulSoup
+    :param name: user name of the line
+    :type name: str
+    :returns: tuple of usage and allowance in GB, (None, None) if not found
+    :rtype: tuple
+    """
+    user_tag = usage_soup.find('p', string=re.compile(re.escape(name)))
+    if not user_tag:
+        return (None, None)
+    usage_tag = list(user_tag.parent.parent.parent.next_siblings)[1]
+    strong = usage_tag.findChild('strong')
+    usage = float(strong.text)
+    allowance = float(list(strong.next_siblings)[-1].split()[0])
+    return (usage, allowance)
+
+
+@raises_parsing_error
+def parse_bill(bill_html, usage_html):
+    """Parse wireless charges of all lines and their data usages.
+
+    Does not touch the database, so bills can be parsed in other processes.
+
+    :param bill_html: bill page html
+    :type bill_html: str
+    :param usage_html: usage tiles html
+    :type usage_html: str
+    :returns: parsed bill
+    :rtype: ParsedBill
+    """
+    if 'Account Details' not in bill_html:
+        raise ParsingError('Failed to retrieve billing page')
+    sections = index_bill_sections(make_soup(bill_html, 'bill'))
+    usage_soup = make_soup(usage_html, 'usage')
+    lines = []
+    for section in sections.values():
+        blocks = [parse_charge_block(tag) for tag in section.charge_blocks]
+        usage, allowance = parse_usage(usage_soup, section.name)
+        lines.append(make_line(section.number, section.name, blocks, usage,
+                               allowance))
+    return ParsedBill(lines)
+
+
+# --------------------------------------------------------------------
+# Streaming
+# --------------------------------------------------------------------
+DETAILS_MARKER = 'Account Details'
+# elements without end tag
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                       'input', 'link', 'meta', 'param', 'source', 'track',
+                       'wbr'])
+
+
+class StreamElement(object):
+    """Open element of a streamed page. Only the first child is kept, to
+    work out the element's string like BeautifulSoup's Tag.string."""
+
+    __slots__ = ('tag', 'classes', 'parent', 'n_children', 'first',
+                 'last_is_text', 'string')
+
+    def __init__(self, tag, classes, parent):
+        self.tag = tag
+        self.classes = classes
+        self.parent = parent
+        self.n_children = 0
+        self.first = None
+        self.last_is_text = False
+        self.string = None
+
+
+class TreeEventParser(HTMLParser):
+    """HTMLParser that keeps the stack of open elements and calls start,
+    end and data hooks. Closed elements are dropped, so memory does not
+    grow with the page."""
+
+    def __init__(self):
+        try:
+            HTMLParser.__init__(self, convert_charrefs=True)
+        except TypeError:
+            # python2
+            HTMLParser.__init__(self)
+        self.root = StreamElement('[document]', [], None)
+        self.stack = [self.root]
+        self.nodes = 0
+
+    def _add_child(self, child, is_text):
+        parent = self.stack[-1]
+        if is_text and parent.last_is_text:
+            # adjacent strings are one string
+            if parent.n_children == 1:
+                parent.first += child
+            return
+        parent.n_children += 1
+        parent.first = child if parent.n_children == 1 else None
+        parent.last_is_text = is_text
+
+    def _close(self, element):
+        if element.n_children == 1:
+            if isinstance(element.first, StreamElement):
+                element.string = element.first.string
+            else:
+                element.string = element.first
+        # drop reference to first child
+        element.first = None
+        self.end(element)
+
+    def handle_starttag(self, tag, attrs):
+        classes = []
+        for key, value in attrs:
+            if key == 'class' and value:
+                classes = value.split()
+        element = StreamElement(tag, classes, self.stack[-1])
+        self._add_child(element, False)
+        self.nodes += 1
+        self.stack.append(element)
+        self.start(element)
+        if tag in VOID_TAGS:
+            self.stack.pop()
+            self._close(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # close unclosed inner elements too, ignore stray end tags
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                while len(self.stack) > i:
+                    self._close(self.stack.pop())
+                return
+
+    def handle_data(self, data):
+        self._add_child(data, True)
+        self.data(data)
+
+    def handle_entityref(self, name):
+        # python2, python3 converts references in handle_data
+        self.handle_data(unescape('&{};'.format(name)))
+
+    def handle_charref(self, name):
+        self.handle_data(unescape('&#{};'.format(name)))
+
+    def start(self, element):
+        pass
+
+    def end(self, element):
+        pass
+
+    def data(self, data):
+        pass
+
+
+class BillStreamParser(TreeEventParser):
+    """Extract lines of a bill page, see index_bill_sections.
+
+    Text of a line's charge blocks is kept until the line's 'Total for'
+    marker, then the line is appended to `lines` without usage.
+    """
+
+    def __init__(self):
+        TreeEventParser.__init__(self)
+        self.lines = []
+        self.found_details = False
+        self._tail = ''
+        self._done = set()
+        # current line: dict of number, name, row_parent, container,
+        # started (row_parent closed) and blocks (tuples of title and text)
+        self._section = None
+        # current charge block: dict of element, title, title_element,
+        # text and title_text lists
+        self._block = None
+
+    def feed(self, chunk):
+        # the marker may be split between chunks
+        if not self.found_details:
+            text = self._tail + chunk
+            self.found_details = DETAILS_MARKER in text
+            self._tail = text[-len(DETAILS_MARKER):]
+        TreeEventParser.feed(self, chunk)
+
+    def start(self, element):
+        section, block = self._section, self._block
+        if block is not None:
+            if block['title_element'] is None and element.tag == 'div':
+                block['title_element'] = element
+            return
+        if (section is not None and section['started'] and
+                element.tag == 'div' and 'accSummary' in element.classes and
+                element.parent is section['container']):
+            self._block = {'element': element, 'title_element': None,
+                           'text': [], 'title_text': [], 'title_open': True}
+
+    def data(self, data):
+        block = self._block
+        if block is None:
+            return
+        block['text'].append(data)
+        if block['title_element'] is not None and block['title_open']:
+            block['title_text'].append(data)
+
+    def end(self, element):
+        section, block = self._section, self._block
+        if block is not None and element is block['title_element']:
+            block['title_open'] = False
+        if element.tag == 'div' and element.string is not None:
+            text = element.string
+            if TOTAL_MARKER in text:
+                self._end_section(text.split(TOTAL_MARKER, 1)[1].strip())
+                return
+            if element.classes == NAME_ROW_CLASSES:
+                self._start_section(element)
+                return
+        if block is not None and element is block['element']:
+            title = (''.join(block['title_text'])
+                     if block['title_element'] is not None else None)
+            section['blocks'].append((title, ''.join(block['text'])))
+            self._block = None
+        elif section is not None and element is section['row_parent']:
+            section['started'] = True
+
+    def _start_section(self, row):
+        text = row.string.strip()
+        number = text.split()[-1] if text.split() else ''
+        if number in self._done:
+            return
+        if self._section is not None and self._section['number'] == number:
+            # the first name row of a line starts its section
+            return
+        self._block = None
+        self._section = {
+            'number': number,
+            'name': text[:-len(number)].strip(),
+            'row_parent': row.parent,
+            'container': row.parent.parent,
+            'started': False,
+            'blocks': [],
+        }
+
+    def _end_section(self, number):
+        section = self._section
+        if section is None or section['number'] != number:
+            return
+        # a block containing the marker ends the section, like a sibling
+        self._block = None
+        self._section = None
+        self._done.add(number)
+        blocks = []
+        for title, text in section['blocks']:
+            if title is None:
+                raise ParsingError('Charge type not found for {}'.format(
+                    section['number']))
+            blocks.append(parse_charge_text(title, text))
+        self.lines.append(make_line(number, section['name'], blocks, None,
+                                    None))
+
+
+class UsageStreamParser(TreeEventParser):
+    """Extract usage tiles, see parse_usage.
+
+    A tile is a 'p' with the user name followed by a 'strong' with the data
+    usage, and the allowance in the last string next to the 'strong'.
+    `tiles` is a list of tuples of name text, usage and allowance in GB.
+    """
+
+    def __init__(self):
+        TreeEventParser.__init__(self)
+        self.tiles = []
+        self._name = None
+        self._strong = None
+        self._usage = None
+        self._last = None
+
+    def start(self, element):
+        if element.tag == 'strong' and self._name is not None and (
+                self._strong is None):
+            self._strong = element
+        elif self._usage is not None and element.parent is self._strong.parent:
+            self._last = None
+
+    def data(self, data):
+        if (self._usage is not None and
+                self.stack[-1] is self._strong.parent):
+            self._last = (self._last or '') + data
+
+    def end(self, element):
+        if element.tag == 'p' and element.string is not None:
+            self._name = element.string
+            self._strong = self._usage = self._last = None
+        elif element is self._strong:
+            if element.string is None:
+                self._name = self._strong = None
+            else:
+                self._usage = float(element.string)
+        elif self._usage is not None and element is self._strong.parent:
+            if self._last and self._last.split():
+                self.tiles.append((self._name, self._usage,
+                                   float(self._last.split()[0])))
+            self._name = self._strong = self._usage = self._last = None
+
+
+def find_usage(tiles, name):
+    """Find data usage and allowance of a line in parsed usage tiles.
+
+    :param tiles: tiles of UsageStreamParser
+    :type tiles: list
+    :param name: user name of the line
+    :type name: str
+    :returns: tuple of usage and allowance in GB, (None, None) if not found
+    :rtype: tuple
+    """
+    for text, usage, allowance in tiles:
+        if name in text:
+            return (usage, allowance)
+    return (None, None)
+
+
+def has_usage_tiles(usage_html):
+    """Check that a usage page has data usage of at least one line, e.g.
+    before caching it.
+
+    :param usage_html: usage tiles html
+    :type usage_html: str
+    :returns: whether usage tiles were found
+    :rtype: bool
+    """
+    usage_parser = UsageStreamParser()
+    try:
+        usage_parser.feed(usage_html)
+        usage_parser.close()
+    except MALFORMED_PAGE_ERRORS:
+        return False
+    return bool(usage_parser.tiles)
+
+
+@raises_parsing_error
+def stream_bill_lines(bill_chunks):
+    """Extract lines of a bill page from its chunks, e.g. as they are
+    downloaded.
+
+    :param bill_chunks: iterable of bill page html chunks
+    :type bill_chunks: iterable
+    :returns: closed parser with lines (without usage) of the bill
+    :rtype: BillStreamParser
+    """
+    bill_parser = BillStreamParser()
+    for chunk in bill_chunks:
+        bill_parser.feed(chunk)
+    bill_parser.close()
+    if not bill_parser.found_details:
+        raise ParsingError('Failed to retrieve billing page')
+    return bill_parser
+
+
+@raises_parsing_error
+def add_usage_stream(bill_parser, usage_chunks):
+    """Add data usages from chunks of usage tiles to lines of a bill.
+
+    :param bill_parser: result of stream_bill_lines
+    :type bill_parser: BillStreamParser
+    :param usage_chunks: iterable of usage tiles html chunks
+    :type usage_chunks: iterable
+    :returns: parsed bill
+    :rtype: ParsedBill
+    """
+    usage_parser = UsageStreamParser()
+    for chunk in usage_chunks:
+        usage_parser.feed(chunk)
+    usage_parser.close()
+    if profiler.enabled:
+        profiler.count(nodes=bill_parser.nodes + usage_parser.nodes)
+    lines = []
+    for line in bill_parser.lines:
+        usage, allowance = find_usage(usage_parser.tiles, line.name)
+        lines.append(line._replace(usage=usage, allowance=allowance))
+    return ParsedBill(lines)
+
+
+def parse_bill_stream(bill_chunks, usage_chunks):
+    """Parse wireless charges of all lines and their data usages like
+    parse_bill, from chunks of the pages.
+
+    :param bill_chunks: iterable of bill page html chunks
+    :type bill_chunks: iterable
+    :param usage_chunks: iterable of usage tiles html chunks
+    :type usage_chunks: iterable
+    :returns: parsed bill
+    :rtype: ParsedBill
+    """
+    return add_usage_stream(stream_bill_lines(bill_chunks), usage_chunks)
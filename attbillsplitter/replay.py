@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+"""Split bills from saved bill and usage pages, without logging in.
+
+Pages are stored in a directory as '<billing cycle name>.bill.html' and
+'<billing cycle name>.usage.html', e.g. 'Mar 15 - Apr 14, 2016.bill.html'.
+"""
+
+from __future__ import print_function, unicode_literals
+import io
+import os
+from multiprocessing import Pool
+import click
+from attbillsplitter.utils import BILL_SUFFIX, bill_page_paths
+from attbillsplitter.main import (
+    find_holder, get_start_end_date, save_parsed_bill
+)
+from attbillsplitter.errors import HolderError, ParsingError
+from attbillsplitter.models import BillingCycle, initialize_database
+from attbillsplitter.parsers import parse_bill
+
+
+def find_saved_cycles(directory):
+    """Find billing cycles with saved pages, oldest first.
+
+    :param directory: directory of saved pages
+    :type directory: str
+    :returns: list of billing cycle names
+    :rtype: list
+    """
+    names = [f[:-len(BILL_SUFFIX)] for f in os.listdir(directory)
+             if f.endswith(BILL_SUFFIX)]
+    return sorted(names, key=get_start_end_date)
+
+
+def parse_saved_bill(args):
+    """Parse saved pages of a billing cycle. Runs in worker processes.
+
+    :param args: tuple of directory and billing cycle name
+    :type args: tuple
+    :returns: tuple of billing cycle name and parsed bill, or the
+        ParsingError raised if the pages could not be parsed
+    :rtype: tuple
+    """
+    directory, bc_name = args
+    bill_path, usage_path = bill_page_paths(directory, bc_name)
+    with io.open(bill_path, encoding='utf-8') as f:
+        bill_html = f.read()
+    usage_html = ''
+    if os.path.exists(usage_path):
+        with io.open(usage_path, encoding='utf-8') as f:
+            usage_html = f.read()
+    try:
+        return (bc_name, parse_bill(bill_html, usage_html))
+    except ParsingError as e:
+        # one bad bill should not stop other bills
+        return (bc_name, e)
+
+
+def replay_bills(directory, processes=None, holder_number=None):
+    """Parse saved bills in a process pool and save the splits in cycle
+    order. Billing cycles already in database are skipped.
+
+    :param directory: directory of saved pages
+    :type directory: str
+    :param processes: number of worker processes, default to cpu count
+    :type processes: int
+    :param holder_number: number of account holder, asked for each bill if
+        not given. Bills without it are skipped.
+    :type holder_number: str
+    :returns: names of billing cycles that could not be split
+    :rtype: list
+    """
+    known = set(bc.name for bc in BillingCycle.select(BillingCycle.name))
+    cycles = [(directory, bc_name) for bc_name in find_saved_cycles(directory)
+              if bc_name not in known]
+    if not cycles:
+        print('No new bills found in {}'.format(directory))
+        return []
+
+    failed = []
+    pool = Pool(processes)
+    try:
+        # imap keeps cycle order while bills are parsed in parallel
+        for bc_name, bill in pool.imap(parse_saved_bill, cycles):
+            try:
+                if isinstance(bill, ParsingError):
+                    raise bill
+                holder = None
+                if holder_number is not None:
+                    holder = find_holder(bill, holder_number)
+                    if holder is None:
+                        raise HolderError(
+                            'Account holder {} not found in bill {}'.format(
+                                holder_number, bc_name))
+                save_parsed_bill(bc_name, bill, holder)
+            except ParsingError as e:
+                print('\U000026A0  Failed to split bill {}: {}'.format(
+                    bc_name, e).encode("utf-8"))
+                failed.append(bc_name)
+                continue
+            print('\U0001F3C1  Finished splitting bill {}.'.format(
+                bc_name).encode("utf-8"))
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        print('\U0001F534  Failed to split bills: {}.'.format(
+            '; '.join(failed)).encode("utf-8"))
+    return failed
+
+
+@click.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--processes', '-p', type=int,
+              help='Number of processes to parse bills. Default to number '
+                   'of CPUs.')
+@click.option('--holder', help=('Account holder\'s number. You will be asked '
+                                'for each bill if not given.'))
+def run_replay_bills(directory, processes, holder):
+    """Split bills saved in DIRECTORY without logging in.
+
+    Save pages with att-split-bill --archive DIRECTORY.
+    """
+    initialize_database()
+    replay_bills(directory, processes, holder)
@@ -0,0 +1,101 @@
+# -*- coding:utf-8 -*-
+"""Per-user wireless charges of a billing cycle, shared by the summary,
+details and notify commands.
+
+A summary is read from monthly bills, which the database keeps up to date.
+A report with the breakdown by charge type is computed with one query.
+"""
+
+from __future__ import unicode_literals
+from collections import namedtuple
+import datetime as dt
+import peewee as pw
+from attbillsplitter.models import (
+    User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill
+)
+
+# charges: list of tuples of charge type text and amount in cents, None in
+# summaries
+UserReport = namedtuple('UserReport', 'id name number charges total')
+# users: list of UserReport ordered by user id, total: wireless total
+CycleReport = namedtuple('CycleReport', 'billing_cycle users total')
+
+
+def find_billing_cycle(month, year=None):
+    """Find billing cycle by month and year of its end date.
+
+    :param month: month (1 - 12) of the end date of billing cycle
+    :type month: int
+    :param year: year of the end of of billing cycle. Default to current year
+    :type year: int
+    :returns: billing cycle or None if not found
+    :rtype: BillingCycle
+    """
+    # year value default to current year
+    year = year or dt.date.today().year
+    try:
+        return BillingCycle.select().where(
+            BillingCycle.end_year == year,
+            BillingCycle.end_month == month
+        ).get()
+    except BillingCycle.DoesNotExist:
+        return None
+
+
+def get_cycle_summary(bc):
+    """Get wireless total of each user in a billing cycle.
+
+    :param bc: billing cycle
+    :type bc: BillingCycle
+    :returns: report of the billing cycle without charges of users
+    :rtype: CycleReport
+    """
+    query = (
+        MonthlyBill
+        .select(User.id, User.name, User.number, MonthlyBill.total)
+        .join(User)
+        .where(MonthlyBill.billing_cycle == bc.id)
+        .order_by(User.id)
+        .tuples()
+    )
+    users = [UserReport(id_, name, number, None, total)
+             for id_, name, number, total in query]
+    return CycleReport(bc, users, sum(u.total for u in users))
+
+
+def get_cycle_report(bc):
+    """Compute wireless charge breakdown of a billing cycle.
+
+    :param bc: billing cycle
+    :type bc: BillingCycle
+    :returns: report of the billing cycle
+    :rtype: CycleReport
+    """
+    query = (
+        User
+        .select(User.id,
+                User.name,
+                User.number,
+                ChargeType.text.alias('charge_type'),
+                pw.fn.SUM(Charge.amount).alias('total'))
+        .join(Charge)
+        .join(BillingCycle)
+        .switch(Charge)
+        .join(ChargeType)
+        .join(ChargeCategory)
+        .where(BillingCycle.id == bc.id,
+               ChargeCategory.category == 'wireless')
+        .group_by(User, BillingCycle, ChargeType)
+        .order_by(User.id)
+        .naive()
+    )
+    users = []
+    current = None
+    for row in query.execute():
+        if current is None or current.id != row.id:
+            current = UserReport(row.id, row.name, row.number, [], 0)
+            users.append(current)
+        current.charges.append((row.charge_type, row.total))
+    users = [u._replace(total=sum(amount for _, amount in u.charges))
+             for u in users]
+    return CycleReport(bc, users, sum(u.total for u in users))
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+"""Split bills again from parsed bill files, without downloading or parsing
+them, e.g. after changing how charges are split.
+
+att-split-bill saves a parsed bill file for every bill it splits, see
+billfile module.
+"""
+
+from __future__ import print_function, unicode_literals
+import timeit
+import click
+import attbillsplitter.utils as utils
+from attbillsplitter.billfile import read_bill_files
+from attbillsplitter.main import (
+    choose_account_holder, prepare_split_charges, save_parsed_bill,
+    split_parsed_bills, update_split_bill
+)
+from attbillsplitter.models import BillingCycle, initialize_database
+
+
+def resplit_bills(saved_bills):
+    """Split saved bills again. Charges of billing cycles split before are
+    updated to the new split, other billing cycles are created.
+
+    Shared charges of all bills are allocated at once, see
+    main.split_parsed_bills.
+
+    :param saved_bills: saved bills, oldest first
+    :type saved_bills: list
+    :returns: names of billing cycles split
+    :rtype: list
+    """
+    existing = dict(
+        (bc.name, bc) for bc in BillingCycle.select().where(
+            BillingCycle.name << [s.name for s in saved_bills]
+        )
+    ) if saved_bills else {}
+    holders = [
+        choose_account_holder(s.bill.lines)
+        if s.holder is None and s.bill.lines else s.holder
+        for s in saved_bills
+    ]
+    all_splits = split_parsed_bills(
+        [(s.bill, holder) for s, holder in zip(saved_bills, holders)]
+    )
+    names = []
+    for saved, holder, splits in zip(saved_bills, holders, all_splits):
+        billing_cycle = existing.get(saved.name)
+        if billing_cycle is None:
+            save_parsed_bill(saved.name, saved.bill, holder,
+                             saved.statement_id, splits)
+        else:
+            charges = prepare_split_charges(saved.bill, holder, splits)
+            update_split_bill(billing_cycle, charges)
+        names.append(saved.name)
+    return names
+
+
+@click.command()
+@click.argument('directory', default=utils.PARSED_DIR,
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--since', help=('Only split bills ending in or after this '
+                               'month, e.g. 2016-01.'))
+@click.option('--until', help=('Only split bills ending in or before this '
+                               'month, e.g. 2016-12.'))
+def run_resplit(directory, since, until):
+    """Split bills again from parsed bills saved in DIRECTORY.
+
+    DIRECTORY defaults to where att-split-bill saves parsed bills.
+    """
+    since, until = utils.parse_month(since), utils.parse_month(until)
+    initialize_database()
+    start = timeit.default_timer()
+    saved_bills = [
+        s for s in read_bill_files(directory)
+        if (since is None or (s.end_date.year, s.end_date.month) >= since) and
+        (until is None or (s.end_date.year, s.end_date.month) <= until)
+    ]
+    if not saved_bills:
+        print('No parsed bills found in {}'.format(directory))
+        return
+    names = resplit_bills(saved_bills)
+    print('\U0001F3C1  Split {} bills again in {:.2f}s.'.format(
+        len(names), timeit.default_timer() - start).encode("utf-8"))
@@ -4,18 +4,17 @@
 
 from __future__ import print_function, unicode_literals
 from builtins import input
+from collections import OrderedDict
 import datetime as dt
+import json
 import logging
 import click
-import peewee as pw
 import warnings
 import attbillsplitter.utils as utils
-from slugify import slugify
+from attbillsplitter import adjustments, messaging, reports
+from attbillsplitter.models import initialize_database
 from twilio.rest import TwilioRestClient
 from twilio.exceptions import TwilioException
-from attbillsplitter.models import (
-    User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill, db
-)
 
 warnings.simplefilter('ignore')
 logger = logging.getLogger(__name__)
@@ -37,40 +36,21 @@ def print_wireless_monthly_summary(month, year=None):
     :type year: int
     :returns: None
     """
-    # year value default to current year
-    year = year or dt.date.today().year
-    if not BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).exists():
-        print('No charge summary found for {}/{}. Please split the '
-              'bill first'.format(year, month))
+    report = load_cycle_report(month, year, summary=True)
+    if report is None:
         return
 
-    bc = BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).get()
     print('\n--------------------------------------------------------------')
-    print('    Charge Summary for Billing Cycle {}'.format(bc.name))
+    print('    Charge Summary for Billing Cycle {}'.format(
+        report.billing_cycle.name))
     print('--------------------------------------------------------------')
-    query = (
-        User
-        .select(User.name,
-                User.number,
-                MonthlyBill.total)
-        .join(MonthlyBill)
-        .where(MonthlyBill.billing_cycle_id == bc.id)
-        .naive()
-    )
-    wireless_total = 0
-    for user in query.execute():
-        print('    {:^18s} ({})      Total: {:.2f}'.format(
-            user.name, user.number, user.total
+    for user in report.users:
+        print('    {:^18s} ({})      Total: {}'.format(
+            user.name, user.number, utils.format_cents(user.total)
         ))
-        wireless_total += user.total
     print('--------------------------------------------------------------')
-    print('{:>47}: {:.2f}\n'.format('Wireless Total', wireless_total))
+    print('{:>47}: {}\n'.format('Wireless Total',
+                                utils.format_cents(report.total)))
 
 
 def print_wireless_monthly_details(month, year=None):
@@ -83,61 +63,75 @@ def print_wireless_monthly_details(month, year=None):
     :type year: int
     :returns: None
     """
-    # year value default to current year
-    year = year or dt.date.today().year
-    if not BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).exists():
-        print('No charge summary found for {}/{}. Please split the '
-              'bill first'.format(year, month))
+    report = load_cycle_report(month, year)
+    if report is None:
         return
 
-    bc = BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).get()
-    query = (
-        User
-        .select(User.id,
-                User.name,
-                User.number,
-                ChargeType.text.alias('charge_type'),
-                pw.fn.SUM(Charge.amount).alias('total'))
-        .join(Charge)
-        .join(BillingCycle)
-        .switch(Charge)
-        .join(ChargeType)
-        .join(ChargeCategory)
-        .where(BillingCycle.id == bc.id,
-               ChargeCategory.category == 'wireless')
-        .group_by(User, BillingCycle, ChargeType)
-        .order_by(User.id)
-        .naive()
-    )
-    current_user_num = ''
-    current_user_total = 0
-    wireless_total = 0
     print('')
-    for user in query.execute():
-        if user.number != current_user_num:
-            if current_user_total:
-                print('      - {:40}   {:.2f}\n'.format('Total',
-                                                        current_user_total))
-                wireless_total += current_user_total
-            current_user_num = user.number
-            current_user_total = 0
-            print('    {} ({})'.format(user.name, user.number))
-        print('      - {:40}   {:.2f}'.format(user.charge_type, user.total))
-        current_user_total += user.total
-    if current_user_total:
-        print('      - {:40}   {:.2f}\n'.format('Total', current_user_total))
-        wireless_total += current_user_total
-    print('{:>48}: {:.2f}\n'.format('Wireless Total', wireless_total))
+    for user in report.users:
+        print('    {} ({})'.format(user.name, user.number))
+        for charge_type, total in user.charges:
+            print('      - {:40}   {}'.format(charge_type,
+                                              utils.format_cents(total)))
+        print('      - {:40}   {}\n'.format(
+            'Total', utils.format_cents(user.total)))
+    print('{:>48}: {}\n'.format('Wireless Total',
+                                utils.format_cents(report.total)))
+
+
+def load_cycle_report(month, year=None, summary=False):
+    """Get report of the billing cycle ending in month and year, printing a
+    hint if it has not been split yet.
+
+    :param month: month (1 - 12) of the end date of billing cycle
+    :type month: int
+    :param year: year of the end of of billing cycle. Default to current year
+    :type year: int
+    :param summary: only get totals of users, without their charges
+    :type summary: bool
+    :returns: report of the billing cycle or None if not found
+    :rtype: CycleReport
+    """
+    bc = reports.find_billing_cycle(month, year)
+    if bc is None:
+        print('No charge summary found for {}/{}. Please split the '
+              'bill first'.format(year or dt.date.today().year, month))
+        return None
+    if summary:
+        return reports.get_cycle_summary(bc)
+    return reports.get_cycle_report(bc)
+
+
+def build_user_messages(report):
+    """Build charge details message for each user.
+
+    :param report: report of the billing cycle
+    :type report: CycleReport
+    :returns: ordered dict of number to message
+    :rtype: OrderedDict
+    """
+    messages = OrderedDict()
+    for user in report.users:
+        # nothing to pay
+        if not user.total:
+            continue
+        message = ('Hi {} ({}),\nYour AT&T Wireless Charges '
+                   'for {}:\n'.format(user.name, user.number,
+                                      report.billing_cycle.name))
+        for charge_type, total in user.charges:
+            message += '  - {:30} {}\n'.format(charge_type,
+                                               utils.format_cents(total))
+        message += '  - {:30} {} \U0001F911\n'.format(
+            'Total', utils.format_cents(user.total))
+        messages[user.number] = message
+    return messages
 
 
 def notify_users_monthly_details(message_client, payment_msg, month,
-                                 year=None):
+                                 year=None, batch=False,
+                                 workers=messaging.DEFAULT_WORKERS,
+                                 rate=messaging.DEFAULT_RATE,
+                                 report_path=None):
     """Calculate monthly charge details for users and notify them.
 
     :param message_client: a message client to send text message
@@ -149,62 +143,29 @@ def notify_users_monthly_details(message_client, payment_msg, month,
     :type month: int
     :param year: year of the end of of billing cycle. Default to current year
     :type year: int
+    :param batch: send to all users without asking, concurrently
+    :type batch: bool
+    :param workers: number of messages sent at the same time in batch mode
+    :type workers: int
+    :param rate: max messages per second in batch mode
+    :type rate: float
+    :param report_path: json file to write result of each message to in
+        batch mode
+    :type report_path: str
     :returns: None
     """
-    # year value default to current year
-    year = year or dt.date.today().year
-    if not BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).exists():
-        print('No charge summary found for {}/{}. Please split the '
-              'bill first'.format(year, month))
+    report = load_cycle_report(month, year)
+    if report is None:
         return
 
-    bc = BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).get()
-    query = (
-        User
-        .select(User.id,
-                User.name,
-                User.number,
-                ChargeType.text.alias('charge_type'),
-                pw.fn.SUM(Charge.amount).alias('total'))
-        .join(Charge)
-        .join(BillingCycle)
-        .switch(Charge)
-        .join(ChargeType)
-        .join(ChargeCategory)
-        .where(BillingCycle.id == bc.id,
-               ChargeCategory.category == 'wireless')
-        .group_by(User, BillingCycle, ChargeType)
-        .order_by(User.id)
-        .naive()
-    )
-    current_user_num = -1
-    current_user_total = 0
-    messages = {}
-    message = ''
+    bc = report.billing_cycle
+    messages = build_user_messages(report)
     print('')
-    for user in query.execute():
-        if user.number != current_user_num:
-            if current_user_total:
-                message += '  - {:30} {:.2f} \U0001F911\n'.format(
-                    'Total', current_user_total
-                )
-                messages[current_user_num] = message
-            current_user_num = user.number
-            current_user_total = 0
-            message = ('Hi {} ({}),\nYour AT&T Wireless Charges '
-                       'for {}:\n'.format(user.name, user.number, bc.name))
-        message += '  - {:30} {:.2f}\n'.format(user.charge_type, user.total)
-        current_user_total += user.total
-    if current_user_total:
-        message += '  - {:30} {:.2f} \U0001F911\n'.format('Total',
-                                                          current_user_total)
-        messages[current_user_num] = message
+    if batch:
+        send_batch_notifications(message_client, payment_msg, bc, messages,
+                                 workers, rate, report_path)
+        return
+
     # print message for user to confirm
     for num, msg in messages.items():
         print(num)
@@ -218,20 +179,75 @@ def notify_users_monthly_details(message_client, payment_msg, month,
             print('\U00002705  Message sent to {}\n'.format(num).encode("utf-8"))
 
 
+def send_batch_notifications(message_client, payment_msg, bc, messages,
+                             workers, rate, report_path=None):
+    """Send charge details to all users concurrently and print results.
+
+    :param message_client: a message client to send text message
+    :type message_client: MessageClient
+    :param payment_message: text appended to charge details
+    :param type: str
+    :param bc: billing cycle of the charge details
+    :type bc: BillingCycle
+    :param messages: dict of number to charge details
+    :type messages: dict
+    :param workers: number of messages sent at the same time
+    :type workers: int
+    :param rate: max messages per second
+    :type rate: float
+    :param report_path: json file to write result of each message to
+    :type report_path: str
+    :returns: list of result dicts
+    :rtype: list
+    """
+    bodies = [(num, '{}\n{}'.format(msg, payment_msg))
+              for num, msg in messages.items()]
+    results = messaging.send_messages(message_client, bodies, workers, rate)
+    for result in results:
+        num = result['to']
+        if result['status'] == 'sent':
+            logger.info('%s charge details sent to %s, body:\n%s',
+                        bc.name, num, messages[num])
+            print('\U00002705  Message sent to {}'.format(num).encode("utf-8"))
+        else:
+            logger.info('%s charge details failed to send to %s: %s',
+                        bc.name, num, result['error'])
+            print('\U0001F6AB  Message to {} failed after {} attempts: '
+                  '{}'.format(num, result['attempts'],
+                              result['error']).encode("utf-8"))
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
 class MessageClient(object):
-    """Twilio message client that sends text message to users."""
-    def __init__(self):
+    """Twilio message client that sends text message to users.
+
+    Credentials are loaded from config file unless given. `base` overrides
+    Twilio's API url, e.g. to send to a fake server.
+    """
+    def __init__(self, number=None, account_sid=None, auth_token=None,
+                 base=None):
+        kwargs = {'base': base} if base else {}
+        if number:
+            self.number = number
+            self.twilio_client = TwilioRestClient(account_sid, auth_token,
+                                                  **kwargs)
+            return
         try:
             number, account_sid, auth_token = utils.load_twilio_config()
             self.number = number
-            self.twilio_client = TwilioRestClient(account_sid, auth_token)
+            self.twilio_client = TwilioRestClient(account_sid, auth_token,
+                                                  **kwargs)
         except TwilioException:
             print('\U0001F6AB  Current twilio credentials invalid. '
                   'Please reset.'.encode("utf-8"))
             utils.initialize_twiolio()
             number, account_sid, auth_token = utils.load_twilio_config()
             self.number = number
-            self.twilio_client = TwilioRestClient(account_sid, auth_token)
+            self.twilio_client = TwilioRestClient(account_sid, auth_token,
+                                                  **kwargs)
 
     def send_message(self, body, to):
         """Send message body from self.number to a phone number.
@@ -256,6 +272,7 @@ def run_print_summary(month, year):
     It should be an integer from 1 to 12. You can also specify --year (YYYY).
     By default, YEAR is set to current calendar year.
     """
+    initialize_database()
     print_wireless_monthly_summary(month, year)
 
 
@@ -270,6 +287,7 @@ def run_print_details(month, year):
     It should be an integer from 1 to 12. You can also specify --year (YYYY).
     By default, YEAR is set to current calendar year.
     """
+    initialize_database()
     print_wireless_monthly_details(month, year)
 
 
@@ -277,18 +295,30 @@ def run_print_details(month, year):
 @click.argument('month', type=int)
 @click.option('-y', '--year', type=int,
               help='Year of the end date of the billing cycle (YYYY)')
-def run_notify_users(month, year):
+@click.option('--batch', is_flag=True, default=False,
+              help='Notify all users without asking, several at a time.')
+@click.option('--workers', '-w', default=messaging.DEFAULT_WORKERS, type=int,
+              help='Number of messages sent at the same time with --batch.')
+@click.option('--rate', '-r', default=messaging.DEFAULT_RATE, type=float,
+              help='Max messages per second with --batch.')
+@click.option('--report', type=click.Path(dir_okay=False),
+              help='Write result of each message to this json file.')
+def run_notify_users(month, year, batch, workers, rate, report):
     """Send monthly charge details to each user via SMS.
 
     For each user, you will first be shown his charge details, then you can
     decide whether you want to notify him/her. MONTH refers to the month of
     the end date of the billing cycle. It should be an integer from 1 to 12.
     You can also specify --year (YYYY). By default, YEAR is set to
-    current calendar year.
+    current calendar year. Use --batch to notify everyone unattended;
+    failed messages are retried with backoff.
     """
+    initialize_database()
     mc = MessageClient()
-    payment_msg = utils.load_payment_msg()
-    notify_users_monthly_details(mc, payment_msg, month, year)
+    payment_msg = utils.load_payment_msg(confirm=not batch)
+    notify_users_monthly_details(mc, payment_msg, month, year, batch=batch,
+                                 workers=workers, rate=rate,
+                                 report_path=report)
 
 
 @click.command()
@@ -296,16 +326,12 @@ def run_notify_users(month, year):
 @click.argument('charge_name', type=str)
 def add_onetime_fee(amount, charge_name):
     """Add one time charge to all users. For example, we can use this to add
-    a $2 annual Twilio fee"""
-    charge_type = slugify(charge_name)
-    ct = ChargeType.create(type=charge_type,
-                           text=charge_name,
-                           charge_category=1)
-    ct.save()
-    bc = BillingCycle.select().order_by(BillingCycle.id.desc()).get()
-
-    with db.atomic():
-        for user in User.select():
-            Charge.create(user=user, charge_type=ct, billing_cycle=bc,
-                          amount=amount).save()
-            print('{} {} added for user {}'.format(amount, charge_name, user.name))
+    a $2 annual Twilio fee. See att-adjust for credits, splits and other
+    billing cycles."""
+    initialize_database()
+    try:
+        added = adjustments.apply_adjustment(charge_name,
+                                             utils.to_cents(amount))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print('{} {} added for {} users'.format(amount, charge_name, added))
@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+"""Generate synthetic AT&T bill and usage pages for tests and benchmarks.
+
+Pages only mimic the structures the parser relies on: 'accRow bold
+MarTop10' name rows, 'accSummary' charge blocks and 'Total for' markers in
+the bill, and name / usage tiles in the usage page. Some unrelated markup is
+mixed in so that pages are not trivially small.
+"""
+
+from __future__ import unicode_literals
+import random
+
+CHARGE_TYPES = ('Equipment Charges', 'Surcharges & Fees',
+                'Government Fees & Taxes')
+ACCOUNT_MONTHLY = '100.00'
+ACCOUNT_DISCOUNT = '15.00'
+LINE_MONTHLY = '15.00'
+OVERAGE_CHARGE = '30.00'
+DATA_ALLOWANCE = 30.0
+
+
+def line_number(i):
+    """Phone number of i-th line, e.g. '415-555-0001'."""
+    return '415-{:03d}-{:04d}'.format(555 + i // 10000, i % 10000)
+
+
+def line_name(i):
+    """User name of i-th line, e.g. 'USER_NAME_1'."""
+    return 'USER_NAME_{}'.format(i)
+
+
+def _charge_block(text, total, details=''):
+    return (
+        '<div class="accSummary MarLeft20">\n'
+        '  <div>\n\t{text}\n\t</div>\n'
+        '  <table><tr><td>{details}</td></tr></table>\n'
+        '  <div class="accRow">Total {text} <span>${total}</span></div>\n'
+        '</div>\n'
+    ).format(text=text.replace('&', '&amp;'), total=total, details=details)
+
+
+def generate_bill(n_lines, overage=True, seed=0):
+    """Generate a bill page and a usage page.
+
+    The first line is the account holder. Its monthly charges include the
+    account monthly fee and national account discount. If overage is True,
+    a data overage charge is added to the account holder and some lines use
+    more than their share of data.
+
+    :param n_lines: number of lines
+    :type n_lines: int
+    :param overage: whether there is a data overage charge
+    :type overage: bool
+    :param seed: random seed for charge amounts and usages
+    :type seed: int
+    :returns: tuple of bill html and usage html
+    :rtype: tuple
+    """
+    rnd = random.Random(seed)
+    bill = ['<html><head><title>Bill</title></head><body>\n',
+            '<div id="content"><h2>Account Details</h2>\n']
+    usage = ['<html><body><div id="usage">\n']
+    share = DATA_ALLOWANCE / n_lines
+    for i in range(1, n_lines + 1):
+        name, number = line_name(i), line_number(i)
+        bill.append('<div class="accHeader">\n  <div class="accRow bold '
+                    'MarTop10">{} {}</div>\n</div>\n'.format(name, number))
+        if i == 1:
+            monthly_total = '{:.2f}'.format(
+                float(ACCOUNT_MONTHLY) - float(ACCOUNT_DISCOUNT) +
+                float(LINE_MONTHLY)
+            )
+            details = ('Mobile Share Value ${} National Account Discount '
+                       '-${} Line ${}'.format(ACCOUNT_MONTHLY,
+                                              ACCOUNT_DISCOUNT, LINE_MONTHLY))
+            bill.append(_charge_block('Monthly Charges - Mobile Share',
+                                      monthly_total, details))
+        else:
+            bill.append(_charge_block(
+                'Monthly Charges', LINE_MONTHLY,
+                'Mobile Share Value Smartphone ${}'.format(LINE_MONTHLY)))
+        for text in CHARGE_TYPES:
+            total = '{:.2f}'.format(rnd.randint(100, 5000) / 100.0)
+            bill.append(_charge_block(text, total))
+        if i == 1 and overage:
+            bill.append(_charge_block('Data & Text Usage Charges',
+                                      OVERAGE_CHARGE))
+        bill.append('<div class="accTotal">\n  <div>Total for {}</div>\n'
+                    '</div>\n'.format(number))
+
+        # every 7th line over uses data when there is an overage
+        if overage and i % 7 == 1:
+            used = share + rnd.randint(1, 300) / 100.0
+        else:
+            used = share * rnd.randint(0, 90) / 100.0
+        usage.append(
+            '<div class="tile">'
+            '<div class="tileHeader"><div><div><p>{}</p></div></div></div>\n'
+            '<div class="tileBody"><strong>{:.2f}</strong><span>GB used '
+            'of</span> {:.0f} GB</div>'
+            '</div>\n'.format(name, used, DATA_ALLOWANCE)
+        )
+    bill.append('</div></body></html>\n')
+    usage.append('</div></body></html>\n')
+    return (''.join(bill), ''.join(usage))
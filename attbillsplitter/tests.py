@@ -2,7 +2,101 @@
 """Test cases for att-bill-splitter."""
 
 import datetime as dt
-from attbillsplitter.main import get_start_end_date
+import io
+import os
+import sqlite3
+import stat
+import threading
+from bs4 import BeautifulSoup, Tag
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+from attbillsplitter import (
+    accounts, adjustments, allocation, billfile, cookies, main, messaging,
+    models, replay, reports, resplit, transport
+)
+from attbillsplitter.cache import PageCache
+from attbillsplitter.errors import ParsingError
+from attbillsplitter.instrumentation import Profiler
+from attbillsplitter.main import (
+    AttBillSplitter, get_start_end_date, prepare_split_charges,
+    save_parsed_bill, split_parsed_bill, update_split_bill
+)
+from attbillsplitter.models import (
+    SCHEMA_VERSION, BillingCycle, Charge, ChargeCategory, ChargeType,
+    MonthlyBill, atomic, charge_category_cache, charge_type_cache,
+    db, get_schema_version, use_database
+)
+from attbillsplitter.parsers import (
+    DEFAULT_PARSER, index_bill_sections, make_soup, parse_bill,
+    parse_bill_stream, parse_charge_block
+)
+from attbillsplitter.synthetic import generate_bill
+from attbillsplitter import utils
+from attbillsplitter.utils import split_cents, to_cents
+from twilio.rest.exceptions import TwilioRestException
+
+BILL_HTML = '''
+<div>
+  <div><div class="accRow bold MarTop10">ALICE 415-555-0001</div></div>
+  <div class="accSummary"><div>Monthly Charges</div></div>
+  <div class="accSummary"><div>Equipment Charges</div></div>
+  <div><div>Total for 415-555-0001</div></div>
+  <div><div class="accRow bold MarTop10">BOB 415-555-0002</div></div>
+  <div class="accSummary"><div>Monthly Charges</div></div>
+  <div><div>Total for 415-555-0002</div></div>
+</div>
+'''
+
+# schema and data of a database created before amounts were stored in cents
+LEGACY_DATABASE = '''
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "name" VARCHAR(255) NOT NULL, "number" VARCHAR(255) NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT (datetime('now')));
+CREATE TABLE "chargecategory" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "category" VARCHAR(255) NOT NULL, "text" VARCHAR(255) NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT (datetime('now')));
+CREATE TABLE "chargetype" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "type" VARCHAR(255) NOT NULL, "text" VARCHAR(255) NOT NULL,
+    "charge_category_id" INTEGER NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT (datetime('now')));
+CREATE TABLE "billingcycle" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "name" VARCHAR(255) NOT NULL, "start_date" DATE NOT NULL,
+    "end_date" DATE NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT (datetime('now')));
+CREATE TABLE "charge" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "user_id" INTEGER NOT NULL, "charge_type_id" INTEGER NOT NULL,
+    "billing_cycle_id" INTEGER NOT NULL, "amount" REAL NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT (datetime('now')));
+CREATE UNIQUE INDEX "charge_user_id_charge_type_id_billing_cycle_id"
+    ON "charge" ("user_id", "charge_type_id", "billing_cycle_id");
+CREATE TABLE "monthlybill" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "user_id" INTEGER NOT NULL, "billing_cycle_id" INTEGER NOT NULL,
+    "total" REAL NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT (datetime('now')));
+INSERT INTO "user" (id, name, number) VALUES
+    (1, 'ALICE', '415-555-0001'), (2, 'BOB', '415-555-0002');
+INSERT INTO chargecategory (id, category, text) VALUES
+    (1, 'wireless', 'Wireless');
+INSERT INTO chargetype (id, type, text, charge_category_id) VALUES
+    (1, 'monthly-charges', 'Monthly Charges', 1);
+INSERT INTO billingcycle (id, name, start_date, end_date) VALUES
+    (1, 'Mar 15 - Apr 14, 2016', '2016-03-15', '2016-04-14');
+INSERT INTO charge (user_id, charge_type_id, billing_cycle_id, amount)
+    VALUES (1, 1, 1, 30.41), (2, 1, 1, 15.1);
+INSERT INTO monthlybill (user_id, billing_cycle_id, total) VALUES
+    (1, 1, 30.41), (2, 1, 15.1), (2, 1, 15.1);
+'''
+
+
+def make_response(text, status_code=200):
+    """Build a response of a fake AT&T page."""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = text.encode('utf-8')
+    response.encoding = 'utf-8'
+    return response
 
 
 def test_get_start_end_date():
@@ -10,3 +104,747 @@ def test_get_start_end_date():
     start_date = dt.date(2016, 3, 15)
     end_date = dt.date(2016, 4, 14)
     assert get_start_end_date(billing_cycle_name) == (start_date, end_date)
+
+
+def test_load_database_config(tmpdir, monkeypatch):
+    config = tmpdir.join('conf')
+    config.write('[database]\npath = {}\nsynchronous = full\n'.format(
+        tmpdir.join('bills.db')))
+    monkeypatch.setattr(utils, 'CONFIG_PATH', str(config))
+    monkeypatch.setenv('ATT_DB_SYNCHRONOUS', 'off')
+    settings = utils.load_database_config()
+    assert settings['path'] == str(tmpdir.join('bills.db'))
+    # environment variables take priority over the config file
+    assert settings['synchronous'] == 'off'
+    assert settings['journal_mode'] == 'wal'
+
+
+def test_cookies_roundtrip(tmpdir):
+    path = cookies.cookie_path(str(tmpdir.join('sessions')), 'user')
+    jar = RequestsCookieJar()
+    jar.set('SESSION', 'abc', domain='.att.com', path='/')
+    cookies.save_cookies(jar, path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    loaded = RequestsCookieJar()
+    assert cookies.load_cookies(loaded, path)
+    assert loaded.get('SESSION', domain='.att.com') == 'abc'
+    cookies.delete_cookies(path)
+    assert not cookies.load_cookies(RequestsCookieJar(), path)
+
+
+def test_resume_session(tmpdir, monkeypatch):
+    path = cookies.cookie_path(str(tmpdir.join('sessions')), 'user')
+    valid = ['abc']
+
+    class SessionTransport(HTTPAdapter):
+        """Accepts the session cookie while it is valid."""
+
+        def send(self, request, **kwargs):
+            assert request.url.startswith(main.HISTORY_URL)
+            if 'SESSION={}'.format(valid[0]) in request.headers.get(
+                    'Cookie', ''):
+                return make_response('<td headers="bill_period"></td>')
+            # expired sessions are redirected to login
+            return make_response('', 302)
+
+    splitter = AttBillSplitter('user', 'password', session_path=path)
+    splitter.session.cookies.set('SESSION', 'abc', domain='.att.com',
+                                 path='/')
+    splitter.save_session()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    # saved cookies are reloaded by the next run
+    splitter = AttBillSplitter('user', 'password', session_path=path,
+                               transport=SessionTransport())
+    assert splitter.resume_session()
+    assert splitter.session.cookies.get('SESSION') == 'abc'
+    assert 'bill_period' in splitter._history_html
+    # expired sessions fall back to login
+    valid[0] = 'new'
+    splitter = AttBillSplitter('user', 'password', session_path=path,
+                               transport=SessionTransport())
+    logins = []
+    monkeypatch.setattr(splitter, 'login', lambda: logins.append(1))
+    assert splitter.run([], False) is None
+    assert logins == [1]
+    assert not os.path.exists(path)
+    assert splitter.session.cookies.get('SESSION') is None
+
+
+def test_page_cache_eviction(tmpdir):
+    cache = PageCache(str(tmpdir), max_bytes=1)
+    assert cache.get('bill', '20160414|123') is None
+    cache.set('bill', '20160414|123', 'Account Details')
+    # single entry exceeds max_bytes and is evicted right away
+    assert cache.get('bill', '20160414|123') is None
+    cache.max_bytes = 1024
+    cache.set('bill', '20160414|123', 'Account Details')
+    assert cache.get('bill', '20160414|123') == 'Account Details'
+    assert cache.get('usage', '20160414|123') is None
+
+
+def test_fetch_usage_cache(tmpdir, monkeypatch):
+    splitter = AttBillSplitter('user', 'password',
+                               cache=PageCache(str(tmpdir), 1024 * 1024))
+    pages = ['<html>Please sign in again</html>', generate_bill(2)[1]]
+
+    def post(url, data):
+        return make_response(pages.pop(0))
+
+    monkeypatch.setattr(splitter.session, 'post', post)
+    # error pages sent with status 200 are not cached
+    splitter.fetch_usage('20160414|123')
+    assert splitter.cache.get('usage', '20160414|123') is None
+    usage_html = splitter.fetch_usage('20160414|123')
+    assert splitter.cache.get('usage', '20160414|123') == usage_html
+    assert splitter.fetch_usage('20160414|123') == usage_html
+
+
+def test_stream_bill_to_cache_and_archive(tmpdir, monkeypatch):
+    use_database(str(tmpdir.join('bills.db')))
+    bc_name = 'Mar 15 - Apr 14, 2016'
+    bill_html, usage_html = generate_bill(3)
+    archive = str(tmpdir.join('pages'))
+    splitter = AttBillSplitter('user', 'password', stream=True,
+                               cache=PageCache(str(tmpdir.join('cache')),
+                                               1024 * 1024),
+                               archive_dir=archive,
+                               holder_number='415-555-0001')
+    pages = {'1': '<html>Please sign in again</html>', '2': bill_html}
+
+    def get(url, stream=False):
+        assert stream
+        response = make_response('')
+        response.raw = io.BytesIO(pages[url[-1]].encode('utf-8'))
+        response._content = False
+        return response
+
+    monkeypatch.setattr(main, 'BILL_LINK_TEMPLATE', 'https://att/{}')
+    monkeypatch.setattr(splitter.session, 'get', get)
+    monkeypatch.setattr(splitter.session, 'post',
+                        lambda url, data: make_response(usage_html))
+    # error pages are neither cached nor archived
+    with pytest.raises(ParsingError):
+        splitter.fetch_cycle(('Feb 15 - Mar 14, 2016', '1'))
+    assert splitter.cache.get('bill', '1') is None
+    fetched = splitter.fetch_cycle((bc_name, '2'))
+    # the page is not kept in memory
+    assert fetched[2] is None
+    splitter.split_fetched(*fetched)
+    assert splitter.cache.get('bill', '2') == bill_html
+    assert replay.find_saved_cycles(archive) == [bc_name]
+    assert replay.parse_saved_bill((archive, bc_name)) == (
+        bc_name, parse_bill(bill_html, usage_html))
+    assert [f for f in os.listdir(archive) if f.endswith('.tmp')] == []
+    db.close()
+
+
+def test_index_bill_sections():
+    sections = index_bill_sections(BeautifulSoup(BILL_HTML, 'html.parser'))
+    assert list(sections) == ['415-555-0001', '415-555-0002']
+    alice, bob = sections.values()
+    assert (alice.name, bob.name) == ('ALICE', 'BOB')
+    assert len(alice.charge_blocks) == 2
+    assert len(bob.charge_blocks) == 1
+
+
+def test_make_soup_strainer(monkeypatch):
+    try:
+        import lxml  # noqa: F401
+        assert DEFAULT_PARSER == 'lxml'
+    except ImportError:
+        assert DEFAULT_PARSER == 'html.parser'
+    bill_html, _ = generate_bill(4)
+
+    def sections(soup, parse_block):
+        return [(s.number, s.name, [parse_block(t) for t in s.charge_blocks])
+                for s in index_bill_sections(soup).values()]
+
+    for parser in set(['html.parser', DEFAULT_PARSER]):
+        monkeypatch.setattr(utils, 'HTML_PARSER', parser)
+        assert sections(make_soup(BILL_HTML, 'bill'), Tag.get_text) == (
+            sections(make_soup(BILL_HTML), Tag.get_text))
+        full = make_soup(bill_html)
+        strained = make_soup(bill_html, 'bill')
+        assert sections(strained, parse_charge_block) == (
+            sections(full, parse_charge_block))
+        # only divs are built
+        assert strained.find('body') is None
+        assert len(strained.find_all(True)) < len(full.find_all(True))
+
+
+def test_split_cents():
+    assert to_cents('30.41') == 3041
+    assert split_cents(1000, [1, 1, 1]) == [334, 333, 333]
+    overage = split_cents(to_cents('30.00'), [0.1, 0.69, 0.3, 3.31])
+    assert sum(overage) == 3000
+    assert split_cents(500, [0, 0]) == [0, 0]
+
+
+def test_allocation_many_cycles():
+    shares = allocation.equal_share([1000, 3041], [3, 2])
+    assert shares == [[334, 333, 333], [1521, 1520]]
+    overages = allocation.proportional_by_usage(
+        [3000, 1500], [[1.2, 1.79, 1.4, 4.41, 0.5], [0.5, 0.5]], [1.1, 1.0]
+    )
+    assert overages[0] == [68, 470, 205, 2257, 0]
+    assert overages[1] == [0, 0]
+
+
+def test_parse_synthetic_bill():
+    bill = parse_bill(*generate_bill(20))
+    assert len(bill.lines) == 20
+    holder = bill.lines[0]
+    assert (holder.account_monthly, holder.account_discount) == (10000, 1500)
+    assert holder.charges[0].text == 'Monthly Charges'
+    assert holder.charges[-1].amount == 3000
+    assert all(line.usage is not None for line in bill.lines)
+
+
+def test_parse_bill_stream():
+    bill_html, usage_html = generate_bill(12)
+    # small chunks split tags, entities and the details marker
+    chunks = [bill_html[i:i + 7] for i in range(0, len(bill_html), 7)]
+    assert parse_bill_stream(chunks, [usage_html]) == parse_bill(bill_html,
+                                                                 usage_html)
+
+
+def test_parse_malformed_page():
+    bill_html, usage_html = generate_bill(3)
+    usage_html = usage_html.replace('<strong>11.33</strong>',
+                                    '<strong>n/a</strong>', 1)
+    with pytest.raises(ParsingError):
+        parse_bill(bill_html, usage_html)
+    with pytest.raises(ParsingError):
+        parse_bill_stream([bill_html], [usage_html])
+
+
+def test_bill_file_roundtrip(tmpdir):
+    bill_html, usage_html = generate_bill(5)
+    bill = parse_bill(bill_html, usage_html)
+    start_date, end_date = get_start_end_date('Mar 15 - Apr 14, 2016')
+    saved = billfile.SavedBill('Mar 15 - Apr 14, 2016', start_date, end_date,
+                               '123', 0, bill)
+    assert billfile.load_bill(billfile.dump_bill(saved)) == saved
+    saved = saved._replace(statement_id=None, holder=None)
+    billfile.write_bill_file(str(tmpdir), saved)
+    assert billfile.read_bill_files(str(tmpdir)) == [saved]
+
+
+def test_migrate_legacy_database(tmpdir):
+    path = str(tmpdir.join('att_bill.db'))
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_DATABASE)
+    conn.close()
+    use_database(path)
+    assert get_schema_version() == SCHEMA_VERSION
+    assert list(db.execute_sql(
+        'SELECT typeof(amount), amount FROM charge ORDER BY id'
+    )) == [('integer', 3041), ('integer', 1510)]
+    bc = reports.find_billing_cycle(4, 2016)
+    summary = reports.get_cycle_summary(bc)
+    assert [u.total for u in summary.users] == [3041, 1510]
+    assert utils.format_cents(reports.get_cycle_report(bc).total) == '45.51'
+    # indexes survive rebuilding the table
+    assert db.execute_sql(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = "
+        "'charge_user_id_charge_type_id_billing_cycle_id'").fetchone()[0] == 1
+    db.close()
+
+
+def test_migrate_indexes(tmpdir):
+    path = str(tmpdir.join('att_bill.db'))
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_DATABASE)
+    conn.close()
+    use_database(path, initialize=False)
+    db.connect()
+    # a database of schema version 1
+    with db.atomic():
+        models.migrate_amounts_to_cents()
+        models.set_schema_version(1)
+    models.migrate_schema()
+    indexes = dict(
+        (table, set(row[1] for row in db.execute_sql(
+            'PRAGMA index_list({})'.format(table))))
+        for table in ('billingcycle', 'charge', 'monthlybill')
+    )
+    assert 'billingcycle_end_year_end_month' in indexes['billingcycle']
+    assert set(['charge_charge_type_id', 'charge_billing_cycle_id']) <= (
+        indexes['charge'])
+    assert 'monthlybill_user_id_billing_cycle_id' in indexes['monthlybill']
+    plan = ' '.join(str(row) for row in db.execute_sql(
+        'EXPLAIN QUERY PLAN SELECT * FROM charge WHERE billing_cycle_id = 1'))
+    assert 'charge_billing_cycle_id' in plan
+    assert list(db.execute_sql(
+        'SELECT end_year, end_month FROM billingcycle')) == [(2016, 4)]
+    # duplicate monthly bills were removed for the unique index
+    assert db.execute_sql(
+        'SELECT COUNT(*) FROM monthlybill').fetchone()[0] == 2
+    db.close()
+
+
+def test_identity_cache(tmpdir):
+    use_database(str(tmpdir.join('bills.db')))
+    statements = []
+
+    def count(sql, params):
+        statements.append(sql)
+
+    db.statement_callbacks.append(count)
+    try:
+        category, created = charge_category_cache.get_or_create(
+            category='wireless', text='Wireless')
+        assert created and statements
+        # hit
+        del statements[:]
+        assert charge_category_cache.get_or_create(
+            category='wireless', text='Wireless') == (category, False)
+        assert statements == []
+    finally:
+        db.statement_callbacks.remove(count)
+    # rows created in a rolled back transaction are dropped from the cache
+    with pytest.raises(ValueError):
+        with atomic():
+            charge_type_cache.get_or_create(
+                type='twilio-fee', charge_category=category,
+                defaults={'text': 'Twilio Fee'})
+            raise ValueError
+    assert ChargeType.select().count() == 0
+    charge_type, created = charge_type_cache.get_or_create(
+        type='twilio-fee', charge_category=category,
+        defaults={'text': 'Twilio Fee'})
+    assert created
+    assert ChargeType.get(ChargeType.type == 'twilio-fee').id == (
+        charge_type.id)
+    assert ChargeCategory.select().count() == 1
+    db.close()
+
+
+def test_update_split_bill(tmpdir):
+    use_database(str(tmpdir.join('bills.db')))
+    bill = parse_bill(*generate_bill(3))
+    bc = save_parsed_bill('Mar 15 - Apr 14, 2016', bill, 0)
+    charges = prepare_split_charges(bill, 0)
+    assert update_split_bill(bc, charges) == (0, 0, 0)
+    # one charge corrected, one removed
+    user, charge_type, amount = charges[-1]
+    changed = charges[:-2] + [(user, charge_type, amount + 100)]
+    assert update_split_bill(bc, changed) == (0, 1, 1)
+    # a charge type dropped from a corrected bill, adjustments are kept
+    adjustments.apply_adjustment('Twilio Fee', 200)
+    corrected = bill._replace(lines=[
+        line._replace(charges=[c for c in line.charges
+                               if c.text != 'Equipment Charges'])
+        for line in bill.lines
+    ])
+    update_split_bill(bc, prepare_split_charges(corrected, 0))
+    texts = [c.charge_type.text for c in Charge.select()]
+    assert 'Equipment Charges' not in texts
+    assert texts.count('Twilio Fee') == 3
+    totals = {}
+    for charge in Charge.select().where(Charge.billing_cycle == bc):
+        totals[charge.user_id] = totals.get(charge.user_id, 0) + charge.amount
+    assert dict((mb.user_id, mb.total) for mb in MonthlyBill.select()) == totals
+    db.close()
+
+
+def test_monthly_bill_triggers(tmpdir):
+    use_database(str(tmpdir.join('bills.db')))
+    bill = parse_bill(*generate_bill(2))
+    bc = save_parsed_bill('Mar 15 - Apr 14, 2016', bill, 0)
+
+    def totals():
+        return dict((mb.user_id, mb.total) for mb in MonthlyBill.select())
+
+    before = totals()
+    user, charge_type, _ = prepare_split_charges(bill, 0)[0]
+    fee_type = ChargeType.create(type='fee', text='Fee',
+                                 charge_category=charge_type.charge_category)
+    fee = Charge.create(user=user, charge_type=fee_type, billing_cycle=bc,
+                        amount=200)
+    assert totals()[user.id] == before[user.id] + 200
+    Charge.update(amount=50).where(Charge.id == fee.id).execute()
+    assert totals()[user.id] == before[user.id] + 50
+    fee.delete_instance()
+    assert totals() == before
+    Charge.delete().where(Charge.user == user).execute()
+    assert user.id not in totals()
+    db.close()
+
+
+def test_apply_adjustment(tmpdir):
+    use_database(str(tmpdir.join('bills.db')))
+    bill = parse_bill(*generate_bill(3))
+    for bc_name in ('Feb 15 - Mar 14, 2016', 'Mar 15 - Apr 14, 2016'):
+        save_parsed_bill(bc_name, bill, 0)
+    before = sum(mb.total for mb in MonthlyBill.select())
+    assert adjustments.apply_adjustment('Twilio Fee', 200) == 3
+    # added twice by mistake
+    with pytest.raises(ValueError):
+        adjustments.apply_adjustment('Twilio Fee', 200)
+    with pytest.raises(ValueError):
+        adjustments.apply_adjustment('Twilio fee!', 200)
+    # other billing cycles can still have it
+    assert adjustments.apply_adjustment('Twilio Fee', 200,
+                                        since=(2016, 3), until=(2016, 3)) == 3
+    assert adjustments.apply_adjustment('Credit', -1000, adjustments.SPLIT,
+                                        since=(2016, 3)) == 6
+    credits = [c.amount for c in Charge.select().join(ChargeType).where(
+        ChargeType.type == 'credit').order_by(Charge.billing_cycle,
+                                              Charge.user)]
+    assert credits == [-333, -333, -334] * 2
+    assert sum(mb.total for mb in MonthlyBill.select()) == (
+        before + 1200 - 2000)
+    # split like utils.split_cents, for fees and credits
+    for i, total in enumerate((1001, 1000, 2, -1, -1000, -1001)):
+        name = 'Split {}'.format(i)
+        adjustments.apply_adjustment(name, total, adjustments.SPLIT)
+        amounts = [c.amount for c in Charge.select().join(ChargeType).where(
+            ChargeType.text == name).order_by(Charge.user)]
+        assert amounts == split_cents(total, [1, 1, 1])
+    db.close()
+
+
+def test_cycle_report(tmpdir):
+    use_database(str(tmpdir.join('bills.db')))
+    bc = save_parsed_bill('Mar 15 - Apr 14, 2016',
+                          parse_bill(*generate_bill(3)), 0)
+    adjustments.apply_adjustment('Twilio Fee', 200)
+    report = reports.get_cycle_report(bc)
+    # same totals as monthly bills
+    assert [(u.id, u.total) for u in report.users] == [
+        (u.id, u.total) for u in reports.get_cycle_summary(bc).users]
+    assert all(('Twilio Fee', 200) in u.charges for u in report.users)
+    assert report.total == sum(c.amount for c in Charge.select())
+    db.close()
+
+
+def test_pending_cycles(tmpdir, monkeypatch):
+    use_database(str(tmpdir.join('bills.db')))
+    bill = parse_bill(*generate_bill(2))
+    # split before its statement id was stored
+    save_parsed_bill('Feb 15 - Mar 14, 2016', bill, 0)
+    history = [('May 15 - Jun 14, 2016', '4'), ('Apr 15 - May 14, 2016', '3'),
+               ('Mar 15 - Apr 14, 2016', '2'), ('Feb 15 - Mar 14, 2016', '1'),
+               ('Jan 15 - Feb 14, 2016', '0')]
+    splitter = AttBillSplitter('user', 'password')
+    monkeypatch.setattr(splitter, 'get_history_bills', lambda: iter(history))
+    save_parsed_bill('Mar 15 - Apr 14, 2016', bill, 0, '2')
+    # stops at the newest bill split before
+    assert splitter.pending_cycles([], False) == history[:2]
+    assert splitter.pending_cycles([], False, full=True) == (
+        history[:2] + history[4:])
+    assert BillingCycle.get(
+        BillingCycle.name == 'Feb 15 - Mar 14, 2016').statement_id == '1'
+    assert splitter.pending_cycles([0, 3], False) == [history[0]]
+    assert splitter.pending_cycles([0, 3], True) == [history[0], history[3]]
+    assert splitter.pending_cycles([], True) == history
+    db.close()
+
+
+def test_force_refreshes_cache(tmpdir, monkeypatch):
+    use_database(str(tmpdir.join('bills.db')))
+    bc_name = 'Mar 15 - Apr 14, 2016'
+    old_bill, old_usage = generate_bill(3, seed=0)
+    new_bill, new_usage = generate_bill(3, seed=1)
+    cache = PageCache(str(tmpdir.join('cache')), 1024 * 1024)
+    cache.set('bill', '2', old_bill)
+    cache.set('usage', '2', old_usage)
+    save_parsed_bill(bc_name, parse_bill(old_bill, old_usage), 0, '2')
+    splitter = AttBillSplitter('user', 'password', cache=cache,
+                               holder_number='415-555-0001')
+    monkeypatch.setattr(splitter, 'get_history_bills',
+                        lambda: iter([(bc_name, '2')]))
+    monkeypatch.setattr(splitter.session, 'get',
+                        lambda url, **kwargs: make_response(new_bill))
+    monkeypatch.setattr(splitter.session, 'post',
+                        lambda url, data: make_response(new_usage))
+    # AT&T corrected the bill after it was cached
+    cycles = splitter.pending_cycles([], True)
+    assert cycles == [(bc_name, '2')]
+    assert splitter.split_with_retry(cycles[0],
+                                     splitter.try_fetch_cycle(cycles[0]))
+    assert (cache.get('bill', '2'), cache.get('usage', '2')) == (new_bill,
+                                                                 new_usage)
+    expected = sorted(
+        amount for _, _, _, amount in split_parsed_bill(
+            parse_bill(new_bill, new_usage), 0))
+    assert sorted(c.amount for c in Charge.select()) == expected
+    db.close()
+
+
+def test_split_overage_within_shares():
+    bill = parse_bill(*generate_bill(4))
+    # data overage, but no line used more than its share of allowance
+    bill = bill._replace(lines=[line._replace(usage=0.5)
+                                for line in bill.lines])
+    splits = split_parsed_bill(bill, 0)
+    assert sum(amount for _, _, _, amount in splits) == sum(
+        charge.amount for line in bill.lines for charge in line.charges)
+    overage = [(i, amount) for i, type_, _, amount in splits
+               if type_ == 'data-text-usage-charges']
+    assert overage == [(0, 3000)]
+
+
+def test_run_splits_in_cycle_order(tmpdir, monkeypatch):
+    use_database(str(tmpdir.join('bills.db')))
+    history = [('May 15 - Jun 14, 2016', '2'), ('Apr 15 - May 14, 2016', '1'),
+               ('Mar 15 - Apr 14, 2016', '0')]
+    pages = dict((statement_id, generate_bill(3, seed=int(statement_id)))
+                 for _, statement_id in history)
+    finished = dict((statement_id, threading.Event())
+                    for _, statement_id in history)
+    order = []
+
+    class ReverseTransport(HTTPAdapter):
+        """Finishes bill downloads of older bills first."""
+
+        def send(self, request, **kwargs):
+            if request.method == 'POST':
+                statement_id = request.body.split('=')[-1]
+                return make_response(pages[statement_id][1])
+            statement_id = request.url.split('=')[-1]
+            older = str(int(statement_id) - 1)
+            if older in finished:
+                assert finished[older].wait(5)
+            order.append(statement_id)
+            finished[statement_id].set()
+            return make_response(pages[statement_id][0])
+
+    splitter = AttBillSplitter('user', 'password', workers=3,
+                               transport=ReverseTransport(),
+                               holder_number='415-555-0001')
+    monkeypatch.setattr(splitter, 'resume_session', lambda: True)
+    monkeypatch.setattr(splitter, 'get_history_bills', lambda: iter(history))
+    assert splitter.run([], False) == [name for name, _ in history]
+    assert order == ['0', '1', '2']
+    # saved in cycle order
+    assert [bc.name for bc in BillingCycle.select().order_by(
+        BillingCycle.id)] == [name for name, _ in history]
+    for name, statement_id in history:
+        expected = sorted(amount for _, _, _, amount in split_parsed_bill(
+            parse_bill(*pages[statement_id]), 0))
+        assert sorted(c.amount for c in Charge.select().join(
+            BillingCycle).where(BillingCycle.name == name)) == expected
+    db.close()
+
+
+def test_resplit_bills(tmpdir):
+    use_database(str(tmpdir.join('bills.db')))
+    saved_bills = []
+    for seed, bc_name in enumerate(('Feb 15 - Mar 14, 2016',
+                                    'Mar 15 - Apr 14, 2016')):
+        start_date, end_date = get_start_end_date(bc_name)
+        bill = parse_bill(*generate_bill(4, overage=not seed, seed=seed))
+        saved_bills.append(billfile.SavedBill(bc_name, start_date, end_date,
+                                              None, 0, bill))
+    save_parsed_bill(saved_bills[0].name, saved_bills[0].bill, 0)
+    # one billing cycle is split again, the other is created
+    assert resplit.resplit_bills(saved_bills) == [s.name for s in saved_bills]
+    for saved in saved_bills:
+        expected = sorted(
+            (saved.bill.lines[i].number, type_, amount)
+            for i, type_, _, amount in split_parsed_bill(saved.bill, 0)
+        )
+        stored = sorted(
+            (c.user.number, c.charge_type.type, c.amount)
+            for c in Charge.select().join(BillingCycle).where(
+                BillingCycle.name == saved.name)
+        )
+        assert stored == expected
+    db.close()
+
+
+def test_replay_bills(tmpdir):
+    archive = str(tmpdir.join('pages'))
+    bill_html, usage_html = generate_bill(3)
+    for bc_name in ('Mar 15 - Apr 14, 2016', 'Feb 15 - Mar 14, 2016'):
+        utils.save_bill_pages(archive, bc_name, bill_html, usage_html)
+    assert replay.find_saved_cycles(archive) == ['Feb 15 - Mar 14, 2016',
+                                                 'Mar 15 - Apr 14, 2016']
+    use_database(str(tmpdir.join('replayed.db')))
+    replay.replay_bills(archive, processes=1, holder_number='415-555-0001')
+    replayed = [(c.billing_cycle.name, c.user.number, c.charge_type.type,
+                 c.amount) for c in Charge.select().order_by(Charge.id)]
+    assert len(set(name for name, _, _, _ in replayed)) == 2
+    # bills already in database are skipped
+    replay.replay_bills(archive, processes=1, holder_number='415-555-0001')
+    assert Charge.select().count() == len(replayed)
+    db.close()
+    # same split as from the downloaded pages
+    use_database(str(tmpdir.join('split.db')))
+    for bc_name in replay.find_saved_cycles(archive):
+        save_parsed_bill(bc_name, parse_bill(bill_html, usage_html), 0)
+    split = [(c.billing_cycle.name, c.user.number, c.charge_type.type,
+              c.amount) for c in Charge.select().order_by(Charge.id)]
+    assert split == replayed
+    db.close()
+
+
+def test_replay_bad_bills(tmpdir):
+    archive = str(tmpdir.join('pages'))
+    bill_html, usage_html = generate_bill(3)
+    utils.save_bill_pages(archive, 'Jan 15 - Feb 14, 2016', bill_html,
+                          usage_html.replace('<strong>11.33</strong>',
+                                             '<strong>n/a</strong>'))
+    # only the holder's line
+    utils.save_bill_pages(archive, 'Feb 15 - Mar 14, 2016',
+                          *generate_bill(1))
+    utils.save_bill_pages(archive, 'Mar 15 - Apr 14, 2016', bill_html,
+                          usage_html)
+    use_database(str(tmpdir.join('bills.db')))
+    # bills that fail are reported, without asking for the holder
+    assert replay.replay_bills(archive, processes=1,
+                               holder_number='415-555-0002') == [
+        'Jan 15 - Feb 14, 2016', 'Feb 15 - Mar 14, 2016']
+    assert [bc.name for bc in BillingCycle.select()] == [
+        'Mar 15 - Apr 14, 2016']
+    db.close()
+
+
+def test_split_account(tmpdir, monkeypatch):
+    manifest = tmpdir.join('accounts.conf')
+    manifest.write(
+        '[home]\nusername = home_user\npassword = secret\n'
+        'holder = 415-555-0001\ndatabase = {}\n'
+        '[work]\nusername = work_user\npassword = wrong\n'
+        'holder = 415-555-0001\ndatabase = {}\n'.format(
+            tmpdir.join('home.db'), tmpdir.join('work.db')))
+
+    class FakeSplitter(object):
+        def __init__(self, username, password, **kwargs):
+            self.password = password
+            self.failed_cycles = []
+
+        def run(self, lag, force, full):
+            if self.password == 'wrong':
+                return None
+            save_parsed_bill('Mar 15 - Apr 14, 2016',
+                             parse_bill(*generate_bill(2)), 0)
+            return ['Mar 15 - Apr 14, 2016']
+
+    monkeypatch.setattr(accounts, 'AttBillSplitter', FakeSplitter)
+    monkeypatch.setattr(accounts, 'profiler', Profiler())
+    options = {'lag': [], 'force': False, 'full': False, 'workers': 1,
+               'stream': False, 'no_cache': True, 'no_session': True,
+               'archive': None}
+    home, work = [accounts.split_account((account, options))
+                  for account in accounts.load_manifest(str(manifest))]
+    assert (home['status'], home['cycles']) == ('ok',
+                                                ['Mar 15 - Apr 14, 2016'])
+    assert (work['status'], work['error']) == ('failed',
+                                               'LoginError: Login failed')
+    # each account is saved to its own database
+    use_database(home['database'])
+    assert BillingCycle.select().count() == 1
+    use_database(work['database'])
+    assert BillingCycle.select().count() == 0
+    db.close()
+
+
+def test_split_with_retry(capsys):
+    bill_html, usage_html = generate_bill(3)
+    # statement 1 has a malformed usage page, statement 2 is fine
+    pages = {'1': (bill_html, usage_html.replace('<strong>11.33</strong>',
+                                                 '<strong>n/a</strong>')),
+             '2': (bill_html, usage_html)}
+    downloads = []
+
+    class PageTransport(HTTPAdapter):
+        def send(self, request, **kwargs):
+            if request.method == 'POST':
+                return make_response(pages[request.body[-1]][1])
+            downloads.append(request.url[-1])
+            return make_response(pages[request.url[-1]][0])
+
+    splitter = AttBillSplitter('user', 'password', transport=PageTransport(),
+                               holder_number='415-555-0009')
+    # a bad page is downloaded again
+    cycle = ('Feb 15 - Mar 14, 2016', '1')
+    assert not splitter.split_with_retry(cycle,
+                                         splitter.try_fetch_cycle(cycle))
+    assert downloads == ['1'] * (main.CYCLE_RETRIES + 1)
+    # a bill without the account holder is not
+    cycle = ('Mar 15 - Apr 14, 2016', '2')
+    assert not splitter.split_with_retry(cycle,
+                                         splitter.try_fetch_cycle(cycle))
+    assert downloads.count('2') == 1
+    assert 'Account holder 415-555-0009 not found' in capsys.readouterr().out
+    assert splitter.failed_cycles == ['Feb 15 - Mar 14, 2016',
+                                      'Mar 15 - Apr 14, 2016']
+
+
+def test_profiler_report():
+    profiler = Profiler()
+    with profiler.phase('login'):
+        profiler.count(requests=2)
+    assert profiler.records == []
+    profiler.enable()
+    seen = []
+    profiler.add_hook(seen.append)
+    with profiler.phase('bill_download', 'Mar 15 - Apr 14, 2016'):
+        profiler.count(requests=1, bytes=100)
+        with profiler.phase('parse', 'Mar 15 - Apr 14, 2016'):
+            profiler.count(nodes=10)
+    report = profiler.report()
+    assert [r['phase'] for r in seen] == ['parse', 'bill_download']
+    assert report['totals']['bill_download']['bytes'] == 100
+    assert report['totals']['bill_download']['nodes'] == 0
+    cycle = report['cycles']['Mar 15 - Apr 14, 2016']
+    assert cycle['parse']['nodes'] == 10
+
+
+def test_send_messages_retries(monkeypatch):
+    monkeypatch.setattr(messaging, 'BACKOFF_BASE_S', 0.001)
+
+    class FlakyClient(object):
+        calls = []
+
+        def send_message(self, body, to):
+            self.calls.append(to)
+            if to == 'invalid':
+                raise TwilioRestException(400, 'uri', 'invalid number')
+            if to == 'flaky' and self.calls.count(to) < 3:
+                raise TwilioRestException(503, 'uri', 'unavailable')
+
+    messages = [('ok', 'hi'), ('flaky', 'hi'), ('invalid', 'hi')]
+    results = messaging.send_messages(FlakyClient(), messages, rate=1000)
+    assert [r['status'] for r in results] == ['sent', 'sent', 'failed']
+    assert [r['attempts'] for r in results] == [1, 3, 1]
+
+
+def test_retrying_adapter(monkeypatch):
+    monkeypatch.setattr(transport, 'BACKOFF_BASE_S', 0.001)
+    statuses = [503, 502, 200, 503]
+
+    def send(self, request, **kwargs):
+        assert kwargs['timeout'] == (1, 2)
+        response = requests.Response()
+        response.status_code = statuses.pop(0)
+        response.raw = io.BytesIO()
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    adapter = transport.RetryingAdapter(connect_timeout=1, read_timeout=2)
+    get = requests.Request('GET', 'https://www.att.com/olam/').prepare()
+    assert adapter.send(get).status_code == 200
+    # never resend requests that are not idempotent
+    post = requests.Request('POST', 'https://www.att.com/olam/').prepare()
+    assert adapter.send(post).status_code == 503
+    stats = adapter.stats()['www.att.com']
+    assert (stats['requests'], stats['errors']) == (4, 3)
+
+
+def test_run_concurrently():
+    threads = {}
+
+    def call(name):
+        def run():
+            threads[name] = threading.current_thread()
+            return name.upper()
+        return run
+
+    results = transport.run_concurrently({'bill': call('bill'),
+                                          'usage': call('usage')})
+    assert results == {'bill': 'BILL', 'usage': 'USAGE'}
+    assert threads['bill'] is not threads['usage']
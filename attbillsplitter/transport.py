@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+"""HTTP transport for AT&T sessions: pooled connections, timeouts, retries
+of idempotent requests, per-host latency statistics and concurrent fan-out
+of independent requests."""
+
+from __future__ import division, unicode_literals
+import random
+import threading
+import time
+import timeit
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+from requests import exceptions
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT_S = 10.0
+DEFAULT_READ_TIMEOUT_S = 60.0
+DEFAULT_RETRIES = 3
+BACKOFF_BASE_S = 0.5
+# safe to send again, e.g. not the login form POST
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class RetryingAdapter(HTTPAdapter):
+    """HTTP adapter with default timeouts that retries idempotent requests
+    on connection errors, timeouts and retryable statuses with jittered
+    exponential backoff.
+
+    Latency (time until response headers) of every attempt is recorded per
+    host, see stats.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_S,
+                 read_timeout=DEFAULT_READ_TIMEOUT_S,
+                 retries=DEFAULT_RETRIES):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.latency = {}
+        self._lock = threading.Lock()
+        super(RetryingAdapter, self).__init__(pool_connections=pool_size,
+                                              pool_maxsize=pool_size)
+
+    def _record(self, host, elapsed, error):
+        with self._lock:
+            stats = self.latency.setdefault(host, {
+                'requests': 0, 'errors': 0, 'total_s': 0.0, 'max_s': 0.0
+            })
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['total_s'] += elapsed
+            stats['max_s'] = max(stats['max_s'], elapsed)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlparse(request.url).netloc
+        retries = self.retries if request.method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            start = timeit.default_timer()
+            try:
+                response = super(RetryingAdapter, self).send(request,
+                                                             **kwargs)
+            except (exceptions.ConnectionError, exceptions.Timeout):
+                self._record(host, timeit.default_timer() - start, True)
+                if attempt == retries:
+                    raise
+            else:
+                error = response.status_code in RETRY_STATUSES
+                self._record(host, timeit.default_timer() - start, error)
+                if not error or attempt == retries:
+                    return response
+                response.close()
+            delay = BACKOFF_BASE_S * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay))
+
+    def stats(self):
+        """Latency statistics per host.
+
+        :returns: dict of host to dict of requests, errors, total_s, max_s
+            and mean_s
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(
+                (host, dict(s, mean_s=s['total_s'] / s['requests']))
+                for host, s in self.latency.items()
+            )
+
+
+def run_concurrently(calls):
+    """Run independent calls (e.g. requests) at the same time, one thread
+    each. The first call runs in the current thread.
+
+    :param calls: dict of name to callable taking no arguments
+    :type calls: dict
+    :returns: dict of name to result of the call
+    :rtype: dict
+    :raises: first error raised by a call, after all calls finished
+    """
+    names = list(calls)
+    results = {}
+    errors = []
+
+    def target(name):
+        try:
+            results[name] = calls[name]()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=target, args=(name,))
+               for name in names[1:]]
+    for thread in threads:
+        thread.start()
+    if names:
+        target(names[0])
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -7,17 +7,182 @@ try:
     import configparser
 except:
     import ConfigParser as configparser
+import datetime as dt
+from decimal import Decimal, ROUND_FLOOR, ROUND_HALF_UP
+import io
 import os
 import sys
 import warnings
+import click
 
 CONFIG_PATH = os.path.expanduser('~/.attbillsplitter.conf')
 PAGE_LOADING_WAIT_S = 10
-DATABASE_PATH = 'att_bill.db'
+DATABASE_PATH = os.path.expanduser('~/.attbillsplitter.db')
+# used by older versions, relative to the working directory
+LEGACY_DATABASE_PATH = 'att_bill.db'
+# sqlite settings, overridden by the [database] section of the config file
+# and by ATT_DB_<NAME> environment variables (e.g. ATT_DB_PATH)
+DATABASE_DEFAULTS = {
+    'path': DATABASE_PATH,
+    'journal_mode': 'wal',
+    # safe with wal, only the last transactions may be lost on power loss
+    'synchronous': 'normal',
+    # negative values are in KiB
+    'cache_size': '-16000',
+    'mmap_size': str(64 * 1024 * 1024),
+}
 LOG_PATH = 'notif_history.log'
+CACHE_DIR = os.path.expanduser('~/.attbillsplitter_cache')
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+# saved session cookies, see cookies module
+SESSION_DIR = os.path.expanduser('~/.attbillsplitter_sessions')
+# html parser for BeautifulSoup, e.g. 'lxml' or 'html.parser'. Picked
+# automatically if not set.
+HTML_PARSER = os.environ.get('ATT_HTML_PARSER')
+# file name suffixes of saved bill pages, see save_bill_pages
+BILL_SUFFIX = '.bill.html'
+USAGE_SUFFIX = '.usage.html'
+# parsed bills for att-resplit, see billfile module
+PARSED_DIR = os.path.expanduser('~/.attbillsplitter_parsed')
+PARSED_SUFFIX = '.parsed'
 warnings.simplefilter('ignore')
 
 
+def to_cents(amount):
+    """Convert a dollar amount to integer cents, rounding half up.
+
+    :param amount: dollar amount, e.g. '12.34' or 12.34
+    :type amount: str or float
+    :returns: amount in cents
+    :rtype: int
+    """
+    # go through str so floats like 0.285 are not rounded as 0.28499...
+    cents = Decimal(str(amount)) * 100
+    return int(cents.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_cents(cents):
+    """Format integer cents as dollars with two decimals, e.g. '12.34'.
+
+    :param cents: amount in cents
+    :type cents: int
+    :returns: formatted amount
+    :rtype: str
+    """
+    sign = '-' if cents < 0 else ''
+    return '{}{}.{:02d}'.format(sign, abs(cents) // 100, abs(cents) % 100)
+
+
+def split_cents(total, weights):
+    """Split integer cents proportionally to weights so that the parts add
+    up exactly to total (largest remainder method).
+
+    :param total: amount in cents to split
+    :type total: int
+    :param weights: non-negative weight of each part
+    :type weights: list
+    :returns: list of cents for each part
+    :rtype: list
+    """
+    weight_sum = sum(weights)
+    if not weights or not weight_sum:
+        return [0] * len(weights)
+    shares = [Decimal(total) * Decimal(str(w)) / Decimal(str(weight_sum))
+              for w in weights]
+    parts = [int(share.to_integral_value(rounding=ROUND_FLOOR))
+             for share in shares]
+    left = total - sum(parts)
+    # hand out remaining cents to parts with largest remainders first
+    order = sorted(range(len(shares)),
+                   key=lambda i: (shares[i] - parts[i], -i), reverse=True)
+    for i in order[:left]:
+        parts[i] += 1
+    return parts
+
+
+def parse_month(value):
+    """Parse a YYYY-MM option value.
+
+    :returns: tuple of year and month, None if value is not given
+    :rtype: tuple
+    """
+    if not value:
+        return None
+    try:
+        month = dt.datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise click.BadParameter('Month must be like 2016-04')
+    return (month.year, month.month)
+
+
+def bill_page_paths(directory, bc_name):
+    """Get paths of saved bill and usage pages of a billing cycle.
+
+    :param directory: directory of saved pages
+    :type directory: str
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :returns: tuple of bill page path and usage page path
+    :rtype: tuple
+    """
+    return (os.path.join(directory, bc_name + BILL_SUFFIX),
+            os.path.join(directory, bc_name + USAGE_SUFFIX))
+
+
+def save_bill_pages(directory, bc_name, bill_html, usage_html):
+    """Save bill and usage pages of a billing cycle for later replay.
+
+    :param directory: directory of saved pages
+    :type directory: str
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :param bill_html: bill page html, None if it was saved while streaming
+    :type bill_html: str
+    :param usage_html: usage tiles html
+    :type usage_html: str
+    :returns: None
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    bill_path, usage_path = bill_page_paths(directory, bc_name)
+    for path, html in ((bill_path, bill_html), (usage_path, usage_html)):
+        if html is None:
+            continue
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+
+
+def load_database_config():
+    """Load sqlite settings from defaults, config file and environment
+    variables, in increasing order of priority.
+
+    If no path is configured and a database of an older version exists in
+    the working directory, that database is used.
+
+    :returns: dict of path, journal_mode, synchronous, cache_size and
+        mmap_size
+    :rtype: dict
+    """
+    settings = dict(DATABASE_DEFAULTS)
+    config = configparser.ConfigParser()
+    config.read(CONFIG_PATH)
+    configured = False
+    if 'database' in config.sections():
+        for name, value in config.items('database'):
+            if name in settings:
+                settings[name] = value
+                configured = configured or name == 'path'
+    for name in settings:
+        value = os.environ.get('ATT_DB_{}'.format(name.upper()))
+        if value:
+            settings[name] = value
+            configured = configured or name == 'path'
+    if not configured and os.path.exists(LEGACY_DATABASE_PATH):
+        settings['path'] = LEGACY_DATABASE_PATH
+    settings['path'] = os.path.expanduser(settings['path'])
+    return settings
+
+
 def initialize_twiolio():
     """Initialize twilio credentials from command line input and save in
     config file.
@@ -81,9 +246,11 @@ def initialize_payment_msg():
     print('\U00002705  New payment message saved.'.encode("utf-8"))
 
 
-def load_payment_msg():
+def load_payment_msg(confirm=True):
     """Load payment message. Prompt to initialize if not yet initialized.
 
+    :param confirm: ask whether to keep using the saved message
+    :type confirm: bool
     :returns: payment message cached in config file
     :rtype: str
     """
@@ -95,7 +262,7 @@ def load_payment_msg():
         initialize_payment_msg()
         config.read(CONFIG_PATH)
 
-    else:
+    elif confirm:
         message = config.get('message', 'payment')
         prompt = ('\U00002753  Do you want to keep using the following '
                   'message: \n{}\n(y/n)? '.format(message))
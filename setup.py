@@ -24,6 +24,10 @@ setup(
     ],
     packages=find_packages(),
     extras_require={
+        'fast': [
+            'lxml',
+            'numpy'
+        ],
         'testing': [
             'pytest>=2.9.2'
         ]
@@ -31,10 +35,14 @@ setup(
     entry_points={
         'console_scripts': [
             'att-split-bill=attbillsplitter.entrypoints:split_bill',
+            'att-replay-bills=attbillsplitter.entrypoints:replay_bills',
+            'att-resplit=attbillsplitter.entrypoints:resplit',
+            'att-split-accounts=attbillsplitter.entrypoints:split_accounts',
             'att-print-summary=attbillsplitter.entrypoints:print_summary',
             'att-print-details=attbillsplitter.entrypoints:print_details',
             'att-notify-users=attbillsplitter.entrypoints:notify_users',
             'att-add-onetime-fee=attbillsplitter.entrypoints:add_onetime_fee',
+            'att-adjust=attbillsplitter.entrypoints:adjust',
             'att-init-twilio=attbillsplitter.entrypoints:init_twilio',
             'att-init-payment-msg=attbillsplitter.entrypoints:init_payment_msg'
         ],